@@ -0,0 +1,76 @@
+"""
+Compare the bar string parser in helpers/barConversion.py with the regex and eval() parser it replaced.
+
+Usage:
+    python -m benchmarks.bar_parser_benchmark --lines 100000 --output parser.json
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import random
+import re
+import sys
+import time
+
+from helpers.barConversion import bars_string_to_dict, bars_strings_to_columns
+
+def legacy_bars_string_to_dict(data):
+    # The previous implementation, kept here as the baseline
+    pattern = r"(\w+)=('[^']*'|datetime\.datetime\([^\)]*\)|[^ ]+)"
+    matches = re.findall(pattern, data)
+    result_dict = {}
+    for key, value in matches:
+        if key == 'timestamp':
+            value = eval(value)
+        result_dict[key] = value
+    return result_dict
+
+def make_lines(count, seed=1):
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 9, 23, 13, 30, tzinfo=datetime.timezone.utc)
+    lines = []
+    for i in range(count):
+        timestamp = repr(start + datetime.timedelta(minutes=i // 100))
+        price = rng.uniform(10, 500)
+        lines.append(
+            f"symbol='SYM{i % 100:03d}' timestamp={timestamp} open={price:.2f} high={price + 0.5:.2f} low={price - 0.5:.2f} "
+            f"close={price + 0.1:.2f} volume={rng.randint(100, 100000)}.0 trade_count={rng.randint(1, 500)}.0 vwap={price + 0.05:.4f}"
+        )
+    return lines
+
+def time_it(function, lines) -> dict:
+    start = time.perf_counter()
+    function(lines)
+    elapsed = time.perf_counter() - start
+    return {'secs': round(elapsed, 4), 'us_per_line': round(elapsed / len(lines) * 1e6, 3), 'lines_per_sec': round(len(lines) / elapsed, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bar string parsers.')
+    parser.add_argument('--lines', help='Number of bar strings to parse. Default is 100000.', type=int, default=100000)
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.', type=str, default=None)
+    args = parser.parse_args()
+
+    lines = make_lines(args.lines)
+    results = {
+        'benchmark': 'bar_parser',
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'lines': args.lines,
+        'legacy_regex_eval': time_it(lambda lines: [legacy_bars_string_to_dict(line) for line in lines], lines),
+        'bars_string_to_dict': time_it(lambda lines: [bars_string_to_dict(line) for line in lines], lines),
+        'bars_strings_to_columns': time_it(bars_strings_to_columns, lines)
+    }
+    results['speedup_dict'] = round(results['legacy_regex_eval']['secs'] / results['bars_string_to_dict']['secs'], 2)
+    results['speedup_columns'] = round(results['legacy_regex_eval']['secs'] / results['bars_strings_to_columns']['secs'], 2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Benchmark the ingest pipeline: msgpack frames like Alpaca sends them are decoded and passed to the real
+handlers in main.py (bar_data_handler, updatebar_data_handler and trade_data_handler), whose writers
+flush into a pluggable sink instead of, or in addition to, the database.
+
+Latency is measured per message for each stage:
+    decode: msgpack unpacking and the alpaca model the client builds for the handler, or the record of
+            helpers/raw_stream.py with --client raw
+    metrics: counting the message
+    gap_detector: noting the time of a bar for the gap backfill
+    log: the handler's logging, what is left of the handler call after the other stages
+    bar_cache: the update of the in-memory bars
+    coalescer: remembering a bar, or holding and flushing a correction
+    convert: the conversion of the model to a database row
+    enqueue: handing the row to the writer
+    aggregate: building the rollups or the trade bars and queueing the finished ones
+    db_write: one flush of a batch to the sink
+    end_to_end: from the handler call until the batch with the message was written, for the rows the
+                handlers put; the rollups and trade bars are not counted
+A stage's time leaves out the stages it calls, e.g. the enqueue the coalescer flushes to.
+
+Usage:
+    python -m benchmarks.ingest_benchmark --symbols 500 --rate 5000 --duration 30 --sink null --output bench.json
+
+The results are printed as JSON, or written to --output, to compare them between releases.
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import platform
+import random
+import sys
+import time
+
+import msgpack
+from alpaca.data.live import StockDataStream
+
+import main as ingest
+import helpers.bar_writer
+import helpers.trade_writer
+from helpers.raw_stream import MESSAGE_TYPES
+from benchmarks.sinks import SINKS
+from benchmarks.stats import summarize
+from helpers.logger import set_console_log_level
+
+STAGES = ('decode', 'metrics', 'gap_detector', 'log', 'bar_cache', 'coalescer', 'convert', 'enqueue', 'aggregate', 'db_write', 'end_to_end')
+
+class StageTimer:
+    """
+    Collects the latency samples of every stage, by message kind.
+
+    drive() sets kind and started before every handler call.  The steps wrapped with wrap() add up their
+    time per stage while the handler runs, and end_message() turns the sums into one sample per stage.
+    """
+
+    def __init__(self):
+        self.samples = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.kind = None
+        self.started = None  # when the handler of the current message was called
+        self._message = collections.defaultdict(float)  # stage: secs for the current message
+        self._handler_secs = 0.0  # time of the wrapped steps called by the handler itself
+        self._stack = []  # [start, secs of the wrapped steps inside] of the steps running
+
+    def add(self, kind, stage, seconds) -> None:
+        self.samples[kind][stage].append(seconds)
+
+    def wrap(self, owner, name, stage) -> None:
+        """
+        Time owner.name, a function or a coroutine function, as stage.
+        """
+        function = getattr(owner, name)
+        if asyncio.iscoroutinefunction(function):
+            async def timed(*args, **kwargs):
+                self._stack.append([time.perf_counter(), 0.0])
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self._step_done(stage)
+        else:
+            def timed(*args, **kwargs):
+                self._stack.append([time.perf_counter(), 0.0])
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self._step_done(stage)
+        setattr(owner, name, timed)
+
+    def _step_done(self, stage) -> None:
+        start, inner = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self._message[stage] += elapsed - inner
+        if self._stack:
+            self._stack[-1][1] += elapsed
+        else:
+            self._handler_secs += elapsed
+
+    def end_message(self, handled) -> None:
+        """
+        Add the samples of the message whose handler took handled seconds, the rest of it is the logging.
+        """
+        for stage, seconds in self._message.items():
+            self.add(self.kind, stage, seconds)
+        self.add(self.kind, 'log', max(0.0, handled - self._handler_secs))
+        self._message.clear()
+        self._handler_secs = 0.0
+
+    def report(self) -> dict:
+        return {kind: {stage: summarize(stages[stage]) for stage in STAGES if stage in stages} for kind, stages in self.samples.items()}
+
+def instrument(writer, kind, module, convert_name, sink, timer) -> None:
+    """
+    Time the row conversion, the enqueue and the flushes of a writer, and send its batches to the sink.
+    """
+    timer.wrap(module, convert_name, 'convert')
+
+    # Writers flush in order, so the queued rows line up with the batches.  The rows of put() carry
+    # the kind and the handler start time of their message, the rows of put_row() carry None
+    started = collections.deque()
+    put = writer.put
+    async def tracked_put(*args, **kwargs):
+        started.append((timer.kind, timer.started))
+        await put(*args, **kwargs)
+    writer.put = tracked_put
+    timer.wrap(writer, 'put', 'enqueue')
+
+    put_row = getattr(writer, 'put_row', None)
+    if put_row is not None:
+        async def tracked_put_row(*args, **kwargs):
+            started.append(None)
+            await put_row(*args, **kwargs)
+        writer.put_row = tracked_put_row
+
+    async def timed_write(batch):
+        start = time.perf_counter()
+        await sink.write(writer, batch)
+        end = time.perf_counter()
+        timer.add(kind, 'db_write', end - start)
+        for _ in range(len(batch)):
+            if started:
+                message = started.popleft()
+                if message is not None:
+                    timer.add(message[0], 'end_to_end', end - message[1])
+    writer._write = timed_write
+
+    # The benchmark measures the sink, not the spool
+    writer._spool_dir = None
+
+def make_frames(symbols, count, frame_size, updated_ratio, trade_ratio, seed=1):
+    """
+    Returns msgpack frames holding count bar, updated bar and trade messages.
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 12, 10, 14, 30, tzinfo=datetime.timezone.utc)
+    frames = []
+    messages = []
+    for i in range(count):
+        symbol = symbols[i % len(symbols)]
+        minute = start + datetime.timedelta(minutes=i // len(symbols))
+        timestamp = msgpack.Timestamp.from_datetime(minute)
+        price = round(rng.uniform(10, 500), 2)
+        draw = rng.random()
+        if draw < trade_ratio:
+            message = {'T': 't', 'S': symbol, 'i': i, 'x': 'V', 'p': price, 's': rng.randint(1, 500),
+                       'c': ['@'], 'z': 'C', 't': msgpack.Timestamp.from_datetime(minute + datetime.timedelta(microseconds=i % 60000000))}
+        else:
+            message = {'T': 'u' if draw < trade_ratio + updated_ratio else 'b', 'S': symbol,
+                       'o': price, 'h': price + 0.5, 'l': price - 0.5, 'c': price + 0.1,
+                       'v': rng.randint(100, 100000), 't': timestamp, 'n': rng.randint(1, 500), 'vw': price + 0.05}
+        messages.append(message)
+        if len(messages) == frame_size:
+            frames.append(msgpack.packb(messages))
+            messages = []
+    if messages:
+        frames.append(msgpack.packb(messages))
+    return frames
+
+async def updated_bar_handler(data):
+    # Flush every correction at once so that its put is timed like the other handlers' puts
+    await ingest.updatebar_data_handler(data)
+    await ingest.update_coalescer.flush()
+
+async def drive(frames, rate, frame_size, timer, client_type='alpaca') -> int:
+    """
+    Decode the frames and call the handlers like the alpaca client, or RawDataStream, does, at rate messages per second.
+    """
+    if client_type == 'raw':
+        unpack_options = {'timestamp': 3}
+        cast = lambda message: MESSAGE_TYPES[message['T']][1](message)
+    else:
+        unpack_options = {}
+        cast = StockDataStream('benchmark', 'benchmark')._cast
+    handlers = {
+        'b': ('bar', ingest.bar_data_handler),
+        'u': ('updated_bar', updated_bar_handler),
+        't': ('trade', ingest.trade_data_handler),
+    }
+    loop = asyncio.get_running_loop()
+    frame_interval = frame_size / rate if rate else 0
+    next_frame = loop.time()
+    sent = 0
+    for frame in frames:
+        if frame_interval:
+            delay = next_frame - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_frame += frame_interval
+
+        start = time.perf_counter()
+        messages = msgpack.unpackb(frame, **unpack_options)
+        unpack_share = (time.perf_counter() - start) / len(messages)
+        for message in messages:
+            kind, handler = handlers[message['T']]
+            start = time.perf_counter()
+            data = cast(message)
+            decoded = time.perf_counter()
+            timer.add(kind, 'decode', unpack_share + decoded - start)
+
+            timer.kind = kind
+            timer.started = decoded
+            await handler(data)
+            timer.end_message(time.perf_counter() - decoded)
+            sent += 1
+        # Let the writers run when the frames come in faster than the rate
+        await asyncio.sleep(0)
+    return sent
+
+async def run_benchmark(args) -> dict:
+    sink = SINKS[args.sink]()
+    timer = StageTimer()
+    instrument(ingest.bar_writer, 'bar', helpers.bar_writer, 'bar_to_row', sink, timer)
+    instrument(ingest.trade_writer, 'trade', helpers.trade_writer, 'trade_to_row', sink, timer)
+    timer.wrap(ingest.metrics, 'count_message', 'metrics')
+    timer.wrap(ingest.gap_detector, 'observe', 'gap_detector')
+    timer.wrap(ingest.bar_cache, 'update', 'bar_cache')
+    for name in ('remember', 'add', 'flush'):
+        timer.wrap(ingest.update_coalescer, name, 'coalescer')
+    timer.wrap(ingest.bar_aggregator, 'add', 'aggregate')
+    timer.wrap(ingest.trade_bar_aggregator, 'add', 'aggregate')
+
+    symbols = [f"SYM{i:04d}" for i in range(args.symbols)]
+    count = int(args.rate * args.duration) if args.rate else args.count
+    frames = make_frames(symbols, count, args.frame_size, args.updated_ratio, args.trade_ratio)
+
+    writer_tasks = [asyncio.create_task(ingest.bar_writer.run()), asyncio.create_task(ingest.trade_writer.run())]
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    sent = await drive(frames, args.rate, args.frame_size, timer, args.client)
+    handled = time.perf_counter() - start
+
+    for task in writer_tasks:
+        task.cancel()
+    await asyncio.gather(*writer_tasks, return_exceptions=True)
+    written = time.perf_counter() - start
+    sink.close()
+
+    stages = timer.report()
+    return {
+        'benchmark': 'ingest',
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'messages': sent,
+        'handler_secs': round(handled, 4),
+        'total_secs': round(written, 4),
+        'handler_msgs_per_sec': round(sent / handled, 1),
+        'msgs_per_sec': round(sent / written, 1),
+        'stages': stages
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ingest handlers and writers.')
+    parser.add_argument('--symbols', help='Number of symbols. Default is 100.', type=int, default=100)
+    parser.add_argument('--rate', help='Messages per second, 0 for as fast as possible. Default is 0.', type=float, default=0)
+    parser.add_argument('--duration', help='Seconds to run when a rate is set. Default is 10.', type=float, default=10)
+    parser.add_argument('--count', help='Messages to send when no rate is set. Default is 50000.', type=int, default=50000)
+    parser.add_argument('--frame-size', help='Messages per websocket frame. Default is 10.', type=int, default=10)
+    parser.add_argument('--updated-ratio', help='Share of updated bars. Default is 0.05.', type=float, default=0.05)
+    parser.add_argument('--trade-ratio', help='Share of trades. Default is 0.', type=float, default=0.0)
+    parser.add_argument('--client', help='Decode like the alpaca-py clients or like helpers/raw_stream.py. Default is alpaca.', choices=('alpaca', 'raw'), default='alpaca')
+    parser.add_argument('--sink', help='Where the writers flush to: null, file or postgres. Default is null.', choices=sorted(SINKS), default='null')
+    parser.add_argument('--console-log', help='Keep the console logging of the handlers on.', action='store_true')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.', type=str, default=None)
+    args = parser.parse_args()
+
+    if not args.console_log:
+        set_console_log_level('WARNING')
+
+    results = asyncio.run(run_benchmark(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
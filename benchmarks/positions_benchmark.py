@@ -0,0 +1,157 @@
+"""
+Compare the open positions query over all orders with the lookup in the positions table.
+
+A scratch schema, bench_positions by default, gets a synthetic orders table with --orders rows over
+--symbols symbols and a positions table computed by backfill_positions().  Both queries run --repeat
+times for us_equity and crypto and must return the same symbols.  The insert cost of the trigger in
+data/db_positions.sql is measured with --trigger-orders new orders, with and without it.
+
+Usage:
+    python -m benchmarks.positions_benchmark --orders 1000000 --symbols 5000 --output positions.json
+
+Needs the database from the .env file.  The schema is dropped at the end unless --keep is given.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+from psycopg import sql
+
+from benchmarks.stats import summarize
+from helpers.database import connect_to_db, open_positions_query, backfill_positions
+
+CREATE_TABLES = """
+CREATE TABLE {schema}.orders (
+    id bigserial PRIMARY KEY,
+    symbol text,
+    asset_class text,
+    qty text,
+    side text
+);
+CREATE TABLE {schema}.positions (
+    asset_class text NOT NULL,
+    symbol text NOT NULL,
+    qty numeric NOT NULL DEFAULT 0,
+    updated_at timestamp with time zone DEFAULT NOW(),
+    PRIMARY KEY (asset_class, symbol)
+);
+CREATE INDEX ON {schema}.positions USING btree (asset_class, symbol) WHERE qty > 0;
+"""
+
+# One in ten symbols is crypto, sells are a third of the orders so most symbols stay open
+FILL_ORDERS = """
+INSERT INTO {schema}.orders (symbol, asset_class, qty, side)
+SELECT 'SYM' || (i %% %(symbols)s),
+       CASE WHEN i %% %(symbols)s %% 10 = 0 THEN 'crypto' ELSE 'us_equity' END,
+       (1 + i %% 7)::text,
+       CASE WHEN i %% 3 = 0 THEN 'sell' ELSE 'buy' END
+FROM generate_series(1, %(orders)s) AS i
+"""
+
+# The same function as in data/db_positions.sql, on the scratch positions table
+CREATE_TRIGGER = """
+CREATE FUNCTION {schema}.update_positions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO {positions} (asset_class, symbol, qty)
+        VALUES (NEW.asset_class, NEW.symbol,
+                CASE NEW.side WHEN 'buy' THEN COALESCE(NEW.qty::numeric, 0) WHEN 'sell' THEN -COALESCE(NEW.qty::numeric, 0) ELSE 0 END)
+    ON CONFLICT (asset_class, symbol) DO UPDATE SET qty = positions.qty + EXCLUDED.qty, updated_at = NOW();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER update_positions AFTER INSERT ON {orders} FOR EACH ROW EXECUTE FUNCTION {schema}.update_positions();
+"""
+
+def time_query(connection, query, asset_class, repeat) -> tuple:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = connection.execute(query, (asset_class,)).fetchall()
+        samples.append(time.perf_counter() - start)
+    return sorted(row[0] for row in rows), summarize(samples)
+
+def time_inserts(connection, schema, count) -> float:
+    start = time.perf_counter()
+    with connection.transaction():
+        connection.execute(sql.SQL(FILL_ORDERS).format(schema=schema), {'symbols': 1000, 'orders': count})
+    return time.perf_counter() - start
+
+def run_benchmark(args) -> dict:
+    schema = sql.Identifier(args.schema)
+    results = {
+        'benchmark': 'positions',
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'config': vars(args),
+    }
+    connection = connect_to_db()
+    connection.autocommit = True
+    try:
+        with connection.transaction():
+            connection.execute(sql.SQL("DROP SCHEMA IF EXISTS {schema} CASCADE").format(schema=schema))
+            connection.execute(sql.SQL("CREATE SCHEMA {schema}").format(schema=schema))
+            connection.execute(sql.SQL(CREATE_TABLES).format(schema=schema))
+
+        start = time.perf_counter()
+        with connection.transaction():
+            connection.execute(sql.SQL(FILL_ORDERS).format(schema=schema), {'symbols': args.symbols, 'orders': args.orders})
+            connection.execute(sql.SQL("ANALYZE {schema}.orders").format(schema=schema))
+        results['fill_secs'] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        results['positions'] = backfill_positions(connection, schema=args.schema)
+        results['backfill_secs'] = round(time.perf_counter() - start, 3)
+        with connection.transaction():
+            connection.execute(sql.SQL("ANALYZE {schema}.positions").format(schema=schema))
+
+        for asset_class in ('us_equity', 'crypto'):
+            old_symbols, old = time_query(connection, open_positions_query(from_orders=True, schema=args.schema), asset_class, args.repeat)
+            new_symbols, new = time_query(connection, open_positions_query(schema=args.schema), asset_class, args.repeat)
+            if old_symbols != new_symbols:
+                raise AssertionError(f"The {asset_class} positions differ from the orders: {len(old_symbols)} vs {len(new_symbols)} symbols")
+            results[asset_class] = {'symbols': len(new_symbols), 'orders_query': old, 'positions_query': new,
+                                    'speedup': round(old['mean_us'] / new['mean_us'], 1)}
+
+        # The cost of keeping the positions up to date on insert
+        plain = time_inserts(connection, schema, args.trigger_orders)
+        with connection.transaction():
+            orders = sql.Identifier(args.schema, 'orders')
+            positions = sql.Identifier(args.schema, 'positions')
+            connection.execute(sql.SQL(CREATE_TRIGGER).format(schema=schema, orders=orders, positions=positions))
+        triggered = time_inserts(connection, schema, args.trigger_orders)
+        results['insert_us_per_order'] = {
+            'without_trigger': round(plain / args.trigger_orders * 1e6, 3),
+            'with_trigger': round(triggered / args.trigger_orders * 1e6, 3),
+        }
+    finally:
+        if not args.keep:
+            with connection.transaction():
+                connection.execute(sql.SQL("DROP SCHEMA IF EXISTS {schema} CASCADE").format(schema=schema))
+        connection.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the open positions queries.')
+    parser.add_argument('--orders', help='Number of synthetic orders. Default is 1000000.', type=int, default=1000000)
+    parser.add_argument('--symbols', help='Number of symbols. Default is 5000.', type=int, default=5000)
+    parser.add_argument('--repeat', help='Runs of each query. Default is 20.', type=int, default=20)
+    parser.add_argument('--trigger-orders', help='Orders inserted to time the trigger. Default is 10000.', type=int, default=10000)
+    parser.add_argument('--schema', help='Scratch schema for the tables. Default is bench_positions.', type=str, default='bench_positions')
+    parser.add_argument('--keep', help='Keep the scratch schema.', action='store_true')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.', type=str, default=None)
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Sinks for the ingest benchmark.  A sink receives every batch a writer flushes in place of the database.
+"""
+
+import datetime
+import json
+
+from helpers.batch_writer import BatchWriter
+
+class NullSink:
+    """
+    Drops the batches, measures the pipeline without any database cost.
+    """
+
+    name = 'null'
+
+    async def write(self, writer, batch) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class FileSink:
+    """
+    Appends the rows to a JSON lines file.
+    """
+
+    name = 'file'
+
+    def __init__(self, path='bench_rows.jsonl'):
+        self.path = path
+        self._file = open(path, 'w')
+
+    async def write(self, writer, batch) -> None:
+        def default(value):
+            if isinstance(value, datetime.datetime):
+                return value.isoformat()
+            raise TypeError(f'Cannot write a {type(value)}')
+        self._file.writelines(json.dumps([writer.name, row], default=default) + '\n' for row in batch)
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+class PostgresSink:
+    """
+    Writes to the database configured in .env, the same way the writers do in production.
+    Point it at a local database, the benchmark adds rows to stock_bars and stock_trades_real_time.
+    """
+
+    name = 'postgres'
+
+    async def write(self, writer, batch) -> None:
+        await BatchWriter._write(writer, batch)
+
+    def close(self) -> None:
+        pass
+
+SINKS = {
+    'null': NullSink,
+    'file': FileSink,
+    'postgres': PostgresSink
+}
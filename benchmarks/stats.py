@@ -0,0 +1,24 @@
+import math
+
+def percentile(sorted_samples, fraction):
+    # Nearest rank percentile of an already sorted list
+    if not sorted_samples:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_samples)) - 1, 0)
+    return sorted_samples[rank]
+
+def summarize(samples) -> dict:
+    """
+    Summarize latency samples given in seconds.  The results are in microseconds.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'mean_us': round(sum(ordered) / len(ordered) * 1e6, 3),
+        'p50_us': round(percentile(ordered, 0.50) * 1e6, 3),
+        'p99_us': round(percentile(ordered, 0.99) * 1e6, 3),
+        'p999_us': round(percentile(ordered, 0.999) * 1e6, 3),
+        'max_us': round(ordered[-1] * 1e6, 3)
+    }
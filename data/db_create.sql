@@ -24,7 +24,6 @@ CREATE TABLE IF NOT EXISTS public.stock_bars (
 
 -- Create a hypertable for stock_bars
 SELECT create_hypertable('stock_bars', 'time', if_not_exists => TRUE);
-CREATE TRIGGER ts_cagg_invalidation_trigger AFTER INSERT OR DELETE OR UPDATE ON public.stock_bars FOR EACH ROW EXECUTE FUNCTION _timescaledb_functions.continuous_agg_invalidation_trigger('1');
 DROP TRIGGER IF EXISTS ts_insert_blocker ON public.stock_bars;
 CREATE TRIGGER ts_insert_blocker BEFORE INSERT ON public.stock_bars FOR EACH ROW EXECUTE FUNCTION _timescaledb_functions.insert_blocker();
 
@@ -254,6 +253,15 @@ CREATE INDEX fki_portfolio_id_fk ON public.orders USING btree (portfolio_id);
 CREATE INDEX ix_symbol_time ON public.stock_bars USING btree (symbol, "time" DESC);
 
 
+--
+-- Name: stock_bars stock_bars_symbol_time_interval_key; Type: CONSTRAINT; Schema: public; Owner: postgres
+-- One row per bar.  Used by INSERT ... ON CONFLICT to upsert corrected bars and ignore replayed ones.
+--
+
+ALTER TABLE public.stock_bars
+    ADD CONSTRAINT stock_bars_symbol_time_interval_key UNIQUE (symbol, "time", "interval");
+
+
 --
 -- TOC entry 5196 (class 1259 OID 32941)
 -- Name: ix_symbol_time_2; Type: INDEX; Schema: public; Owner: postgres
@@ -1,13 +1,14 @@
---- MATERIALIZED VIEW stock_bars_5min creation
-CREATE MATERIALIZED VIEW stock_bars_5min WITH (timescaledb.continuous) AS
+--- VIEW stock_bars_5min creation
+--- The ingest process writes the 5 min bars to stock_bars with "interval" = 5 (see helpers/bar_aggregator.py),
+--- so nothing is recomputed; the view keeps the columns of the continuous aggregate it replaced
+CREATE OR REPLACE VIEW stock_bars_5min AS
     SELECT
-        time_bucket('5 minutes', time) AS bucket,
+        time AS bucket,
         symbol,
-        first(open, time) AS open,
-        max(high) AS high,
-        min(low) AS low,
-        last(close, time) AS close,
-        sum(volume) AS volume
+        open,
+        high,
+        low,
+        close,
+        volume
 FROM stock_bars
-GROUP BY bucket, symbol;
-
+WHERE "interval" = 5;
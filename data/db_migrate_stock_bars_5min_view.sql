@@ -0,0 +1,46 @@
+--
+-- Replace the stock_bars_5min continuous aggregate of an existing database with the view of db_create2.sql.
+--
+-- The ingest process writes its own 5 min, 15 min, 1 hour and 1 day rollups to stock_bars with "interval"
+-- set to the minutes of the bar (see helpers/bar_aggregator.py), so the aggregate and its refresh policy,
+-- which recomputed the last day every 5 minutes, are no longer needed.  Without a continuous aggregate the
+-- invalidation trigger no longer fires for every row written to stock_bars.
+--
+-- The buckets the aggregate materialized are copied to stock_bars first, so that the view keeps the 5 min
+-- bars of the days before the ingest process wrote its own.  Needs the unique constraint of
+-- db_migrate_stock_bars_unique.sql.  Run it with the ingest process stopped.
+--
+
+BEGIN;
+
+SELECT remove_continuous_aggregate_policy('stock_bars_5min', if_exists => true);
+
+INSERT INTO public.stock_bars ("time", symbol, open, high, low, close, volume, "interval")
+    SELECT bucket, symbol, open, high, low, close, volume::integer, 5
+    FROM stock_bars_5min
+    WHERE bucket + INTERVAL '5 minutes' <= now()
+ON CONFLICT DO NOTHING;
+
+DROP MATERIALIZED VIEW IF EXISTS stock_bars_5min;
+
+-- Left behind by db_create.sql, unless another continuous aggregate still needs it
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM timescaledb_information.continuous_aggregates WHERE hypertable_name = 'stock_bars') THEN
+        DROP TRIGGER IF EXISTS ts_cagg_invalidation_trigger ON public.stock_bars;
+    END IF;
+END $$;
+
+CREATE VIEW stock_bars_5min AS
+    SELECT
+        time AS bucket,
+        symbol,
+        open,
+        high,
+        low,
+        close,
+        volume
+FROM stock_bars
+WHERE "interval" = 5;
+
+COMMIT;
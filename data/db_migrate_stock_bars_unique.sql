@@ -0,0 +1,21 @@
+--
+-- Add the (symbol, time, interval) unique constraint to an existing stock_bars table.
+-- New databases get it from db_create.sql.
+--
+-- Bars that were inserted more than once are removed first so that only one row per bar is kept.
+-- Rows with the same time are in the same chunk, so comparing ctid is enough to pick one.
+--
+
+BEGIN;
+
+DELETE FROM public.stock_bars a
+    USING public.stock_bars b
+WHERE a.symbol = b.symbol
+    AND a."time" = b."time"
+    AND a."interval" = b."interval"
+    AND a.ctid < b.ctid;
+
+ALTER TABLE public.stock_bars
+    ADD CONSTRAINT stock_bars_symbol_time_interval_key UNIQUE (symbol, "time", "interval");
+
+COMMIT;
@@ -0,0 +1,60 @@
+--
+-- Open quantity per symbol, kept up to date from orders by a trigger.
+-- Run on new and existing databases, the file can be run again.  Existing orders are summed once with
+--     python main.py --backfill-positions
+--
+-- qty is the bought minus the sold quantity of all orders of the symbol, like the query over orders that
+-- get_stocks_to_track and get_crypto_to_track used before.  asset_class is the one of the orders,
+-- 'us_equity' or 'crypto'.
+--
+
+CREATE TABLE IF NOT EXISTS public.positions (
+    asset_class text NOT NULL,
+    symbol text NOT NULL,
+    qty numeric NOT NULL DEFAULT 0,
+    updated_at timestamp with time zone DEFAULT NOW(),
+    PRIMARY KEY (asset_class, symbol)
+);
+
+-- The watchlist queries only read the open positions
+CREATE INDEX IF NOT EXISTS positions_open_idx ON public.positions USING btree (asset_class, symbol) WHERE qty > 0;
+
+-- Signed quantity of an order, NULL quantities count as 0 like they do in SUM()
+CREATE OR REPLACE FUNCTION public.order_position_qty(side text, qty text)
+RETURNS numeric AS $$
+    SELECT CASE side
+        WHEN 'buy' THEN COALESCE(qty::numeric, 0)
+        WHEN 'sell' THEN -COALESCE(qty::numeric, 0)
+        ELSE 0
+    END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Take the old version of the order out of its position and add the new one
+CREATE OR REPLACE FUNCTION public.update_positions()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.symbol IS NOT NULL AND OLD.asset_class IS NOT NULL THEN
+        INSERT INTO public.positions (asset_class, symbol, qty)
+            VALUES (OLD.asset_class, OLD.symbol, -public.order_position_qty(OLD.side, OLD.qty))
+        ON CONFLICT (asset_class, symbol) DO UPDATE
+            SET qty = positions.qty + EXCLUDED.qty, updated_at = NOW();
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') AND NEW.symbol IS NOT NULL AND NEW.asset_class IS NOT NULL THEN
+        INSERT INTO public.positions (asset_class, symbol, qty)
+            VALUES (NEW.asset_class, NEW.symbol, public.order_position_qty(NEW.side, NEW.qty))
+        ON CONFLICT (asset_class, symbol) DO UPDATE
+            SET qty = positions.qty + EXCLUDED.qty, updated_at = NOW();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS update_positions ON public.orders;
+CREATE TRIGGER update_positions AFTER INSERT OR DELETE ON public.orders
+    FOR EACH ROW EXECUTE FUNCTION public.update_positions();
+DROP TRIGGER IF EXISTS update_positions_update ON public.orders;
+CREATE TRIGGER update_positions_update AFTER UPDATE OF symbol, asset_class, qty, side ON public.orders
+    FOR EACH ROW
+    WHEN (OLD.symbol IS DISTINCT FROM NEW.symbol OR OLD.asset_class IS DISTINCT FROM NEW.asset_class
+          OR OLD.qty IS DISTINCT FROM NEW.qty OR OLD.side IS DISTINCT FROM NEW.side)
+    EXECUTE FUNCTION public.update_positions();
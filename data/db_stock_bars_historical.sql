@@ -0,0 +1,36 @@
+--
+-- Historical bars loaded by python -m helpers.historical_loader, and the days it has loaded.
+-- Run on new and existing databases, the file can be run again.
+--
+-- stock_bars_historical has the (timestamp, symbol, interval) constraint of data/useful_queries.sql.
+-- volume is a double precision because crypto volumes are fractional.
+--
+
+CREATE TABLE IF NOT EXISTS public.stock_bars_historical (
+    "timestamp" timestamp with time zone NOT NULL,
+    symbol text NOT NULL,
+    open double precision,
+    high double precision,
+    low double precision,
+    close double precision,
+    volume double precision,
+    trade_count integer,
+    vwap double precision,
+    "interval" integer NOT NULL,
+    CONSTRAINT unique_time_symbol_interval UNIQUE ("timestamp", symbol, "interval")
+);
+
+SELECT create_hypertable('stock_bars_historical', 'timestamp', if_not_exists => TRUE);
+
+CREATE INDEX IF NOT EXISTS stock_bars_historical_symbol_time_idx ON public.stock_bars_historical USING btree (symbol, "timestamp" DESC);
+
+-- One row per symbol, UTC day and interval that is completely loaded, written in the same transaction
+-- as its bars.  Days without bars are recorded too, with rows = 0.
+CREATE TABLE IF NOT EXISTS public.historical_load_checkpoints (
+    symbol text NOT NULL,
+    day date NOT NULL,
+    "interval" integer NOT NULL,
+    rows integer NOT NULL,
+    loaded_at timestamp with time zone DEFAULT NOW(),
+    PRIMARY KEY (symbol, day, "interval")
+);
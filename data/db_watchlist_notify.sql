@@ -0,0 +1,67 @@
+--
+-- Notify the ingest process when the symbols to track may have changed.
+-- Run on new and existing databases, the file can be run again.
+--
+-- The payload of the notifications on the watchlist_changed channel is the asset whose watchlist
+-- changed: 'stock', 'crypto' or 'all'.  Notifications with the same payload in one transaction are
+-- delivered once, on commit.  See helpers/watchlist_listener.py.
+--
+
+-- The asset of an orders or stock_targets row
+CREATE OR REPLACE FUNCTION public.watchlist_asset(table_name text, row_data jsonb)
+RETURNS text AS $$
+    SELECT CASE
+        WHEN table_name = 'orders' AND row_data->>'asset_class' = 'crypto' THEN 'crypto'
+        WHEN table_name = 'stock_targets' AND row_data->>'type' = 'crypto' THEN 'crypto'
+        ELSE 'stock'
+    END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- The payload is the asset of the changed row, any portfolio change can affect both
+CREATE OR REPLACE FUNCTION public.notify_watchlist_changed()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'portfolio_configs' THEN
+        PERFORM pg_notify('watchlist_changed', 'all');
+        RETURN NULL;
+    END IF;
+    -- A row that moved from stock to crypto changes both watchlists
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('watchlist_changed', public.watchlist_asset(TG_TABLE_NAME, to_jsonb(OLD)));
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') THEN
+        PERFORM pg_notify('watchlist_changed', public.watchlist_asset(TG_TABLE_NAME, to_jsonb(NEW)));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only the columns the watchlist queries read, last_modified is updated on every change
+DROP TRIGGER IF EXISTS notify_watchlist_changed ON public.stock_targets;
+CREATE TRIGGER notify_watchlist_changed AFTER INSERT OR DELETE ON public.stock_targets
+    FOR EACH ROW EXECUTE FUNCTION public.notify_watchlist_changed();
+DROP TRIGGER IF EXISTS notify_watchlist_changed_update ON public.stock_targets;
+CREATE TRIGGER notify_watchlist_changed_update AFTER UPDATE OF symbol, weight, portfolio_id, type ON public.stock_targets
+    FOR EACH ROW
+    WHEN (OLD.symbol IS DISTINCT FROM NEW.symbol OR OLD.weight IS DISTINCT FROM NEW.weight
+          OR OLD.portfolio_id IS DISTINCT FROM NEW.portfolio_id OR OLD.type IS DISTINCT FROM NEW.type)
+    EXECUTE FUNCTION public.notify_watchlist_changed();
+
+DROP TRIGGER IF EXISTS notify_watchlist_changed ON public.portfolio_configs;
+CREATE TRIGGER notify_watchlist_changed AFTER INSERT OR DELETE ON public.portfolio_configs
+    FOR EACH ROW EXECUTE FUNCTION public.notify_watchlist_changed();
+DROP TRIGGER IF EXISTS notify_watchlist_changed_update ON public.portfolio_configs;
+CREATE TRIGGER notify_watchlist_changed_update AFTER UPDATE OF active ON public.portfolio_configs
+    FOR EACH ROW
+    WHEN (OLD.active IS DISTINCT FROM NEW.active)
+    EXECUTE FUNCTION public.notify_watchlist_changed();
+
+DROP TRIGGER IF EXISTS notify_watchlist_changed ON public.orders;
+CREATE TRIGGER notify_watchlist_changed AFTER INSERT OR DELETE ON public.orders
+    FOR EACH ROW EXECUTE FUNCTION public.notify_watchlist_changed();
+DROP TRIGGER IF EXISTS notify_watchlist_changed_update ON public.orders;
+CREATE TRIGGER notify_watchlist_changed_update AFTER UPDATE OF symbol, asset_class, qty, side ON public.orders
+    FOR EACH ROW
+    WHEN (OLD.symbol IS DISTINCT FROM NEW.symbol OR OLD.asset_class IS DISTINCT FROM NEW.asset_class
+          OR OLD.qty IS DISTINCT FROM NEW.qty OR OLD.side IS DISTINCT FROM NEW.side)
+    EXECUTE FUNCTION public.notify_watchlist_changed();
@@ -10,17 +10,11 @@ return a dictionary of the data
 """
 
 import requests
-import os
-from dotenv import load_dotenv
 
-load_dotenv()
+from helpers.env import API_KEY, API_SECRET
 
 def get_crypto_data():
     url = 'https://paper-api.alpaca.markets/v2/assets?asset_class=crypto'
-    # Alpaca API key ID and secret
-    API_KEY = os.getenv("MS_ALPACA_API_KEY")
-    API_SECRET = os.getenv("MS_ALPACA_API_SECRET")
-
     headers = {
         'Apca-Api-Key-Id': API_KEY,
         'Apca-Api-Secret-Key': API_SECRET
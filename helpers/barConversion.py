@@ -1,36 +1,142 @@
 import re
-from alpaca.data.models.bars import Bar
+from array import array
+from datetime import datetime, timedelta, timezone
+
+# A printed bar looks like this:
+#   symbol='AAPL' timestamp=datetime.datetime(2024, 9, 23, 19, 59, tzinfo=datetime.timezone.utc) open=226.375 high=226.63 low=226.3 close=226.49 volume=15052.0 trade_count=208.0 vwap=226.463702
+# The timestamp is parsed from its digits, nothing in the string is evaluated.  Its tzinfo is UTC, a
+# TzInfo of pydantic or a fixed offset like datetime.timezone(datetime.timedelta(days=-1, seconds=68400)).
+_TIMEDELTA = r"datetime\.timedelta\((?:0|(?:days|seconds|microseconds)=-?\d+(?:, (?:seconds|microseconds)=\d+)*)\)"
+_DATETIME = (
+    r"datetime\.datetime\((?P<args>\d+(?:, \d+){2,6})(?:, tzinfo=(?P<tz>datetime\.timezone\.utc|TzInfo\((?:UTC|[+-]?\d+)\)"
+    r"|datetime\.timezone\(" + _TIMEDELTA + r"(?:, '[^']*')?\)))?\)"
+)
+_DATETIME_PATTERN = re.compile(_DATETIME)
+
+# The usual field order, matched in one pass
+_BAR_PATTERN = re.compile(
+    r"symbol='(?P<symbol>[^']*)' timestamp=" + _DATETIME +
+    r" open=(?P<open>\S+) high=(?P<high>\S+) low=(?P<low>\S+) close=(?P<close>\S+)"
+    r" volume=(?P<volume>\S+) trade_count=(?P<trade_count>\S+) vwap=(?P<vwap>\S+)"
+)
+
+# Any other order, one key=value pair at a time.  A datetime holds up to three levels of parentheses.
+_PAIR_PATTERN = re.compile(r"(\w+)=('[^']*'|datetime\.datetime\((?:[^()]|\((?:[^()]|\((?:[^()]|\([^()]*\))*\))*\))*\)|\S+)")
+_TIMEDELTA_ARG_PATTERN = re.compile(r"(days|seconds|microseconds)=(-?\d+)")
+
+NUMBER_KEYS = ('open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap')
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_NAN = float('nan')
+
+def _to_number(value: str):
+    return None if value == 'None' else float(value)
+
+def _to_datetime(args: str, tz: str) -> datetime:
+    if tz is None or tz in ('datetime.timezone.utc', 'TzInfo(UTC)'):
+        tzinfo = timezone.utc
+    elif tz.startswith('TzInfo('):
+        tzinfo = timezone(timedelta(seconds=int(tz[len('TzInfo('):-1])))
+    else:
+        delta = {key: int(value) for key, value in _TIMEDELTA_ARG_PATTERN.findall(tz)}
+        tzinfo = timezone(timedelta(**delta))
+    return datetime(*map(int, args.split(', ')), tzinfo=tzinfo)
+
+def _parse_timestamp(value: str) -> datetime:
+    match = _DATETIME_PATTERN.fullmatch(value)
+    if match is None:
+        raise ValueError(f'Unsupported timestamp: {value}')
+    return _to_datetime(match['args'], match['tz'])
 
 def bars_string_to_BarClass(data):
+    # alpaca.data imports pandas, so it is imported when a string is converted rather than at startup
+    from alpaca.data.models.bars import Bar
+
     # Convert the string to a dictionary
     result_dict = bars_string_to_dict(data)
     # Create an instance of the Bar class
     bar = Bar(
-        t=result_dict['timestamp'],
-        o=result_dict['open'],
-        h=result_dict['high'],
-        l=result_dict['low'],
-        c=result_dict['close'],
-        v=result_dict['volume'],
-        n=result_dict['trade_count'],
-        vw=result_dict['vwap']
+        result_dict['symbol'],
+        {
+            't': result_dict['timestamp'],
+            'o': result_dict['open'],
+            'h': result_dict['high'],
+            'l': result_dict['low'],
+            'c': result_dict['close'],
+            'v': result_dict['volume'],
+            'n': result_dict['trade_count'],
+            'vw': result_dict['vwap']
+        }
     )
     return bar
 
 def bars_string_to_dict(data):
+    """
+    Convert a printed bar to a dictionary with the keys symbol, timestamp, open, high, low, close, volume, trade_count and vwap.
+    The timestamp becomes a datetime and the numbers floats, None if the bar has none.
 
-    # Regular expression to match key-value pairs
-    pattern = r"(\w+)=('[^']*'|datetime\.datetime\([^\)]*\)|[^ ]+)"
-
-    # Find all matches
-    matches = re.findall(pattern, data)
+    Raises a ValueError if the string is not a bar.
+    """
+    match = _BAR_PATTERN.fullmatch(data.strip())
+    if match is not None:
+        result_dict = {key: _to_number(match[key]) for key in NUMBER_KEYS}
+        result_dict['symbol'] = match['symbol']
+        result_dict['timestamp'] = _to_datetime(match['args'], match['tz'])
+        return result_dict
 
-    # Convert matches to dictionary
+    # The fields are in another order
     result_dict = {}
-    for key, value in matches:
+    for key, value in _PAIR_PATTERN.findall(data):
         if key == 'timestamp':
-            # Evaluate the timestamp string to convert it to a datetime object
-            value = eval(value)
+            value = _parse_timestamp(value)
+        elif key in NUMBER_KEYS:
+            value = _to_number(value)
+        elif value.startswith("'"):
+            value = value[1:-1]
         result_dict[key] = value
-    
-    return result_dict
\ No newline at end of file
+
+    missing_keys = [key for key in ('symbol', 'timestamp') + NUMBER_KEYS if key not in result_dict]
+    if missing_keys:
+        raise ValueError(f'Not a bar string, missing {missing_keys}: {data}')
+    return result_dict
+
+def bars_strings_to_columns(lines) -> dict:
+    """
+    Parse many printed bars, one per line, into columns.
+
+    INPUTS:
+        lines: iterable of str - e.g. an open file of BAR_1MIN strings.
+    Returns:
+        dict with the keys
+            symbol: list of str
+            time: array('q') of microseconds since 1970-01-01 UTC
+            open, high, low, close, volume, trade_count, vwap: array('d'), nan where the bar has None
+    Blank lines are skipped, a line that is not a bar raises a ValueError.
+    """
+    symbols = []
+    times = array('q')
+    numbers = {key: array('d') for key in NUMBER_KEYS}
+    appends = [(numbers[key].append, key) for key in NUMBER_KEYS]
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        match = _BAR_PATTERN.fullmatch(line)
+        if match is not None:
+            symbols.append(match['symbol'])
+            timestamp = _to_datetime(match['args'], match['tz'])
+            for append, key in appends:
+                value = match[key]
+                append(_NAN if value == 'None' else float(value))
+        else:
+            result_dict = bars_string_to_dict(line)
+            symbols.append(result_dict['symbol'])
+            timestamp = result_dict['timestamp']
+            for append, key in appends:
+                value = result_dict[key]
+                append(_NAN if value is None else value)
+        times.append((timestamp - _EPOCH) // timedelta(microseconds=1))
+
+    columns = {'symbol': symbols, 'time': times}
+    columns.update(numbers)
+    return columns
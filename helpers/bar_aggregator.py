@@ -0,0 +1,199 @@
+"""
+Roll the 1 min bars up into 5 min, 15 min, 1 hour and 1 day bars as they arrive.
+
+Every interval keeps a running bucket per symbol that a new bar updates in constant time.  A bucket is
+finished when its last minute arrives, when a bar of a later bucket arrives, or CLOSE_DELAY_SEC after it
+ended, and is then written to stock_bars with interval set to its length in minutes.  Buckets are aligned
+to the epoch in UTC, like time_bucket() in the database.
+
+The 1 min bars of the last day are kept so that a corrected bar can recompute its bucket, the bucket is
+written again as an update if it was finished already.  Buckets that started before the aggregator did
+miss bars and are not written.
+"""
+
+import asyncio
+import datetime
+import threading
+import time
+
+from helpers.logger import logger
+from resources.constants import BAR_AGGREGATOR
+
+class Bucket:
+    __slots__ = ('start', 'end', 'open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap_volume', 'first', 'last')
+
+    def __init__(self, start, end, minute, values):
+        self.start = start
+        self.end = end
+        open, high, low, close, volume, trade_count, vwap = values
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.trade_count = trade_count or 0
+        self.vwap_volume = (vwap if vwap is not None else close) * volume
+        self.first = minute
+        self.last = minute
+
+    def add(self, minute, values) -> None:
+        open, high, low, close, volume, trade_count, vwap = values
+        if minute < self.first:
+            self.open = open
+            self.first = minute
+        if minute > self.last:
+            self.close = close
+            self.last = minute
+        if high > self.high:
+            self.high = high
+        if low < self.low:
+            self.low = low
+        self.volume += volume
+        self.trade_count += trade_count or 0
+        self.vwap_volume += (vwap if vwap is not None else close) * volume
+
+    def to_row(self, symbol, interval) -> tuple:
+        vwap = self.vwap_volume / self.volume if self.volume else None
+        timestamp = datetime.datetime.fromtimestamp(self.start, tz=datetime.timezone.utc)
+        return (timestamp, symbol, self.open, self.high, self.low, self.close, self.volume, self.trade_count, vwap, interval)
+
+class _SymbolState:
+    __slots__ = ('minutes', 'kept_since', 'open_buckets', 'closed_until')
+
+    def __init__(self):
+        self.minutes = {}        # epoch seconds of the minute: (open, high, low, close, volume, trade_count, vwap)
+        self.kept_since = 0      # older minutes have been forgotten
+        self.open_buckets = {}   # interval: Bucket
+        self.closed_until = {}   # interval: end of the last finished bucket
+
+class BarAggregator:
+    """
+    Aggregates the 1 min bars of the handlers and writes the rollups with writer.put_row().
+
+    INPUTS:
+        writer: BarWriter - Where the finished rollups are queued.
+        intervals: tuple of int - Rollup lengths in minutes.
+        close_delay: float - Seconds after the end of a bucket before it is written without its last minute.
+    add() can be called from the threads of both clients, run() runs on the writer's loop.
+    """
+
+    def __init__(self, writer, intervals=BAR_AGGREGATOR['INTERVALS'], close_delay=BAR_AGGREGATOR['CLOSE_DELAY_SEC'], check_frequency=BAR_AGGREGATOR['CHECK_FREQUENCY_SEC']):
+        self.writer = writer
+        self.intervals = tuple(sorted(intervals))
+        self.close_delay = close_delay
+        self.check_frequency = check_frequency
+        self.started = time.time()
+        self.rollups_written = 0
+        self.rollups_corrected = 0
+        self._symbols = {}
+        self._lock = threading.Lock()
+
+    async def add(self, data, update=False) -> None:
+        """
+        Add a 1 min bar, or replace it when update is True, and write the rollups it finishes or corrects.
+        """
+        minute = int(data.timestamp.timestamp())
+        values = (data.open, data.high, data.low, data.close, data.volume, data.trade_count, data.vwap)
+        with self._lock:
+            rows = self._add(data.symbol, minute, values)
+        await self._write(rows)
+
+    def _add(self, symbol, minute, values) -> list:
+        state = self._symbols.get(symbol)
+        if state is None:
+            state = self._symbols[symbol] = _SymbolState()
+        replaced = minute in state.minutes
+        state.minutes[minute] = values
+
+        rows = []
+        for interval in self.intervals:
+            length = interval * 60
+            start = minute - minute % length
+            bucket = state.open_buckets.get(interval)
+
+            if start < state.closed_until.get(interval, 0):
+                # A bar for a finished bucket, write it again
+                if start < self.started or start < state.kept_since:
+                    logger.warning(f"BarAggregator: cannot correct the {interval} min bar of {symbol} at {start}, its minutes are not kept")
+                else:
+                    rows.append((self._recompute(symbol, state, interval, start).to_row(symbol, interval), True))
+                continue
+
+            if bucket is not None and bucket.start != start:
+                # The first bar of the next bucket
+                rows.extend(self._close(symbol, state, interval))
+                bucket = None
+
+            if bucket is None:
+                bucket = state.open_buckets[interval] = Bucket(start, start + length, minute, values)
+            elif replaced:
+                bucket = state.open_buckets[interval] = self._recompute(symbol, state, interval, start)
+            else:
+                bucket.add(minute, values)
+
+            if minute + 60 == bucket.end:
+                rows.extend(self._close(symbol, state, interval))
+        return rows
+
+    def _recompute(self, symbol, state, interval, start) -> Bucket:
+        # Rebuild a bucket from the kept minutes, O(interval)
+        bucket = None
+        for minute in range(start, start + interval * 60, 60):
+            values = state.minutes.get(minute)
+            if values is None:
+                continue
+            if bucket is None:
+                bucket = Bucket(start, start + interval * 60, minute, values)
+            else:
+                bucket.add(minute, values)
+        return bucket
+
+    def _close(self, symbol, state, interval) -> list:
+        bucket = state.open_buckets.pop(interval)
+        state.closed_until[interval] = bucket.end
+        if bucket.start < self.started:
+            logger.debug(f"BarAggregator: skipping the partial {interval} min bar of {symbol} at {bucket.start}")
+            return []
+        return [(bucket.to_row(symbol, interval), False)]
+
+    def close_due(self, now=None) -> list:
+        """
+        Finish the buckets that ended close_delay seconds before now and forget minutes older than the
+        longest interval.  Returns the (row, update) pairs to write.
+        """
+        now = time.time() if now is None else now
+        oldest = now - self.intervals[-1] * 60 - self.close_delay
+        rows = []
+        with self._lock:
+            for symbol, state in self._symbols.items():
+                for interval, bucket in list(state.open_buckets.items()):
+                    if bucket.end + self.close_delay <= now:
+                        rows.extend(self._close(symbol, state, interval))
+                for minute in [minute for minute in state.minutes if minute < oldest]:
+                    del state.minutes[minute]
+                state.kept_since = max(state.kept_since, oldest)
+        return rows
+
+    async def _write(self, rows) -> None:
+        for row, update in rows:
+            await self.writer.put_row(row, update=update)
+            if update:
+                self.rollups_corrected += 1
+            else:
+                self.rollups_written += 1
+
+    def forget(self, *symbols) -> None:
+        """
+        Drop the state of symbols that are no longer tracked.
+        """
+        with self._lock:
+            for symbol in symbols:
+                self._symbols.pop(symbol, None)
+
+    async def run(self) -> None:
+        """
+        Write the buckets that no bar closed, every check_frequency seconds.
+        """
+        while True:
+            await asyncio.sleep(self.check_frequency)
+            await self._write(self.close_due())
@@ -0,0 +1,352 @@
+"""
+Export the closed days of stock_bars, and optionally stock_trades_real_time, to Parquet files partitioned
+by date and symbol, and read them back without touching the database.
+
+    archive/
+        manifest.json
+        bars/date=2024-03-01/symbol=AAPL/part-0.parquet
+        bars/date=2024-03-01/symbol=BTC%2FUSD/part-0.parquet
+        trades/date=2024-03-01/symbol=AAPL/part-0.parquet
+
+bars holds the 1 min bars (interval = 1), the rollups can be computed from them.  The date is the day in
+ET, so that a stock session is never split over two dates.  A day is exported once it ended SETTLE_SEC
+ago, after the late corrections and gap backfills arrived.  Each day is read with one binary COPY, sorted
+by symbol, and a file is written whenever the symbol changes, so only one symbol's day is held in memory.
+
+manifest.json lists the days exported with the rows of every symbol.  An export skips the days in it,
+so running it again, e.g. every night, only exports the new days.  A day is added to the manifest after
+all of its files were written, and the manifest is saved every MANIFEST_SAVE_SEC and when the export
+ends, so an export that is killed writes the days since the last save again on the next run.
+
+The files are read with BarArchive, which memory-maps them:
+
+    archive = BarArchive()
+    arrays = archive.read_arrays('AAPL', '2024-03-01', '2024-03-31')  # {'time': ndarray, 'open': ...}
+    table = archive.read_table('AAPL', '2024-03-01', '2024-03-31', columns=['time', 'close'])
+
+or as a Hive partitioned dataset, pyarrow.dataset.dataset('archive/bars', partitioning='hive').
+
+pyarrow is only needed here, install it with pip install pyarrow.
+
+Usage:
+    python -m helpers.bar_archive
+    python -m helpers.bar_archive --trades --start 2024-01-01
+    python -m helpers.bar_archive --dir /data/archive --end 2024-12-31
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+import pytz
+from psycopg import sql
+
+from helpers.db_pool import get_pool, close_pools
+from helpers.logger import logger
+from resources.constants import BAR_ARCHIVE, FILE_PATHS, MARKET_CALENDAR
+
+MANIFEST_VERSION = 1
+
+# Dataset: the table it is exported from, its rows and its columns with their PostgreSQL type
+DATASETS = {
+    'bars': {
+        'table': 'stock_bars',
+        'where': '"interval" = 1',
+        'columns': (('time', 'timestamptz'), ('open', 'float8'), ('high', 'float8'), ('low', 'float8'), ('close', 'float8'),
+                    ('volume', 'int8'), ('trade_count', 'int8'), ('vwap', 'float8')),
+    },
+    'trades': {
+        'table': 'stock_trades_real_time',
+        'where': 'TRUE',
+        'columns': (('time', 'timestamptz'), ('price', 'float8'), ('size', 'int8'), ('exchange', 'text'),
+                    ('trade_id', 'text'), ('conditions', 'text')),
+    },
+}
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("BarArchive: the archive needs pyarrow, install it with pip install pyarrow") from e
+    return pyarrow
+
+def _arrow_schema(dataset):
+    pa = _pyarrow()
+    types = {
+        'timestamptz': pa.timestamp('us', tz='UTC'),
+        'float8': pa.float64(),
+        'int8': pa.int64(),
+        'text': pa.string(),
+    }
+    return pa.schema([(name, types[pg_type]) for name, pg_type in DATASETS[dataset]['columns']])
+
+def _day(value) -> datetime.date:
+    return value if isinstance(value, datetime.date) else datetime.date.fromisoformat(value)
+
+def partition_path(dataset: str, day: datetime.date, symbol: str) -> str:
+    """
+    Returns the path of a symbol's day, relative to the archive directory.  Symbols are URI encoded like
+    pyarrow does for Hive partitions, BTC/USD is in symbol=BTC%2FUSD.
+    """
+    return f"{dataset}/date={day.isoformat()}/symbol={urllib.parse.quote(symbol, safe='')}/part-0.parquet"
+
+def load_manifest(path: str) -> dict:
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {'version': MANIFEST_VERSION, 'timezone': MARKET_CALENDAR['TIMEZONE'], 'datasets': {}}
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"BarArchive: {path}/manifest.json has version {manifest.get('version')}, expected {MANIFEST_VERSION}")
+    return manifest
+
+def save_manifest(path: str, manifest: dict) -> None:
+    # Replaced in one step, a reader never sees half of it
+    temp_path = os.path.join(path, 'manifest.json.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp_path, os.path.join(path, 'manifest.json'))
+
+class ArchiveExporter:
+    """
+    INPUTS:
+        path: str - The archive directory.
+        datasets: tuple - Keys of DATASETS to export.
+        settle: float - Seconds after the end of a day in ET before it is exported.
+    """
+
+    def __init__(self, path=FILE_PATHS['ARCHIVE_DIR'], datasets=('bars',), settle=BAR_ARCHIVE['SETTLE_SEC']):
+        self.path = path
+        self.datasets = datasets
+        self.settle = settle
+        self.timezone = pytz.timezone(MARKET_CALENDAR['TIMEZONE'])
+        self.manifest = load_manifest(path)
+        self.rows_exported = 0
+        self.files_written = 0
+        self.days_exported = 0
+        self._saved = time.monotonic()
+
+    def _day_start(self, day: datetime.date) -> datetime.datetime:
+        return self.timezone.localize(datetime.datetime.combine(day, datetime.time()))
+
+    def last_closed_day(self, now=None) -> datetime.date:
+        """
+        Returns the last day in ET that ended at least settle seconds before now.
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        day = (now - datetime.timedelta(seconds=self.settle)).astimezone(self.timezone).date()
+        # day is still running, or ended less than settle seconds ago
+        return day - datetime.timedelta(days=1)
+
+    def first_day(self, dataset: str):
+        """
+        Returns the day in ET of the oldest row of a dataset, None when its table is empty.
+        """
+        definition = DATASETS[dataset]
+        query = sql.SQL("SELECT min(\"time\") FROM {table} WHERE {where}").format(
+            table=sql.Identifier('public', definition['table']), where=sql.SQL(definition['where'])
+        )
+        with get_pool().connection() as connection:
+            first = connection.execute(query).fetchone()[0]
+        return None if first is None else first.astimezone(self.timezone).date()
+
+    def days_to_export(self, dataset: str, start=None, end=None) -> list:
+        """
+        Returns the closed days from start to end that are not in the manifest.  start defaults to the
+        day of the oldest row.
+        """
+        last_closed = self.last_closed_day()
+        end = min(_day(end), last_closed) if end else last_closed
+        start = _day(start) if start else self.first_day(dataset)
+        if start is None:
+            return []
+        exported = self.manifest['datasets'].get(dataset, {})
+        days = []
+        day = start
+        while day <= end:
+            if day.isoformat() not in exported:
+                days.append(day)
+            day += datetime.timedelta(days=1)
+        return days
+
+    def _write_symbol(self, dataset, day, symbol, columns, schema) -> None:
+        pa = _pyarrow()
+        table = pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
+        path = os.path.join(self.path, partition_path(dataset, day, symbol))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        pa.parquet.write_table(table, temp_path, compression=BAR_ARCHIVE['COMPRESSION'], row_group_size=BAR_ARCHIVE['ROW_GROUP_SIZE'])
+        os.replace(temp_path, path)
+        self.files_written += 1
+
+    def export_day(self, dataset: str, day: datetime.date) -> dict:
+        """
+        Write the files of a day and return its rows per symbol.
+        """
+        definition = DATASETS[dataset]
+        schema = _arrow_schema(dataset)
+        names = [name for name, _ in definition['columns']]
+        pg_types = ['text'] + [pg_type for _, pg_type in definition['columns']]
+        query = sql.SQL(
+            "COPY (SELECT symbol::text, {columns} FROM {table} WHERE {where} AND \"time\" >= {start} AND \"time\" < {end} "
+            "ORDER BY symbol, \"time\") TO STDOUT (FORMAT BINARY)"
+        ).format(
+            columns=sql.SQL(', ').join(
+                sql.SQL("{column}::{pg_type}").format(column=sql.Identifier(name), pg_type=sql.SQL(pg_type))
+                for name, pg_type in definition['columns']
+            ),
+            table=sql.Identifier('public', definition['table']),
+            where=sql.SQL(definition['where']),
+            start=sql.Literal(self._day_start(day)),
+            end=sql.Literal(self._day_start(day + datetime.timedelta(days=1))),
+        )
+
+        symbols = {}
+        symbol = None
+        columns = [[] for _ in names]
+        with get_pool().connection() as connection:
+            with connection.cursor() as cursor:
+                with cursor.copy(query) as copy:
+                    copy.set_types(pg_types)
+                    for row in copy.rows():
+                        if row[0] != symbol:
+                            if symbol is not None:
+                                self._write_symbol(dataset, day, symbol, columns, schema)
+                                symbols[symbol] = len(columns[0])
+                                columns = [[] for _ in names]
+                            symbol = row[0]
+                        for values, value in zip(columns, row[1:]):
+                            values.append(value)
+        if symbol is not None:
+            self._write_symbol(dataset, day, symbol, columns, schema)
+            symbols[symbol] = len(columns[0])
+
+        rows = sum(symbols.values())
+        self.manifest['datasets'].setdefault(dataset, {})[day.isoformat()] = {
+            'rows': rows,
+            'symbols': symbols,
+            'exported_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        }
+        if time.monotonic() - self._saved >= BAR_ARCHIVE['MANIFEST_SAVE_SEC']:
+            self.save()
+        self.rows_exported += rows
+        self.days_exported += 1
+        return symbols
+
+    def save(self) -> None:
+        save_manifest(self.path, self.manifest)
+        self._saved = time.monotonic()
+
+    def run(self, start=None, end=None) -> dict:
+        """
+        Export the new closed days of every dataset and return a summary.
+        """
+        _pyarrow()
+        os.makedirs(self.path, exist_ok=True)
+        started = time.perf_counter()
+        try:
+            for dataset in self.datasets:
+                days = self.days_to_export(dataset, start, end)
+                logger.info(f"ArchiveExporter: {len(days)} days of {dataset} to export to {self.path}")
+                for day in days:
+                    symbols = self.export_day(dataset, day)
+                    logger.info(f"ArchiveExporter: {dataset} {day}: {sum(symbols.values())} rows of {len(symbols)} symbols")
+        finally:
+            # The days exported before an error or an interrupt are kept
+            self.save()
+        elapsed = time.perf_counter() - started
+        return {
+            'days': self.days_exported,
+            'files': self.files_written,
+            'rows': self.rows_exported,
+            'secs': round(elapsed, 3),
+            'rows_per_sec': round(self.rows_exported / elapsed, 1) if elapsed else None,
+        }
+
+class BarArchive:
+    """
+    Reads a symbol's days from an archive written by ArchiveExporter.  The manifest is read once, create
+    a new BarArchive to see the days exported since.
+
+    INPUTS:
+        path: str - The archive directory.
+    """
+
+    def __init__(self, path=FILE_PATHS['ARCHIVE_DIR']):
+        self.path = path
+        self.manifest = load_manifest(path)
+
+    def days(self, dataset='bars', symbol=None) -> list:
+        """
+        Returns the days exported, only those with rows of symbol when it is given.
+        """
+        exported = self.manifest['datasets'].get(dataset, {})
+        return [_day(day) for day, entry in sorted(exported.items()) if symbol is None or entry['symbols'].get(symbol)]
+
+    def paths(self, symbol: str, start, end, dataset='bars') -> list:
+        """
+        Returns the files of a symbol from start to end, both included, in the order of the days.
+        """
+        start, end = _day(start).isoformat(), _day(end).isoformat()
+        exported = self.manifest['datasets'].get(dataset, {})
+        return [
+            os.path.join(self.path, partition_path(dataset, _day(day), symbol))
+            for day, entry in sorted(exported.items())
+            if start <= day <= end and entry['symbols'].get(symbol)
+        ]
+
+    def read_table(self, symbol: str, start, end, dataset='bars', columns=None):
+        """
+        Returns a pyarrow Table of a symbol's rows from start to end, one chunk per day.  The files are
+        memory-mapped rather than read into memory.
+        """
+        pa = _pyarrow()
+        tables = [pa.parquet.read_table(path, columns=columns, memory_map=True) for path in self.paths(symbol, start, end, dataset)]
+        if not tables:
+            schema = _arrow_schema(dataset)
+            return schema.empty_table() if columns is None else schema.empty_table().select(columns)
+        return pa.concat_tables(tables)
+
+    def read_arrays(self, symbol: str, start, end, dataset='bars', columns=None) -> dict:
+        """
+        Returns {column: NumPy array} of a symbol's rows from start to end.  time is datetime64[us] in
+        UTC.  Missing values are NaN, or None in the text columns.
+        """
+        pa = _pyarrow()
+        table = self.read_table(symbol, start, end, dataset, columns)
+        arrays = {}
+        for name in table.column_names:
+            column = table.column(name)
+            if pa.types.is_timestamp(column.type):
+                # NumPy has no time zones, the values stay in UTC
+                column = column.cast(pa.timestamp('us'))
+            arrays[name] = column.to_numpy()
+        return arrays
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the closed days of stock_bars to Parquet files partitioned by date and symbol.')
+    parser.add_argument('--dir', help=f"The archive directory. Default is {FILE_PATHS['ARCHIVE_DIR']}.", type=str, default=FILE_PATHS['ARCHIVE_DIR'])
+    parser.add_argument('--trades', help='Also export stock_trades_real_time.', action='store_true')
+    parser.add_argument('--start', help='First day in ET, YYYY-MM-DD. Default is the day of the oldest row.', type=str, default=None)
+    parser.add_argument('--end', help='Last day in ET, YYYY-MM-DD. Default is the last closed day.', type=str, default=None)
+    args = parser.parse_args()
+
+    exporter = ArchiveExporter(args.dir, datasets=('bars', 'trades') if args.trades else ('bars',))
+    try:
+        summary = exporter.run(start=args.start, end=args.end)
+    except KeyboardInterrupt:
+        logger.info("ArchiveExporter: interrupted, run again to resume")
+        return
+    finally:
+        asyncio.run(close_pools())
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
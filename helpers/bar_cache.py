@@ -0,0 +1,157 @@
+"""
+An in-memory cache of the most recent 1 min bars of every tracked symbol.
+
+Each symbol has a time column of microseconds since 1970-01-01 UTC (like bars_strings_to_columns) and float
+columns for open, high, low, close, volume, trade_count and vwap, nan where a bar has None.  The columns are
+twice the cache size and new bars are appended until the end is reached, then the newest bars are moved to
+the front.  That keeps the cached bars contiguous and in time order, so windows are returned as NumPy views
+without copying.
+
+A view shows the cache as it is and may change with the next bar, use .copy() to keep the values.
+"""
+
+import datetime
+import threading
+
+import numpy as np
+
+from helpers.barConversion import NUMBER_KEYS
+from helpers.logger import logger
+from resources.constants import BAR_CACHE
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def to_epoch_us(timestamp: datetime.datetime) -> int:
+    return (timestamp - _EPOCH) // datetime.timedelta(microseconds=1)
+
+def _to_float(value) -> float:
+    return np.nan if value is None else value
+
+class SymbolBars:
+    """
+    The cached bars of one symbol.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.time = np.zeros(2 * size, dtype=np.int64)
+        self.values = np.full((len(NUMBER_KEYS), 2 * size), np.nan)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _make_room(self) -> None:
+        # Move the cached bars to the front of the columns
+        count = len(self)
+        self.time[:count] = self.time[self.start:self.end]
+        self.values[:, :count] = self.values[:, self.start:self.end]
+        self.start, self.end = 0, count
+
+    def put(self, time_us: int, row) -> None:
+        """
+        Add the bar at time_us, or replace it if it is cached already.  row holds the values in NUMBER_KEYS order.
+        """
+        if self.end > self.start and time_us > self.time[self.end - 1]:
+            pos = self.end
+        else:
+            pos = self.start + int(np.searchsorted(self.time[self.start:self.end], time_us))
+            if pos < self.end and self.time[pos] == time_us:
+                self.values[:, pos] = row
+                return
+            if pos == self.start and len(self) == self.size:
+                # Older than every cached bar
+                return
+
+        if self.end == len(self.time):
+            pos -= self.start
+            self._make_room()
+        if pos < self.end:
+            # A late bar, move the newer ones up
+            self.time[pos + 1:self.end + 1] = self.time[pos:self.end]
+            self.values[:, pos + 1:self.end + 1] = self.values[:, pos:self.end]
+        self.time[pos] = time_us
+        self.values[:, pos] = row
+        self.end += 1
+        if len(self) > self.size:
+            self.start += 1
+
+    def view(self, start: int, end: int) -> dict:
+        columns = {'time': self.time[start:end]}
+        for i, key in enumerate(NUMBER_KEYS):
+            columns[key] = self.values[i, start:end]
+        return columns
+
+class BarCache:
+    """
+    The recent bars of the tracked symbols, updated by the bar handlers.
+
+    INPUTS:
+        size: int - Bars kept per symbol.
+    Only tracked symbols are cached, see track() and evict().  All methods can be called from any thread.
+    """
+
+    def __init__(self, size: int = BAR_CACHE['SIZE']):
+        self.size = size
+        self._bars = {}
+        self._lock = threading.Lock()
+
+    @property
+    def symbols(self) -> list:
+        return sorted(self._bars)
+
+    def track(self, *symbols) -> None:
+        """
+        Cache the bars of symbols from now on.
+        """
+        with self._lock:
+            added = [symbol for symbol in symbols if symbol not in self._bars]
+            for symbol in added:
+                self._bars[symbol] = SymbolBars(self.size)
+        if added:
+            logger.info(f"BarCache: tracking {added}")
+
+    def evict(self, *symbols) -> None:
+        """
+        Forget the cached bars of symbols and stop caching them.
+        """
+        with self._lock:
+            evicted = [symbol for symbol in symbols if self._bars.pop(symbol, None) is not None]
+        if evicted:
+            logger.info(f"BarCache: evicted {evicted}")
+
+    def update(self, data) -> None:
+        """
+        Add a bar, or correct it when it is an updated bar.  Bars of symbols that are not tracked are ignored.
+        """
+        row = [_to_float(getattr(data, key)) for key in NUMBER_KEYS]
+        time_us = to_epoch_us(data.timestamp)
+        with self._lock:
+            bars = self._bars.get(data.symbol)
+            if bars is not None:
+                bars.put(time_us, row)
+
+    def window(self, symbol: str, start: datetime.datetime = None, end: datetime.datetime = None):
+        """
+        Returns the cached bars of symbol from start up to, not including, end as a dict of array views with
+        the keys time and NUMBER_KEYS, or None if symbol is not tracked.  Without start or end the window is open.
+        """
+        with self._lock:
+            bars = self._bars.get(symbol)
+            if bars is None:
+                return None
+            times = bars.time[bars.start:bars.end]
+            first = bars.start if start is None else bars.start + int(np.searchsorted(times, to_epoch_us(start)))
+            last = bars.end if end is None else bars.start + int(np.searchsorted(times, to_epoch_us(end)))
+            return bars.view(first, last)
+
+    def last(self, symbol: str, count: int):
+        """
+        Returns the count most recent bars of symbol like window().
+        """
+        with self._lock:
+            bars = self._bars.get(symbol)
+            if bars is None:
+                return None
+            return bars.view(max(bars.start, bars.end - count), bars.end)
@@ -0,0 +1,49 @@
+from helpers.batch_writer import BatchWriter
+from helpers.database import bar_to_row, add_bars_to_stock_bars_async
+from resources.constants import BAR_WRITER, FILE_PATHS
+
+class BarWriter(BatchWriter):
+    """
+    Writes the bars received by the websocket handlers to stock_bars in batches.
+
+    New bars are inserted and skipped if they are already stored, updated bars overwrite the stored bar.
+    Bars that cannot be written are kept in the spool under spool/bars/ until the database is back.
+    See BatchWriter for when batches are flushed.
+    """
+
+    name = "BarWriter"
+
+    def __init__(self, batch_size=BAR_WRITER['BATCH_SIZE'], flush_interval=BAR_WRITER['FLUSH_INTERVAL_SEC'], max_queue=BAR_WRITER['MAX_QUEUE'], spool_dir=FILE_PATHS['SPOOL_DIR'] + 'bars'):
+        super().__init__(batch_size, flush_interval, max_queue, spool_dir=spool_dir)
+
+    async def put(self, data, update=False) -> None:
+        """
+        Queue a bar to be written to stock_bars.
+
+        INPUTS:
+            data: Bar or string - The bar received from the Alpaca API.
+            update: bool - True for corrected bars, which replace the bar already in the table.
+        """
+        row = bar_to_row(data)
+        await self._put_item((row, update))
+
+    async def put_row(self, row, update=False) -> None:
+        """
+        Queue a row from bar_to_row, or one built like it such as a rollup, to be written to stock_bars.
+        """
+        await self._put_item((row, update))
+
+    def _item_time(self, item):
+        # Only the 1 min bars from the feed, rollups are stamped with the start of their bucket
+        row, update = item
+        return row[0] if row[9] == 1 else None
+
+    async def _write_batch(self, batch, connection) -> None:
+        new_rows = [row for row, update in batch if not update]
+        updated_rows = [row for row, update in batch if update]
+
+        # New bars first so that a correction in the same batch wins
+        if new_rows:
+            await add_bars_to_stock_bars_async(new_rows, connection)
+        if updated_rows:
+            await add_bars_to_stock_bars_async(updated_rows, connection, upsert=True)
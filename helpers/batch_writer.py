@@ -0,0 +1,257 @@
+import asyncio
+import os
+
+from helpers import metrics
+from helpers.db_pool import get_async_pool
+from helpers.logger import logger
+from helpers.spool import Spool
+from resources.constants import SPOOL
+
+class BatchWriter:
+    """
+    Collects rows from the websocket handlers in a bounded queue and writes them to the database in batches.
+
+    A batch is flushed when it holds batch_size rows, or flush_interval seconds after its first row arrived.
+    The handlers only queue rows; all database work happens in run() on a connection from the async pool.
+    Subclasses convert the handler data to rows in put() and write a batch in _write_batch().
+
+    The alpaca clients run their handlers on their own event loop in another thread, so rows are handed
+    over to the loop that is running the writer.  When the queue is full the handler waits, which pushes
+    back on the websocket instead of opening more connections.
+
+    With a spool, rows are never dropped.  A batch that cannot be written is appended to the spool on disk
+    and, until the spool has been replayed, the following batches go straight to the spool as well.  When
+    the queue is full the handler does not wait: its row and the rows after it are held until the batch
+    being written is done, then spooled behind the rows still queued, and the writer keeps spooling until
+    the spool is replayed.  A background task replays the spool into the database once it is reachable
+    again, and switches back to direct writes only after a replay that left nothing behind, so that a
+    row is never written before an older one of the same bar.
+    """
+
+    name = "BatchWriter"
+
+    def __init__(self, batch_size, flush_interval, max_queue, report_frequency=300, spool_dir=None, drain_frequency=SPOOL['DRAIN_FREQUENCY_SEC']):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.report_frequency = report_frequency
+        self.drain_frequency = drain_frequency
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._pending = []
+        self._overflow = []  # rows that found the queue full, spooled behind the queued ones
+        self._loop = None
+        self._spool_dir = spool_dir
+        self.spool = None
+        self.db_available = True
+
+        # Counters for logging
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.batches_written = 0
+        self.rows_spooled = 0
+        self._last_report_time = None
+        self._last_report_rows = 0
+
+    async def _write_batch(self, batch, connection) -> None:
+        raise NotImplementedError
+
+    def _item_time(self, item):
+        # The exchange timestamp of a queued item for the write lag metric, None when it has none
+        return None
+
+    async def _write(self, batch) -> None:
+        pool = await get_async_pool()
+        async with pool.connection() as connection:
+            await self._write_batch(batch, connection)
+
+    def _open_spool(self) -> Spool:
+        if self.spool is None and self._spool_dir is not None:
+            self.spool = Spool(self._spool_dir, SPOOL['SEGMENT_SIZE'])
+        return self.spool
+
+    async def _put_item(self, item) -> None:
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if self.spool is not None:
+            # Never waits, _enqueue decides between the queue and the overflow on the writer's loop
+            if self._loop is None or self._loop is running_loop:
+                self._enqueue(item)
+            else:
+                self._loop.call_soon_threadsafe(self._enqueue, item)
+            return
+
+        if self._loop is None or self._loop is running_loop:
+            await self._queue.put(item)
+        else:
+            # asyncio.Queue is not thread safe, let the writer's loop do the put
+            future = asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop)
+            await asyncio.wrap_future(future)
+
+    def _enqueue(self, item) -> None:
+        if self._overflow or self._queue.full():
+            # The database is lagging, keep the websocket moving.  Once one row overflowed, the rows
+            # after it overflow too, so that they are spooled in the order they arrived
+            self._overflow.append(item)
+        else:
+            self._queue.put_nowait(item)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def run(self) -> None:
+        """
+        Write queued rows until cancelled.  Whatever is still queued when cancelled is flushed before returning.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._last_report_time = self._loop.time()
+        logger.info(f"{self.name}: started (batch_size={self.batch_size}, flush_interval={self.flush_interval}s)")
+
+        drain_task = None
+        if self._open_spool() is not None:
+            if not self.spool.is_empty():
+                # The rows left by the previous run are older than the new ones, write them first
+                self.db_available = False
+            drain_task = asyncio.create_task(self._drain_spool_forever())
+        try:
+            while True:
+                await self._collect_batch()
+                await self._flush()
+                self._report_rate()
+        except asyncio.CancelledError:
+            if drain_task is not None:
+                drain_task.cancel()
+            await self.close()
+            raise
+
+    async def close(self) -> None:
+        """
+        Flush the pending rows and everything left in the queue.
+        """
+        while not self._queue.empty():
+            self._pending.append(self._queue.get_nowait())
+        await self._flush()
+
+        logger.info(f"{self.name}: stopped. {self.rows_written} rows written in {self.batches_written} batches, {self.rows_spooled} spooled, {self.rows_failed} failed.")
+
+    async def _collect_batch(self) -> None:
+        # Wait as long as needed for the first row, then up to flush_interval for the rest
+        if not self._pending:
+            self._pending.append(await self._queue.get())
+        deadline = self._loop.time() + self.flush_interval
+
+        while len(self._pending) < self.batch_size:
+            if not self._queue.empty():
+                self._pending.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                # asyncio.timeout, unlike wait_for, never loses a cancellation that races with the get
+                async with asyncio.timeout(timeout):
+                    self._pending.append(await self._queue.get())
+            except TimeoutError:
+                break
+
+    async def _flush(self) -> None:
+        await self._flush_pending()
+        if self._overflow:
+            self._spool_overflow()
+
+    def _spool_overflow(self) -> None:
+        # The rows still queued arrived before the overflow, they are spooled ahead of it
+        items = []
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        items.extend(self._overflow)
+        self._overflow = []
+        self.db_available = False
+        self._spool_items(items)
+
+    async def _flush_pending(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+
+        if not self.db_available:
+            # Keep the order of the rows, they are written after the spool is replayed
+            self._spool_items(batch)
+            return
+
+        try:
+            await self._write(batch)
+        except Exception as e:
+            logger.error(f"{self.name}: failed to write {len(batch)} rows: {e}")
+            if self.spool is None:
+                self.rows_failed += len(batch)
+                return
+            self.db_available = False
+            self._spool_items(batch)
+            return
+
+        self.rows_written += len(batch)
+        self.batches_written += 1
+        metrics.observe_write_lag(self.name, map(self._item_time, batch))
+        logger.debug(f"{self.name}: wrote {len(batch)} rows ({self.qsize()} queued)")
+
+    def _spool_items(self, items) -> None:
+        try:
+            self.spool.append_many(items)
+        except Exception as e:
+            self.rows_failed += len(items)
+            logger.error(f"{self.name}: failed to spool {len(items)} rows: {e}")
+            return
+        self.rows_spooled += len(items)
+
+    async def _drain_spool_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.drain_frequency)
+            if not self.db_available or not self.spool.is_empty():
+                await self.drain_spool()
+
+    async def drain_spool(self) -> bool:
+        """
+        Replay the spool into the database one segment at a time, oldest first.
+        Returns True when the spool was replayed and batches are written to the database directly again.
+        """
+        # Batches keep going to the spool during a replay, the rows spooled meanwhile are replayed by the
+        # next pass.  The switch back happens when a pass left nothing behind, with no await in between
+        while True:
+            if not await self._drain_sealed_segments():
+                return False
+            if self.spool.is_empty():
+                break
+
+        if not self.db_available:
+            logger.info(f"{self.name}: spool replayed, writing to the database again")
+        self.db_available = True
+        return True
+
+    async def _drain_sealed_segments(self) -> bool:
+        self.spool.seal()
+        for path in self.spool.sealed_segments():
+            rows = self.spool.read(path)
+            try:
+                if rows:
+                    await self._write(rows)
+            except Exception as e:
+                self.db_available = False
+                logger.warning(f"{self.name}: database still unavailable, {len(rows)} rows stay in {os.path.basename(path)}: {e}")
+                return False
+            self.spool.remove(path)
+            self.rows_written += len(rows)
+            logger.info(f"{self.name}: replayed {len(rows)} rows from {os.path.basename(path)}")
+        return True
+
+    def _report_rate(self) -> None:
+        # Log the write rate every report_frequency seconds
+        now = self._loop.time()
+        elapsed = now - self._last_report_time
+        if elapsed < self.report_frequency:
+            return
+        rows = self.rows_written - self._last_report_rows
+        logger.info(f"{self.name}: {rows / elapsed:.1f} rows/sec over the last {elapsed:.0f} secs ({self.qsize()} queued, {self.rows_failed} failed in total)")
+        self._last_report_time = now
+        self._last_report_rows = self.rows_written
@@ -1,20 +1,22 @@
-import os
-from psycopg import sql, connect
-from dotenv import load_dotenv
+from typing import TYPE_CHECKING
 
-from alpaca.data.models.bars import Bar
+from psycopg import sql, connect, AsyncConnection
 
 from helpers.barConversion import bars_string_to_BarClass
+from helpers.db_pool import get_pool
+from helpers.env import DB_PWD, DB_URL, DB_USER, DB_NAME, DB_PORT
 from helpers.logger import logger
+from helpers.metrics import timed
 
-load_dotenv()
+if TYPE_CHECKING:
+    # alpaca.data imports pandas, only the functions that need it import it
+    from alpaca.data.models.bars import Bar
 
-# Database info
-DB_PWD = os.getenv("MS_DB_PWD")
-DB_URL = os.getenv("MS_DB_URL")
-DB_USER = os.getenv("MS_DB_USER")
-DB_NAME = os.getenv("MS_DB_NAME")
-DB_PORT = os.getenv("MS_DB_PORT")
+# Column order of the rows produced by bar_to_row
+BAR_COLUMNS = ('time', 'symbol', 'open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap', 'interval')
+
+# PostgreSQL allows at most 65535 parameters per statement
+MAX_ROWS_PER_INSERT = 65535 // len(BAR_COLUMNS)
 
 def connect_to_db(user=DB_USER, password=DB_PWD, url=DB_URL, db_name=DB_NAME, port=DB_PORT):
     
@@ -23,30 +25,187 @@ def connect_to_db(user=DB_USER, password=DB_PWD, url=DB_URL, db_name=DB_NAME, po
 
     return db_connection
 
-def add_bar_to_stock_bars(data_bar, connection):
+async def connect_to_db_async(user=DB_USER, password=DB_PWD, url=DB_URL, db_name=DB_NAME, port=DB_PORT):
+    
+    # REFERENCE - https://www.psycopg.org/psycopg3/docs/api/connections.html#psycopg.AsyncConnection.connect
+    db_connection = await AsyncConnection.connect(host=url, port=port, dbname=db_name, user=user, password=password)
+
+    return db_connection
+
+def bar_to_row(data, interval=1) -> tuple:
+    """
+    Convert a bar into a row for the stock_bars table.  The values are in the order of BAR_COLUMNS.
+
+    INPUTS:
+        data: Bar or string - The bar received from the Alpaca API, or its string representation.
+        interval: int - The bar interval in minutes.
+    """
+    if type(data) == str:
+        data = bars_string_to_BarClass(data)
+
     required_props = ['timestamp', 'symbol', 'open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap']
     
     # Check if all required properties are present in the data_bar
-    missing_props = [prop for prop in required_props if not hasattr(data_bar, prop)]
+    missing_props = [prop for prop in required_props if not hasattr(data, prop)]
     
     if missing_props:
         raise ValueError(f'All required properties are not present in the data_bar. Missing properties: {missing_props}')
+
+    return (data.timestamp, data.symbol, data.open, data.high, data.low, data.close, data.volume, data.trade_count, data.vwap, interval)
+
+# stock_bars.interval of the bar types.  Time bars of a minute or more store their minutes (1, 5, 60, 1440).
+# The bars built from trades store negative values that cannot be confused with them:
+#   seconds bars: -seconds                       e.g. -10 for 10 second bars
+#   tick bars:    -(TICK_INTERVAL_BASE + trades)  e.g. -100100 for 100 trade bars
+#   volume bars:  -(VOLUME_INTERVAL_BASE + size)  e.g. -1010000 for 10000 share bars
+TICK_INTERVAL_BASE = 100_000
+VOLUME_INTERVAL_BASE = 1_000_000
+
+def bar_interval(kind: str, size: int) -> int:
+    """
+    Returns the stock_bars.interval of a bar type.
+
+    INPUTS:
+        kind: str - 'minutes', 'seconds', 'ticks' or 'volume'.
+        size: int - The minutes, seconds, trades or shares per bar.
+    """
+    if kind == 'minutes':
+        return size
+    if kind == 'seconds' and 0 < size < 60:
+        return -size
+    if kind == 'ticks' and 0 < size < VOLUME_INTERVAL_BASE - TICK_INTERVAL_BASE:
+        return -(TICK_INTERVAL_BASE + size)
+    if kind == 'volume' and 0 < size <= 2**31 - 1 - VOLUME_INTERVAL_BASE:
+        return -(VOLUME_INTERVAL_BASE + size)
+    raise ValueError(f'Unsupported bar type: {size} {kind}')
+
+def interval_to_bar_type(interval: int) -> tuple:
+    """
+    Returns the (kind, size) of a stock_bars.interval, the reverse of bar_interval.
+    """
+    if interval > 0:
+        return ('minutes', interval)
+    if interval > -TICK_INTERVAL_BASE:
+        return ('seconds', -interval)
+    if interval > -VOLUME_INTERVAL_BASE:
+        return ('ticks', -interval - TICK_INTERVAL_BASE)
+    return ('volume', -interval - VOLUME_INTERVAL_BASE)
+
+# Columns of the stock_bars unique constraint
+BAR_KEY_COLUMNS = ('symbol', 'time', 'interval')
+_BAR_KEY_INDEXES = tuple(BAR_COLUMNS.index(column) for column in BAR_KEY_COLUMNS)
+
+def bar_key(row) -> tuple:
+    """
+    Returns the (symbol, time, interval) of a row from bar_to_row.
+    """
+    return tuple(row[index] for index in _BAR_KEY_INDEXES)
+
+def _insert_bars_query(row_count: int, upsert: bool = False) -> sql.Composed:
+    """
+    A single INSERT with one VALUES tuple per row.
+
+    Bars that are already in stock_bars are left as they are, so replaying bars is harmless.
+    With upsert=True they are overwritten with the new values instead.
+    """
+    row_placeholder = sql.SQL("({})").format(sql.SQL(', ').join(sql.Placeholder() * len(BAR_COLUMNS)))
+    if upsert:
+        on_conflict = sql.SQL("DO UPDATE SET {}").format(sql.SQL(', ').join(
+            sql.SQL("{column} = EXCLUDED.{column}").format(column=sql.Identifier(column))
+            for column in BAR_COLUMNS if column not in BAR_KEY_COLUMNS
+        ))
+    else:
+        on_conflict = sql.SQL("DO NOTHING")
+
+    return sql.SQL(
+        "INSERT INTO {table} ({columns}) VALUES {values} ON CONFLICT ({key}) {on_conflict}"
+    ).format(
+        table=sql.Identifier('stock_bars'),
+        columns=sql.SQL(', ').join(map(sql.Identifier, BAR_COLUMNS)),
+        values=sql.SQL(', ').join([row_placeholder] * row_count),
+        key=sql.SQL(', ').join(map(sql.Identifier, BAR_KEY_COLUMNS)),
+        on_conflict=on_conflict
+    )
+
+def _latest_per_key(rows) -> list:
+    # ON CONFLICT DO UPDATE cannot touch the same row twice in one statement, keep the last version of each bar
+    latest = {}
+    for row in rows:
+        latest[bar_key(row)] = row
+    return list(latest.values())
+
+def _chunked(rows):
+    for start in range(0, len(rows), MAX_ROWS_PER_INSERT):
+        yield rows[start:start + MAX_ROWS_PER_INSERT]
+
+@timed
+def add_bar_to_stock_bars(data_bar, connection):
+    row = bar_to_row(data_bar)
     
     # Insert the data into the database
     with connection.cursor() as cursor:
-        query = sql.SQL(
-            "INSERT INTO {table} (time, symbol, open, high, low, close, volume, trade_count, vwap, interval) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-        ).format(
-            table=sql.Identifier('stock_bars')
-        )
-        cursor.execute(
-            query,
-            (data_bar.timestamp, data_bar.symbol, data_bar.open, data_bar.high, data_bar.low, data_bar.close, data_bar.volume, data_bar.trade_count, data_bar.vwap, 1)
-        )
+        cursor.execute(_insert_bars_query(1), row)
 
     connection.commit()
 
-def add_trade_to_stock_trades(data, connection):
+@timed
+def upsert_bars(rows, connection):
+    """
+    Insert or update many bars in stock_bars in one statement and commit.
+
+    INPUTS:
+        rows: list - Rows as returned by bar_to_row.
+        connection: Connection - An open database connection.
+    """
+    rows = _latest_per_key(rows)
+    with connection.cursor() as cursor:
+        for chunk in _chunked(rows):
+            params = [value for row in chunk for value in row]
+            cursor.execute(_insert_bars_query(len(chunk), upsert=True), params)
+
+    connection.commit()
+
+@timed
+async def add_bars_to_stock_bars_async(rows, connection, upsert=False):
+    """
+    Insert many bars into stock_bars with multi-row INSERT statements and commit once.
+
+    INPUTS:
+        rows: list - Rows as returned by bar_to_row.
+        connection: AsyncConnection - An open async database connection.
+        upsert: bool - Overwrite bars that are already in the table instead of leaving them as they are.
+    """
+    if upsert:
+        rows = _latest_per_key(rows)
+    async with connection.cursor() as cursor:
+        for chunk in _chunked(rows):
+            params = [value for row in chunk for value in row]
+            await cursor.execute(_insert_bars_query(len(chunk), upsert=upsert), params)
+
+    await connection.commit()
+
+# Column order of the rows produced by trade_to_row, and their types for binary COPY
+TRADE_COLUMNS = ('time', 'symbol', 'price', 'size', 'exchange', 'trade_id', 'conditions')
+TRADE_COLUMN_TYPES = ('timestamptz', 'text', 'float8', 'int4', 'text', 'text', 'text')
+
+def _conditions_to_text(conditions):
+    # Stored the way PostgreSQL prints a text[], e.g. {@,T}
+    if conditions is None or isinstance(conditions, str):
+        return conditions
+    items = []
+    for condition in conditions:
+        if condition == '' or any(char in condition for char in ' ,{}"\\'):
+            condition = '"' + condition.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        items.append(condition)
+    return '{' + ','.join(items) + '}'
+
+def trade_to_row(data) -> tuple:
+    """
+    Convert a trade into a row for the stock_trades_real_time table.  The values are in the order of TRADE_COLUMNS.
+
+    INPUTS:
+        data: Trade - The trade received from the Alpaca API.
+    """
     required_props = ['symbol', 'timestamp', 'exchange', 'price', 'size', 'id', 'conditions']
 
     # Check if all required properties are present in the data
@@ -54,39 +213,121 @@ def add_trade_to_stock_trades(data, connection):
 
     if missing_props:
         raise ValueError(f'All required properties are not present in the data. Missing properties: {missing_props}')
+
+    exchange = getattr(data.exchange, 'value', data.exchange)
+    trade_id = None if data.id is None else str(data.id)
+    return (data.timestamp, data.symbol, data.price, round(data.size), exchange, trade_id, _conditions_to_text(data.conditions))
+
+@timed
+def add_trade_to_stock_trades(data, connection):
+    row = trade_to_row(data)
     
     # Insert the data into the database
     with connection.cursor() as cursor:
         query = sql.SQL(
-            "INSERT INTO {table} (symbol, time, exchange, price, size, trade_id, conditions) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+            "INSERT INTO {table} ({columns}) VALUES ({values})"
         ).format(
-            table=sql.Identifier('stock_trades_real_time')
-        )
-        cursor.execute(
-            query,
-            (data.symbol, data.timestamp, data.exchange, data.price, data.size, data.id, data.conditions)
+            table=sql.Identifier('stock_trades_real_time'),
+            columns=sql.SQL(', ').join(map(sql.Identifier, TRADE_COLUMNS)),
+            values=sql.SQL(', ').join(sql.Placeholder() * len(TRADE_COLUMNS))
         )
+        cursor.execute(query, row)
 
     connection.commit()
+
+@timed
+async def copy_trades_async(rows, connection):
+    """
+    Stream many trades into stock_trades_real_time with a binary COPY and commit once.
+
+    INPUTS:
+        rows: list - Rows as returned by trade_to_row.
+        connection: AsyncConnection - An open async database connection.
+    """
+    query = sql.SQL(
+        "COPY {table} ({columns}) FROM STDIN (FORMAT BINARY)"
+    ).format(
+        table=sql.Identifier('stock_trades_real_time'),
+        columns=sql.SQL(', ').join(map(sql.Identifier, TRADE_COLUMNS))
+    )
+    async with connection.cursor() as cursor:
+        async with cursor.copy(query) as copy:
+            copy.set_types(TRADE_COLUMN_TYPES)
+            for row in rows:
+                await copy.write_row(row)
+
+    await connection.commit()
     
-# Connect to the database and refresh the view stock_bars_5min
-def refresh_stock_bars_5min(connection):
-    with connection.cursor() as cursor:
-        cursor.execute(
-            "CALL refresh_continuous_aggregate('stock_bars_5min', NULL, NULL)"
-        )
-    connection.commit()
+# Symbols whose bought minus sold quantity is above 0, summed over every order
+_OPEN_POSITIONS_FROM_ORDERS = """
+SELECT symbol
+FROM {orders}
+WHERE asset_class = %s
+GROUP BY symbol
+HAVING SUM(CASE WHEN side = 'buy' THEN qty::numeric ELSE 0 END) -
+       SUM(CASE WHEN side = 'sell' THEN qty::numeric ELSE 0 END) > 0
+"""
+
+# The same from the positions table that the trigger in data/db_positions.sql keeps up to date
+_OPEN_POSITIONS = """
+SELECT symbol
+FROM {positions}
+WHERE asset_class = %s AND qty > 0
+"""
+
+_BACKFILL_POSITIONS = """
+INSERT INTO {positions} (asset_class, symbol, qty)
+SELECT asset_class, symbol,
+       SUM(CASE side WHEN 'buy' THEN COALESCE(qty::numeric, 0) WHEN 'sell' THEN -COALESCE(qty::numeric, 0) ELSE 0 END)
+FROM {orders}
+WHERE symbol IS NOT NULL AND asset_class IS NOT NULL
+GROUP BY asset_class, symbol
+"""
+
+_has_positions_table = None
+
+def open_positions_query(from_orders=False, schema='public') -> sql.Composed:
+    """
+    Returns the query for the symbols with an open position, with the asset_class as its parameter.
 
-# Connect to the database and print 10 rows from the stock_bars_5min view
-def print_stock_bars_5min(connection):
-    with connection.cursor() as cursor:
-        cursor.execute(
-            "SELECT * FROM stock_bars_5min LIMIT 10"
-        )
-        rows = cursor.fetchall()
-        for row in rows:
-            print(row)
+    INPUTS:
+        from_orders: bool - Sum the orders instead of reading the positions table.
+        schema: str - The schema of the orders and positions tables.
+    """
+    query = _OPEN_POSITIONS_FROM_ORDERS if from_orders else _OPEN_POSITIONS
+    return sql.SQL(query).format(orders=sql.Identifier(schema, 'orders'), positions=sql.Identifier(schema, 'positions'))
+
+@timed
+def get_open_positions(connection, asset_class):
+    """
+    Returns the (symbol,) rows of the open positions of asset_class, 'us_equity' or 'crypto'.
 
+    Reads the positions table when data/db_positions.sql has been run, otherwise sums the orders.
+    """
+    global _has_positions_table
+    if _has_positions_table is None:
+        _has_positions_table = connection.execute("SELECT to_regclass('public.positions') IS NOT NULL").fetchone()[0]
+        if not _has_positions_table:
+            logger.warning("get_open_positions: there is no positions table, summing the orders instead.  See data/db_positions.sql.")
+    return connection.execute(open_positions_query(from_orders=not _has_positions_table), (asset_class,)).fetchall()
+
+@timed
+def backfill_positions(connection, schema='public') -> int:
+    """
+    Recompute the positions table from all orders, once after data/db_positions.sql was run.
+    Orders cannot be changed until it is done.  Returns the number of positions.
+    """
+    orders = sql.Identifier(schema, 'orders')
+    positions = sql.Identifier(schema, 'positions')
+    with connection.transaction():
+        connection.execute(sql.SQL("LOCK TABLE {orders} IN SHARE ROW EXCLUSIVE MODE").format(orders=orders))
+        connection.execute(sql.SQL("DELETE FROM {positions}").format(positions=positions))
+        cursor = connection.execute(sql.SQL(_BACKFILL_POSITIONS).format(orders=orders, positions=positions))
+        count = cursor.rowcount
+    logger.info(f"backfill_positions: {count} positions computed from the orders")
+    return count
+
+@timed
 def get_stocks_to_track():
     """
     Returns a list of symbols of the stocks to track
@@ -98,7 +339,7 @@ def get_stocks_to_track():
     TODO: Only the top condition is implemented for now.  Add in the other conditions.
     """
 
-    with connect_to_db(DB_USER, DB_PWD, DB_URL, DB_NAME, port=DB_PORT) as connection:
+    with get_pool().connection() as connection:
         # Query the DB for the active portfolios and get the symbols that are in the stock_targets table.
         query1 = """
         SELECT DISTINCT
@@ -117,15 +358,7 @@ def get_stocks_to_track():
         results_list1 = connection.execute(query1).fetchall()
 
         # Query the DB for stocks that have not been sold.
-        query2 = """
-        SELECT symbol
-        FROM public.orders
-        WHERE asset_class = 'us_equity'
-        GROUP BY symbol
-        HAVING SUM(CASE WHEN side = 'buy' THEN qty::numeric ELSE 0 END) - 
-               SUM(CASE WHEN side = 'sell' THEN qty::numeric ELSE 0 END) > 0;
-        """
-        results_list2 = connection.execute(query2).fetchall()
+        results_list2 = get_open_positions(connection, 'us_equity')
 
         # Use a set to avoid duplicates
         active_symbols_set = set(result[0] for result in results_list1)
@@ -136,6 +369,7 @@ def get_stocks_to_track():
 
     return tuple(active_symbols_set)
 
+@timed
 def get_crypto_to_track():
     """
     Returns a list of symbols of the crypto to track
@@ -146,7 +380,7 @@ def get_crypto_to_track():
     - those that have qty greater than 0 in the orders table for the portfolio_id that is active.
     """
     
-    with connect_to_db(DB_USER, DB_PWD, DB_URL, DB_NAME, port=DB_PORT) as connection:
+    with get_pool().connection() as connection:
         # Query the DB for the active portfolios and get the symbols that are in the stock_targets table.
         query1 = """
         SELECT DISTINCT
@@ -164,16 +398,8 @@ def get_crypto_to_track():
         """
         results_list1 = connection.execute(query1).fetchall()
 
-        # Query the DB for stocks that have not been sold.
-        query2 = """
-        SELECT symbol
-        FROM public.orders
-        WHERE asset_class = 'crypto'
-        GROUP BY symbol
-        HAVING SUM(CASE WHEN side = 'buy' THEN qty::numeric ELSE 0 END) - 
-               SUM(CASE WHEN side = 'sell' THEN qty::numeric ELSE 0 END) > 0;
-        """
-        results_list2 = connection.execute(query2).fetchall()
+        # Query the DB for crypto that has not been sold.
+        results_list2 = get_open_positions(connection, 'crypto')
 
         # Use a set to avoid duplicates
         active_symbols_set = set(result[0] for result in results_list1)
@@ -184,9 +410,10 @@ def get_crypto_to_track():
 
     return tuple(active_symbols_set)
 
+@timed
 def add_bar_row_to_db(data):
     """
-    Connect to the database.
+    Take a connection from the pool.
     Add the data_dict keys timestamp, symbol, open, high, low, close, volume, trade_count, vwap to the table, stock_bars
         as time, symbol, open, high, low, close, volume, trade_count, vwap
     
@@ -194,6 +421,8 @@ def add_bar_row_to_db(data):
         data: string - The data string received from the Alpaca API
         Example data string: "symbol='AAPL' timestamp=datetime.datetime(2024, 9, 23, 19, 59, tzinfo=datetime.timezone.utc) open=226.375 high=226.63 low=226.3 close=226.49 volume=15052.0 trade_count=208.0 vwap=226.463702"
     """
+    from alpaca.data.models.bars import Bar
+
     # Convert the string to a dictionary
     if type(data) == str:
         data_bar = bars_string_to_BarClass(data)
@@ -203,54 +432,19 @@ def add_bar_row_to_db(data):
         logger.warning(f'Data is not a string or Bar object as expected.  Data type: {type(data)}')
     logger.debug(data_bar)
 
-    # Connect to the database
-    db_connection = connect_to_db(DB_USER, DB_PWD, DB_URL, DB_NAME, port=DB_PORT)
-
-    # Insert the data into the database
-    add_bar_to_stock_bars(data_bar, db_connection)
+    with get_pool().connection() as db_connection:
+        # Insert the data into the database
+        add_bar_to_stock_bars(data_bar, db_connection)
 
-def update_bar_row_in_db(data: Bar):
+@timed
+def update_bar_row_in_db(data: 'Bar'):
     """
-    Connects to the database and if the data with the symbol and timestamp is found, updates the row.
-    If the data is not found, adds the data to the database.
+    Takes a connection from the pool and updates the bar with the same symbol, timestamp and interval.
+    If the bar is not found, adds it to the database.  Both happen in a single INSERT ... ON CONFLICT.
 
     INPUTS:
         data: Bar - The data to add or update in the database
     """
 
-    # Connect to the database
-    db_connection = connect_to_db(DB_USER, DB_PWD, DB_URL, DB_NAME, port=DB_PORT)
-
-    try:
-        # Check if the data is in the database
-        with db_connection.cursor() as cursor:
-            query = sql.SQL(
-                "SELECT * FROM {table} WHERE time = %s AND symbol = %s AND interval = %s"
-            ).format(
-                table=sql.Identifier('stock_bars')
-            )
-            cursor.execute(
-                query,
-                (data.timestamp, data.symbol, 1)
-            )
-            row = cursor.fetchone()
-
-        # If the data is found, update the row
-        if row:
-            with db_connection.cursor() as cursor:
-                query = sql.SQL(
-                    "UPDATE {table} SET open = %s, high = %s, low = %s, close = %s, volume = %s, trade_count = %s, vwap = %s WHERE time = %s AND symbol = %s AND interval = %s"
-                ).format(
-                    table=sql.Identifier('stock_bars')
-                )
-                cursor.execute(
-                    query,
-                    (data.open, data.high, data.low, data.close, data.volume, data.trade_count, data.vwap, data.timestamp, data.symbol, 1)
-                )
-            db_connection.commit()
-        # If the data is not found, add the data to the database
-        else:
-            add_bar_to_stock_bars(data, db_connection)
-    finally:
-        # Ensure the connection is closed
-        db_connection.close()
\ No newline at end of file
+    with get_pool().connection() as db_connection:
+        upsert_bars([bar_to_row(data)], db_connection)
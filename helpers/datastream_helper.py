@@ -1,24 +1,27 @@
-import os
+import asyncio
 import json
+from typing import TYPE_CHECKING
+
 import websockets
-from dotenv import load_dotenv
-from alpaca.data.live import StockDataStream, CryptoDataStream
-from alpaca.data.live.websocket import DataStream
-from alpaca.common.enums import BaseURL
-from alpaca.data.enums import DataFeed, CryptoFeed
 
 from helpers.database import get_stocks_to_track, get_crypto_to_track
+from helpers.env import API_KEY, API_SECRET
 from helpers.logger import logger
+from resources.constants import STARTUP
 
-load_dotenv()
+# alpaca.data imports pandas, which takes most of the startup time, so it is imported where it is used
+if TYPE_CHECKING:
+    from alpaca.data.live.websocket import DataStream
 
-# Alpaca API key ID and secret
-API_KEY = os.getenv("MS_ALPACA_API_KEY")
-API_SECRET = os.getenv("MS_ALPACA_API_SECRET")
 TESTING = False
 
+# The values of alpaca's BaseURL.MARKET_DATA_STREAM, DataFeed.IEX and CryptoFeed.US, without importing alpaca
+MARKET_DATA_STREAM_URL = "wss://stream.data.alpaca.markets"
+STOCK_FEED = "iex"
+CRYPTO_FEED = "us"
+
 
-def get_wss_url(asset='stock', testing: bool = TESTING) -> str:
+def get_wss_url(asset='stock', testing: bool = TESTING, base_url: str = None) -> str:
     """
     Get the WebSocket URL for the asset.
 
@@ -30,22 +33,28 @@ def get_wss_url(asset='stock', testing: bool = TESTING) -> str:
     Inputs:
     - asset (str): The asset to track, either 'stock' or 'crypto'.
     - testing (bool): Whether to use the sandbox url for testing.
+    - base_url (str): Use this server instead of Alpaca's, e.g. ws://localhost:8765 for helpers/replay_server.py.
 
     Returns:
     - str: The WebSocket URL for the asset.
     """
-    baseURL = BaseURL.MARKET_DATA_STREAM.value if not testing else "wss://stream.data.sandbox.alpaca.markets"
+    if base_url:
+        baseURL = base_url.rstrip('/')
+    else:
+        baseURL = MARKET_DATA_STREAM_URL if not testing else "wss://stream.data.sandbox.alpaca.markets"
     if asset == 'stock':
-        return baseURL + "/v2/" + DataFeed.IEX.value
+        return baseURL + "/v2/" + STOCK_FEED
     elif asset == 'crypto':
-        return baseURL+"/v1beta3/crypto/"+CryptoFeed.US.value
+        return baseURL+"/v1beta3/crypto/"+CRYPTO_FEED
     else:
         return None
     
-def start_stream(bar_data_handler, updatebar_data_handler, stocks_to_track = None, asset='stock') -> DataStream:
+def start_stream(bar_data_handler, updatebar_data_handler, stocks_to_track = None, asset='stock') -> 'DataStream':
     """
     Start the WebSocket client and subscribe to the bars for the symbols to track.
     """
+    from alpaca.data.live import StockDataStream, CryptoDataStream
+
     stock_url = get_wss_url('stock', testing=TESTING)
     crypto_url = get_wss_url('crypto', testing=TESTING)
     
@@ -75,32 +84,31 @@ def start_stream(bar_data_handler, updatebar_data_handler, stocks_to_track = Non
     
     return wss_client
 
-async def test_socket(url = "wss://stream.data.sandbox.alpaca.markets/v1beta3/crypto/us") -> bool:
+async def test_socket(url = "wss://stream.data.sandbox.alpaca.markets/v1beta3/crypto/us", timeout = STARTUP['PREFLIGHT_TIMEOUT_SEC']) -> bool:
     """
-    Test the connection to the WebSocket client.
+    Test the connection to the WebSocket client: connect and authenticate, which fails when the
+    connection limit is exceeded.  Nothing is subscribed, the connection is closed at once.
     
     Returns:
         bool: True if the connection is successful, False otherwise.
     """
-    
-    async with websockets.connect(url) as ws:
-        await ws.send(json.dumps({'action': 'auth', 'key': API_KEY, 'secret': API_SECRET}))
-        response = await ws.recv()
-        logger.debug(f"Response: {response}")
-        # if the response is successful, then listen to the stream
-        if json.loads(response)[0]["T"] == 'success':
-            await ws.send(json.dumps({'action': 'subscribe', 'bars': ["XTZ/USD"] }))
-            response = await ws.recv()
-            logger.debug(f"Response: {response}")
-            response_dict = json.loads(response)[0]
-            if response_dict["T"] == 'success':
-                return True
-            else:
-                logger.warning(f"Failed to subscribe to the stream: {response_dict['msg']}")
-                return False
-        else:
-            return False
-        
+    try:
+        async with asyncio.timeout(timeout):
+            async with websockets.connect(url) as ws:
+                response = await ws.recv()
+                logger.debug(f"Response: {response}")
+                await ws.send(json.dumps({'action': 'auth', 'key': API_KEY, 'secret': API_SECRET}))
+                response = await ws.recv()
+                logger.debug(f"Response: {response}")
+    except (TimeoutError, OSError, websockets.WebSocketException) as e:
+        logger.warning(f"Failed to connect to the stream {url}: {type(e).__name__} {e}")
+        return False
+
+    response_dict = json.loads(response)[0]
+    if response_dict["T"] == 'success':
+        return True
+    logger.warning(f"Failed to authenticate to the stream {url}: {response_dict.get('msg')}")
+    return False
 
 
 if __name__== "__main__":
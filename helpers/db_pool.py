@@ -0,0 +1,120 @@
+import asyncio
+import os
+import threading
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
+
+from helpers.env import DB_PWD, DB_URL, DB_USER, DB_NAME, DB_PORT
+from helpers.logger import logger
+
+# Pool sizing and recycling
+POOL_MIN_SIZE = int(os.getenv("MS_DB_POOL_MIN", default="1"))
+POOL_MAX_SIZE = int(os.getenv("MS_DB_POOL_MAX", default="5"))
+POOL_MAX_IDLE = float(os.getenv("MS_DB_POOL_MAX_IDLE", default="300"))          # seconds an unused connection is kept
+POOL_MAX_LIFETIME = float(os.getenv("MS_DB_POOL_MAX_LIFETIME", default="3600"))  # seconds before a connection is replaced
+POOL_TIMEOUT = float(os.getenv("MS_DB_POOL_TIMEOUT", default="30"))              # seconds to wait for a connection
+POOL_STATS_FREQUENCY = 300  # seconds between pool usage log lines
+
+_pool = None
+_async_pool = None
+_pool_lock = threading.Lock()
+
+def _conninfo() -> str:
+    return make_conninfo(host=DB_URL, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PWD)
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the process wide pool of database connections, opening it on first use.
+
+    Connections are checked before they are handed out and replaced once they have been idle for
+    POOL_MAX_IDLE seconds or open for POOL_MAX_LIFETIME seconds.
+
+    Usage:
+        with get_pool().connection() as connection:
+            connection.execute(...)
+    The transaction is committed when the block exits without an error and rolled back otherwise.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                _conninfo(),
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+                max_idle=POOL_MAX_IDLE,
+                max_lifetime=POOL_MAX_LIFETIME,
+                timeout=POOL_TIMEOUT,
+                check=ConnectionPool.check_connection,
+                name="market_stream",
+                open=True
+            )
+    return _pool
+
+async def get_async_pool() -> AsyncConnectionPool:
+    """
+    Returns the process wide pool of async database connections, opening it on first use.
+
+    The async pool belongs to the event loop that opened it, so only use it from that loop.
+    """
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = AsyncConnectionPool(
+            _conninfo(),
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            max_idle=POOL_MAX_IDLE,
+            max_lifetime=POOL_MAX_LIFETIME,
+            timeout=POOL_TIMEOUT,
+            check=AsyncConnectionPool.check_connection,
+            name="market_stream_async",
+            open=False
+        )
+        await _async_pool.open()
+    return _async_pool
+
+def pool_stats() -> dict:
+    """
+    Returns the usage counters of the open pools, keyed by 'sync' and 'async'.
+
+    Of interest are:
+        requests_num: number of connections checked out of the pool.
+        requests_queued: number of check outs that had to wait for a connection.
+        requests_wait_ms: total time spent waiting for a connection.
+        connections_num: number of connections opened to the database.
+        pool_size / pool_available: connections in the pool and how many of them are idle.
+    """
+    stats = {}
+    if _pool is not None:
+        stats['sync'] = _pool.get_stats()
+    if _async_pool is not None:
+        stats['async'] = _async_pool.get_stats()
+    return stats
+
+def log_pool_stats() -> None:
+    for name, stats in pool_stats().items():
+        logger.info(
+            f"db pool {name}: checkouts={stats.get('requests_num', 0)} waits={stats.get('requests_queued', 0)} "
+            f"wait_ms={stats.get('requests_wait_ms', 0)} size={stats.get('pool_size', 0)} "
+            f"available={stats.get('pool_available', 0)} connections_opened={stats.get('connections_num', 0)}"
+        )
+
+async def report_pool_stats(frequency=POOL_STATS_FREQUENCY) -> None:
+    """
+    Log the pool usage counters every frequency seconds.
+    """
+    while True:
+        await asyncio.sleep(frequency)
+        log_pool_stats()
+
+async def close_pools() -> None:
+    """
+    Close both pools.  Called once when the program shuts down.
+    """
+    global _pool, _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -0,0 +1,20 @@
+"""
+The settings read from the environment and the .env file, which is loaded once for all modules.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Alpaca API key ID and secret
+API_KEY = os.getenv("MS_ALPACA_API_KEY", default="")
+API_SECRET = os.getenv("MS_ALPACA_API_SECRET", default="")
+
+# Database info
+DB_PWD = os.getenv("MS_DB_PWD")
+DB_URL = os.getenv("MS_DB_URL")
+DB_USER = os.getenv("MS_DB_USER")
+DB_NAME = os.getenv("MS_DB_NAME")
+DB_PORT = os.getenv("MS_DB_PORT")
@@ -0,0 +1,117 @@
+"""
+Record the raw websocket frames of a StockDataStream or CryptoDataStream to a capture file.
+
+A capture file is gzip compressed and starts with a header line:
+    MSCAP1 {"asset": "stock", "url": "wss://...", "started": "2024-12-10T14:36:00+00:00"}
+followed by one record per frame:
+    receive time (float64 unix seconds), frame length (uint32), frame bytes
+Frames are kept exactly as received, msgpack for the alpaca clients.
+
+Captures can be replayed with helpers/replay_server.py.
+"""
+
+import datetime
+import gzip
+import json
+import os
+import struct
+import threading
+import time
+
+from helpers.logger import logger
+
+MAGIC = b'MSCAP1'
+FRAME_HEADER = struct.Struct('<dI')
+
+class FeedRecorder:
+    """
+    Writes frames to a new capture file named <asset>_<YYYYmmdd_HHMMSS>.cap.gz in directory.
+    """
+
+    def __init__(self, directory: str, asset: str, url: str = ""):
+        os.makedirs(directory, exist_ok=True)
+        started = datetime.datetime.now(datetime.timezone.utc)
+        self.path = os.path.join(directory, f"{asset}_{started.strftime('%Y%m%d_%H%M%S')}.cap.gz")
+        self.frames = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, 'wb', compresslevel=6)
+        header = {'asset': asset, 'url': url, 'started': started.isoformat()}
+        self._file.write(MAGIC + b' ' + json.dumps(header).encode() + b'\n')
+        logger.info(f"FeedRecorder: recording the {asset} stream to {self.path}")
+
+    def record(self, frame) -> None:
+        if isinstance(frame, str):
+            frame = frame.encode()
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(FRAME_HEADER.pack(time.time(), len(frame)))
+            self._file.write(frame)
+            self.frames += 1
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                logger.info(f"FeedRecorder: {self.frames} frames recorded to {self.path}")
+
+class _RecordingWebSocket:
+    # Passes everything through to the websocket and records the frames returned by recv()
+
+    def __init__(self, ws, recorder: FeedRecorder):
+        self._ws = ws
+        self._recorder = recorder
+
+    async def recv(self, *args, **kwargs):
+        frame = await self._ws.recv(*args, **kwargs)
+        self._recorder.record(frame)
+        return frame
+
+    def __getattr__(self, name):
+        return getattr(self._ws, name)
+
+def attach_recorder(wss_client, recorder: FeedRecorder) -> None:
+    """
+    Record every frame wss_client receives after it connects, including after reconnects.
+
+    INPUTS:
+        wss_client: DataStream - A StockDataStream or CryptoDataStream that is not running yet.
+        recorder: FeedRecorder - Where the frames are written.
+    """
+    connect = wss_client._connect
+
+    async def recording_connect():
+        await connect()
+        wss_client._ws = _RecordingWebSocket(wss_client._ws, recorder)
+
+    wss_client._connect = recording_connect
+
+def read_capture(path: str):
+    """
+    Returns the header of a capture file and a generator of its (receive time, frame) records.
+    """
+    f = gzip.open(path, 'rb')
+    header_line = f.readline()
+    if not header_line.startswith(MAGIC):
+        f.close()
+        raise ValueError(f"{path} is not a capture file")
+    header = json.loads(header_line[len(MAGIC):])
+
+    def frames():
+        with f:
+            while True:
+                try:
+                    frame_header = f.read(FRAME_HEADER.size)
+                    if len(frame_header) < FRAME_HEADER.size:
+                        return
+                    received, length = FRAME_HEADER.unpack(frame_header)
+                    frame = f.read(length)
+                except EOFError:
+                    # The recorder was killed before the file was closed
+                    return
+                if len(frame) < length:
+                    return
+                yield received, frame
+
+    return header, frames()
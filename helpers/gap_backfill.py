@@ -0,0 +1,191 @@
+"""
+Find the 1 min bars missed while a websocket client was disconnected and fetch them from the REST API.
+
+GapDetector keeps the time of the newest bar of every symbol and listens to the StreamSupervisor of every
+client, which tells it when a stream drops and when it is connected again, even when it reconnects at
+once.  The minutes in between are queued as gaps, per symbol from the minute after its newest bar, and an
+outage that ends with the client stopped on purpose, e.g. after trading hours, is forgotten.  Gaps are
+only looked for around disconnects because a minute without trades has no bar, so a jump in the bar
+times of a symbol is not a gap by itself.
+
+BackfillWorker fetches the queued gaps with HistoricalBarsClient, GAP_BACKFILL['CONCURRENCY'] at a
+time, and hands every bar to on_bar, which main.py writes to stock_bars as an update.  Bars that did
+arrive are written again with the same values, which the upsert makes harmless.
+"""
+
+import asyncio
+import collections
+import datetime
+import time
+
+from helpers.historical_bars import HistoricalBarsClient
+from helpers.logger import logger
+from resources.constants import GAP_BACKFILL
+
+class Gap:
+    __slots__ = ('asset', 'symbols', 'start', 'end', 'attempts')
+
+    def __init__(self, asset, symbols, start, end):
+        self.asset = asset
+        self.symbols = symbols
+        self.start = start  # epoch seconds of the first and the last missing minute
+        self.end = end
+        self.attempts = 0
+
+    def __repr__(self):
+        start = datetime.datetime.fromtimestamp(self.start, datetime.timezone.utc)
+        end = datetime.datetime.fromtimestamp(self.end, datetime.timezone.utc)
+        return f"{self.asset} gap of {len(self.symbols)} symbols from {start:%Y-%m-%d %H:%M} to {end:%H:%M} UTC"
+
+class _ClientState:
+    __slots__ = ('asset', 'client', 'down_since')
+
+    def __init__(self, asset, client):
+        self.asset = asset
+        self.client = client
+        self.down_since = None
+
+class GapDetector:
+    """
+    INPUTS:
+        max_gap_min: int - Only the last max_gap_min minutes of a longer outage are queued.
+        check_frequency: float - Seconds between checks for the outages that ended.
+    """
+
+    def __init__(self, max_gap_min=GAP_BACKFILL['MAX_GAP_MIN'], check_frequency=GAP_BACKFILL['CHECK_FREQUENCY_SEC']):
+        self.max_gap_min = max_gap_min
+        self.check_frequency = check_frequency
+        self.last_bar = {}  # symbol: epoch seconds of its newest 1 min bar
+        self.outages = 0
+        self.gaps = asyncio.Queue()
+        self._events = collections.deque()  # (_ClientState, event, at), appended from the clients' loops
+
+    def observe(self, data) -> None:
+        """
+        Note the time of a 1 min bar from the stream.  Called by the bar handler.
+        """
+        minute = int(data.timestamp.timestamp())
+        if minute > self.last_bar.get(data.symbol, 0):
+            self.last_bar[data.symbol] = minute
+
+    def watch(self, supervisor) -> None:
+        """
+        Listen to the drops and reconnects of a StreamSupervisor's client.
+        """
+        state = _ClientState(supervisor.asset, supervisor.client)
+        supervisor.listeners.append(lambda event, at: self._events.append((state, event, at)))
+
+    def check(self) -> list:
+        """
+        Returns the gaps of the outages that ended since the last check.
+        """
+        gaps = []
+        while self._events:
+            state, event, at = self._events.popleft()
+            if event == 'down':
+                if state.down_since is None:
+                    state.down_since = at
+                    logger.warning(f"GapDetector: the {state.asset} stream is down")
+            elif event == 'up':
+                if state.down_since is not None:
+                    self.outages += 1
+                    symbols = list(state.client._handlers['bars'])
+                    gaps.extend(self.find_gaps(state.asset, symbols, state.down_since, at))
+                    logger.info(f"GapDetector: the {state.asset} stream is back after {at - state.down_since:.1f} secs")
+                    state.down_since = None
+            else:
+                # Stopped on purpose, e.g. after trading hours
+                state.down_since = None
+        return gaps
+
+    def find_gaps(self, asset, symbols, down_since, up_at) -> list:
+        """
+        Returns the gaps of symbols for a disconnect from down_since to up_at, epoch seconds, grouped by
+        their first missing minute.
+        """
+        # The bar of a minute arrives after the minute, so the one before the disconnect may be missing
+        first_missing = int(down_since) - int(down_since) % 60 - 60
+        last_missing = int(up_at) - int(up_at) % 60 - 60
+        first_missing = max(first_missing, last_missing - (self.max_gap_min - 1) * 60)
+
+        starts = {}
+        for symbol in symbols:
+            start = max(first_missing, self.last_bar.get(symbol, 0) + 60)
+            if start <= last_missing:
+                starts.setdefault(start, []).append(symbol)
+        return [Gap(asset, sorted(group), start, last_missing) for start, group in sorted(starts.items())]
+
+    async def run(self) -> None:
+        """
+        Queue the gaps of the outages that ended, every check_frequency seconds.
+        """
+        while True:
+            await asyncio.sleep(self.check_frequency)
+            for gap in self.check():
+                logger.info(f"GapDetector: queued the {gap}")
+                self.gaps.put_nowait(gap)
+
+class BackfillWorker:
+    """
+    Fetches the gaps queued by a GapDetector.
+
+    INPUTS:
+        detector: GapDetector - Where the gaps come from.
+        client: HistoricalBarsClient - For the requests, its RateLimiter paces them.
+        on_bar: coroutine function - Called with every fetched bar, a BarRecord.
+        concurrency: int - Gaps fetched at the same time.
+    """
+
+    def __init__(self, detector: GapDetector, client: HistoricalBarsClient, on_bar, concurrency=GAP_BACKFILL['CONCURRENCY'], symbols_per_request=GAP_BACKFILL['SYMBOLS_PER_REQUEST']):
+        self.detector = detector
+        self.client = client
+        self.on_bar = on_bar
+        self.concurrency = concurrency
+        self.symbols_per_request = symbols_per_request
+        self.bars_backfilled = 0
+        self.gaps_backfilled = 0
+        self.gaps_failed = 0
+
+    async def backfill(self, gap: Gap) -> int:
+        """
+        Fetch the bars of a gap and hand them to on_bar.  Returns the number of bars.
+        """
+        start = datetime.datetime.fromtimestamp(gap.start, datetime.timezone.utc)
+        end = datetime.datetime.fromtimestamp(gap.end, datetime.timezone.utc)
+        count = 0
+        for index in range(0, len(gap.symbols), self.symbols_per_request):
+            symbols = gap.symbols[index:index + self.symbols_per_request]
+            async for bars in self.client.pages(gap.asset, symbols, start, end):
+                for bar in bars:
+                    await self.on_bar(bar)
+                count += len(bars)
+        self.bars_backfilled += count
+        self.gaps_backfilled += 1
+        return count
+
+    async def _work(self) -> None:
+        gaps = self.detector.gaps
+        while True:
+            gap = await gaps.get()
+            gap.attempts += 1
+            started = time.perf_counter()
+            try:
+                count = await self.backfill(gap)
+            except Exception as e:
+                if gap.attempts == 1:
+                    logger.warning(f"BackfillWorker: failed to backfill the {gap}, trying again in {GAP_BACKFILL['RETRY_DELAY_SEC']} secs: {e}")
+                    asyncio.get_running_loop().call_later(GAP_BACKFILL['RETRY_DELAY_SEC'], gaps.put_nowait, gap)
+                else:
+                    self.gaps_failed += 1
+                    logger.error(f"BackfillWorker: gave up on the {gap}: {e}")
+                continue
+            logger.info(f"BackfillWorker: backfilled {count} bars for the {gap} in {time.perf_counter() - started:.1f} secs")
+
+    async def run(self) -> None:
+        """
+        Fetch gaps until cancelled.
+        """
+        try:
+            await asyncio.gather(*(self._work() for _ in range(self.concurrency)))
+        finally:
+            self.client.close()
@@ -0,0 +1,151 @@
+"""
+Read historical bars from Alpaca's market data REST API, one page at a time.
+
+alpaca-py's get_stock_bars() reads every page of a request before it returns and cannot be paced, so
+HistoricalBarsClient calls the bars endpoints itself: every page is one request through a shared
+RateLimiter, pages are handed to the caller as soon as they arrive, and 429 and 5xx answers are retried
+with the delay from Retry-After or a doubling one.  The bars are BarRecords like those of
+helpers/raw_stream.py, so the handlers and writers take them as they are.
+
+    https://docs.alpaca.markets/reference/stockbars
+    https://docs.alpaca.markets/reference/cryptobars-1
+
+helpers/rest_stub_server.py stands in for Alpaca in tests, pass its url as base_url.
+"""
+
+import asyncio
+import datetime
+import email.utils
+import time
+
+import requests
+
+from helpers.env import API_KEY, API_SECRET
+from helpers.logger import logger
+from helpers.raw_stream import BarRecord
+from resources.constants import HISTORICAL_BARS
+
+# The values of alpaca's BaseURL.DATA, DataFeed.IEX and CryptoFeed.US, without importing alpaca
+DATA_URL = "https://data.alpaca.markets"
+STOCK_FEED = "iex"
+CRYPTO_FEED = "us"
+
+def bars_path(asset: str) -> str:
+    if asset == 'crypto':
+        return f"/v1beta3/crypto/{CRYPTO_FEED}/bars"
+    return "/v2/stocks/bars"
+
+def to_rfc3339(value: datetime.datetime) -> str:
+    return value.astimezone(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def retry_after(value, default: float) -> float:
+    """
+    Returns the seconds to wait from a Retry-After header, seconds or an HTTP date, or default without one.
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        until = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (until - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def parse_bars(response: dict) -> list:
+    """
+    Returns the BarRecords of a bars response, {'bars': {symbol: [{'t': ..., 'o': ...}]}}.
+    """
+    bars = []
+    for symbol, symbol_bars in (response.get('bars') or {}).items():
+        for bar in symbol_bars:
+            timestamp = datetime.datetime.fromisoformat(bar['t'].replace('Z', '+00:00'))
+            bars.append(BarRecord(symbol, timestamp, bar['o'], bar['h'], bar['l'], bar['c'], bar['v'], bar.get('n'), bar.get('vw')))
+    return bars
+
+class RateLimiter:
+    """
+    Allows requests_per_min requests a minute, spread evenly, to every task that shares it.
+    """
+
+    def __init__(self, requests_per_min: float = HISTORICAL_BARS['REQUESTS_PER_MIN']):
+        self.interval = 60 / requests_per_min
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class HistoricalBarsClient:
+    """
+    INPUTS:
+        base_url: str - Alpaca's data API by default, e.g. http://localhost:8766 for helpers/rest_stub_server.py.
+        rate_limiter: RateLimiter - Shared by all requests of the client.
+        page_size: int - Bars per page, at most 10000.
+    """
+
+    def __init__(self, base_url: str = None, rate_limiter: RateLimiter = None, page_size: int = HISTORICAL_BARS['PAGE_SIZE']):
+        self.base_url = (base_url or DATA_URL).rstrip('/')
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.page_size = page_size
+        self.requests_sent = 0
+        self.requests_retried = 0
+        self._session = requests.Session()
+        self._session.headers.update({'APCA-API-KEY-ID': API_KEY, 'APCA-API-SECRET-KEY': API_SECRET})
+
+    async def pages(self, asset, symbols, start, end, timeframe='1Min'):
+        """
+        Yields the bars of symbols from start to end, both datetimes and inclusive, one page at a time.
+        """
+        params = {
+            'symbols': ','.join(symbols),
+            'timeframe': timeframe,
+            'start': to_rfc3339(start),
+            'end': to_rfc3339(end),
+            'limit': self.page_size,
+            'sort': 'asc',
+        }
+        if asset == 'stock':
+            params['feed'] = STOCK_FEED
+        url = self.base_url + bars_path(asset)
+        while True:
+            response = await self._get(url, params)
+            yield parse_bars(response)
+            page_token = response.get('next_page_token')
+            if not page_token:
+                break
+            params['page_token'] = page_token
+
+    async def _get(self, url, params) -> dict:
+        delay = HISTORICAL_BARS['RETRY_DELAY_SEC']
+        for attempt in range(HISTORICAL_BARS['RETRIES'] + 1):
+            await self.rate_limiter.wait()
+            self.requests_sent += 1
+            try:
+                response = await asyncio.to_thread(self._session.get, url, params=params, timeout=HISTORICAL_BARS['TIMEOUT_SEC'])
+            except requests.RequestException as e:
+                if attempt == HISTORICAL_BARS['RETRIES']:
+                    raise
+                logger.warning(f"HistoricalBarsClient: request failed, retrying in {delay} secs: {e}")
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                if (response.status_code != 429 and response.status_code < 500) or attempt == HISTORICAL_BARS['RETRIES']:
+                    raise ValueError(f"HistoricalBarsClient: {response.status_code} {response.text[:200]}")
+                delay = retry_after(response.headers.get('Retry-After'), delay)
+                logger.warning(f"HistoricalBarsClient: {response.status_code} from {url}, retrying in {delay:.1f} secs")
+            self.requests_retried += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, HISTORICAL_BARS['MAX_RETRY_DELAY_SEC'])
+
+    def close(self) -> None:
+        self._session.close()
@@ -0,0 +1,234 @@
+"""
+Load historical bars of many symbols and days into stock_bars_historical.
+
+The load is split into units of one UTC day and up to SYMBOLS_PER_REQUEST symbols.  CONCURRENCY workers
+fetch units through one HistoricalBarsClient, so the requests share its rate limit, and write each unit
+in one transaction: a binary COPY into a temporary table, an INSERT ... ON CONFLICT DO NOTHING into
+stock_bars_historical and a row per symbol and day in historical_load_checkpoints.  A load that is
+interrupted or fails for some units is resumed by running it again, only the days without a checkpoint
+are fetched.  Today is never loaded because it is not complete yet.
+
+Run data/db_stock_bars_historical.sql first.
+
+Usage:
+    python -m helpers.historical_loader --symbols AAPL,MSFT --start 2022-01-01 --end 2024-12-31
+    python -m helpers.historical_loader --asset crypto --start 2024-01-01 --concurrency 8
+    python -m helpers.historical_loader --symbols AAPL --start 2024-01-01 --rest-url http://localhost:8766
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import sys
+import time
+
+from psycopg import sql
+
+from helpers.database import get_stocks_to_track, get_crypto_to_track
+from helpers.db_pool import get_pool, get_async_pool, close_pools
+from helpers.historical_bars import HistoricalBarsClient
+from helpers.logger import logger
+from resources.constants import HISTORICAL_LOADER
+
+# Alpaca timeframe: stock_bars_historical.interval in minutes
+TIMEFRAMES = {'1Min': 1, '5Min': 5, '15Min': 15, '1Hour': 60, '1Day': 1440}
+
+HISTORICAL_COLUMNS = ('timestamp', 'symbol', 'open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap', 'interval')
+HISTORICAL_COLUMN_TYPES = ('timestamptz', 'text', 'float8', 'float8', 'float8', 'float8', 'float8', 'int4', 'float8', 'int4')
+
+class LoadUnit:
+    __slots__ = ('day', 'symbols')
+
+    def __init__(self, day, symbols):
+        self.day = day
+        self.symbols = symbols
+
+    def __repr__(self):
+        return f"{self.day} ({len(self.symbols)} symbols)"
+
+def load_checkpoints(symbols, start_day, end_day, interval) -> set:
+    """
+    Returns the (symbol, day) pairs that are loaded already.
+    """
+    with get_pool().connection() as connection:
+        rows = connection.execute(
+            "SELECT symbol, day FROM public.historical_load_checkpoints "
+            "WHERE symbol = ANY(%s) AND day BETWEEN %s AND %s AND \"interval\" = %s",
+            (list(symbols), start_day, end_day, interval)
+        ).fetchall()
+    return set(rows)
+
+def plan_units(symbols, start_day, end_day, done, asset='stock', symbols_per_request=HISTORICAL_LOADER['SYMBOLS_PER_REQUEST']) -> list:
+    """
+    Returns the LoadUnits of the days from start_day to end_day that are not in done.  Stocks have no
+    bars on a Sunday in UTC, those days are left out.
+    """
+    units = []
+    day = start_day
+    while day <= end_day:
+        if asset == 'crypto' or day.weekday() != 6:
+            todo = [symbol for symbol in symbols if (symbol, day) not in done]
+            for index in range(0, len(todo), symbols_per_request):
+                units.append(LoadUnit(day, todo[index:index + symbols_per_request]))
+        day += datetime.timedelta(days=1)
+    return units
+
+class HistoricalLoader:
+    """
+    INPUTS:
+        client: HistoricalBarsClient - Fetches the bars, its RateLimiter paces all workers.
+        asset: str - 'stock' or 'crypto'.
+        timeframe: str - A key of TIMEFRAMES.
+        concurrency: int - Units fetched and written at the same time.
+    """
+
+    def __init__(self, client: HistoricalBarsClient, asset='stock', timeframe='1Min', concurrency=HISTORICAL_LOADER['CONCURRENCY']):
+        self.client = client
+        self.asset = asset
+        self.timeframe = timeframe
+        self.interval = TIMEFRAMES[timeframe]
+        self.concurrency = concurrency
+        self.rows_loaded = 0
+        self.units_loaded = 0
+        self.units_failed = 0
+        self._started = None
+
+    async def fetch(self, unit: LoadUnit) -> list:
+        """
+        Returns the rows of a unit in the order of HISTORICAL_COLUMNS.
+        """
+        start = datetime.datetime.combine(unit.day, datetime.time(), datetime.timezone.utc)
+        end = start + datetime.timedelta(days=1, minutes=-1)
+        rows = []
+        async for bars in self.client.pages(self.asset, unit.symbols, start, end, timeframe=self.timeframe):
+            rows.extend(
+                (bar.timestamp, bar.symbol, bar.open, bar.high, bar.low, bar.close, bar.volume, bar.trade_count, bar.vwap, self.interval)
+                for bar in bars
+            )
+        return rows
+
+    async def write(self, unit: LoadUnit, rows) -> None:
+        """
+        Write the rows of a unit and its checkpoints in one transaction.
+        """
+        counts = dict.fromkeys(unit.symbols, 0)
+        for row in rows:
+            counts[row[1]] = counts.get(row[1], 0) + 1
+        columns = sql.SQL(', ').join(map(sql.Identifier, HISTORICAL_COLUMNS))
+
+        pool = await get_async_pool()
+        async with pool.connection() as connection:
+            async with connection.transaction():
+                async with connection.cursor() as cursor:
+                    # Bars that are in the table already, e.g. from an older loader, are kept
+                    await cursor.execute(
+                        "CREATE TEMP TABLE IF NOT EXISTS bars_load "
+                        "(LIKE public.stock_bars_historical INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+                    )
+                    async with cursor.copy(sql.SQL("COPY bars_load ({columns}) FROM STDIN (FORMAT BINARY)").format(columns=columns)) as copy:
+                        copy.set_types(HISTORICAL_COLUMN_TYPES)
+                        for row in rows:
+                            await copy.write_row(row)
+                    await cursor.execute(
+                        sql.SQL("INSERT INTO public.stock_bars_historical ({columns}) SELECT {columns} FROM bars_load ON CONFLICT DO NOTHING").format(columns=columns)
+                    )
+                    await cursor.executemany(
+                        "INSERT INTO public.historical_load_checkpoints (symbol, day, \"interval\", rows) VALUES (%s, %s, %s, %s) "
+                        "ON CONFLICT (symbol, day, \"interval\") DO UPDATE SET rows = EXCLUDED.rows, loaded_at = NOW()",
+                        [(symbol, unit.day, self.interval, count) for symbol, count in counts.items()]
+                    )
+
+    async def _work(self, units) -> None:
+        while units:
+            unit = units.pop()
+            try:
+                rows = await self.fetch(unit)
+                await self.write(unit, rows)
+            except Exception as e:
+                self.units_failed += 1
+                logger.error(f"HistoricalLoader: failed to load {unit}, it is loaded on the next run: {e}")
+                continue
+            self.rows_loaded += len(rows)
+            self.units_loaded += 1
+
+    async def _report(self, total) -> None:
+        while True:
+            await asyncio.sleep(HISTORICAL_LOADER['REPORT_FREQUENCY_SEC'])
+            elapsed = time.perf_counter() - self._started
+            logger.info(
+                f"HistoricalLoader: {self.units_loaded + self.units_failed}/{total} units, {self.rows_loaded} rows, "
+                f"{self.rows_loaded / elapsed:.0f} rows/sec, {self.client.requests_sent} requests"
+            )
+
+    async def run(self, units) -> dict:
+        """
+        Load the units and return a summary.
+        """
+        self._started = time.perf_counter()
+        # Oldest first, the workers pop from the end
+        pending = sorted(units, key=lambda unit: unit.day, reverse=True)
+        total = len(pending)
+        report_task = asyncio.create_task(self._report(total))
+        try:
+            await asyncio.gather(*(self._work(pending) for _ in range(self.concurrency)))
+        finally:
+            report_task.cancel()
+        elapsed = time.perf_counter() - self._started
+        return {
+            'units': total,
+            'units_loaded': self.units_loaded,
+            'units_failed': self.units_failed,
+            'rows': self.rows_loaded,
+            'secs': round(elapsed, 3),
+            'rows_per_sec': round(self.rows_loaded / elapsed, 1) if elapsed else None,
+            'requests': self.client.requests_sent,
+            'requests_retried': self.client.requests_retried,
+        }
+
+async def load(args) -> dict:
+    if args.symbols:
+        symbols = sorted(set(args.symbols.split(',')))
+    else:
+        symbols = list(get_crypto_to_track() if args.asset == 'crypto' else get_stocks_to_track())
+
+    yesterday = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+    start_day = datetime.date.fromisoformat(args.start)
+    end_day = datetime.date.fromisoformat(args.end) if args.end else yesterday
+    if end_day > yesterday:
+        logger.warning(f"HistoricalLoader: today is not complete, loading until {yesterday}")
+        end_day = yesterday
+
+    interval = TIMEFRAMES[args.timeframe]
+    done = await asyncio.to_thread(load_checkpoints, symbols, start_day, end_day, interval)
+    units = plan_units(symbols, start_day, end_day, done, asset=args.asset)
+    logger.info(f"HistoricalLoader: {len(symbols)} symbols from {start_day} to {end_day}, {len(done)} symbol days loaded already, {len(units)} units to load")
+
+    loader = HistoricalLoader(HistoricalBarsClient(base_url=args.rest_url), asset=args.asset, timeframe=args.timeframe, concurrency=args.concurrency)
+    try:
+        return await loader.run(units)
+    finally:
+        loader.client.close()
+        await close_pools()
+
+def main():
+    parser = argparse.ArgumentParser(description='Load historical bars into stock_bars_historical.')
+    parser.add_argument('--symbols', help='Comma separated symbols. Default is the tracked symbols of --asset.', type=str, default=None)
+    parser.add_argument('--asset', help='stock or crypto. Default is stock.', choices=('stock', 'crypto'), default='stock')
+    parser.add_argument('--start', help='First day, YYYY-MM-DD.', type=str, required=True)
+    parser.add_argument('--end', help='Last day, YYYY-MM-DD. Default is yesterday.', type=str, default=None)
+    parser.add_argument('--timeframe', help='Bar length. Default is 1Min.', choices=sorted(TIMEFRAMES), default='1Min')
+    parser.add_argument('--concurrency', help=f"Units fetched and written at the same time. Default is {HISTORICAL_LOADER['CONCURRENCY']}.", type=int, default=HISTORICAL_LOADER['CONCURRENCY'])
+    parser.add_argument('--rest-url', help='Fetch from a local stub server, e.g. http://localhost:8766, instead of Alpaca. See helpers/rest_stub_server.py.', type=str, default=None)
+    args = parser.parse_args()
+
+    try:
+        summary = asyncio.run(load(args))
+    except KeyboardInterrupt:
+        logger.info("HistoricalLoader: interrupted, run again to resume")
+        return
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
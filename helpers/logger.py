@@ -1,54 +1,206 @@
+import atexit
+import glob
+import gzip
 import logging
-from datetime import datetime
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+from datetime import datetime, timedelta
 
-from resources.constants import FILE_PATHS
+from resources.constants import FILE_PATHS, LOGGING
 
 LOGGER_NAME = "market_stream"
 
+class DailyFileHandler(logging.FileHandler):
+    """
+    Writes to log_dir/<prefix>_YYYY-MM-DD.log and moves to the next file when the local date of a record
+    changes, so a process that runs for weeks still writes one file per day.
+
+    When the first file is opened and on every change of file, the files of days more than
+    compress_after_days before it are gzipped.  The day in between is left alone because other
+    processes, like the workers of --writer-processes, may still be writing to it.
+    """
+
+    def __init__(self, log_dir: str, prefix: str = 'app', compress_after_days: int = LOGGING['COMPRESS_AFTER_DAYS']):
+        self.log_dir = log_dir
+        self.prefix = prefix
+        self.compress_after_days = compress_after_days
+        self.date = None  # the first record opens the file of its day
+        super().__init__(self._path(datetime.now().date()), delay=True)
+
+    def _path(self, date) -> str:
+        return os.path.join(self.log_dir, f"{self.prefix}_{date.isoformat()}.log")
+
+    def emit(self, record) -> None:
+        date = datetime.fromtimestamp(record.created).date()
+        if date != self.date:
+            self.rollover(date)
+        super().emit(record)
+
+    def rollover(self, date) -> None:
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.date = date
+        self.baseFilename = os.path.abspath(self._path(date))
+        self.compress_old_files()
+
+    def compress_old_files(self) -> None:
+        oldest_plain = (self.date - timedelta(days=self.compress_after_days)).isoformat()
+        for path in glob.glob(os.path.join(self.log_dir, f"{self.prefix}_*.log")):
+            date = os.path.basename(path)[len(self.prefix) + 1:-len('.log')]
+            if date >= oldest_plain:
+                continue
+            try:
+                with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(path)
+            except OSError as e:
+                # Logging from here would come back to this handler
+                print(f"DailyFileHandler: cannot compress {path}: {e}")
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands the records to the listener thread as they are, so that the message, its arguments and any
+    traceback are formatted there and not on the websocket loop.  A record that does not fit in the
+    queue is dropped and counted instead of blocking the caller.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LazyFormat:
+    """
+    Calls func(*args) only when the log message is formatted, e.g.
+        logger.info('BAR_1MIN: %s', LazyFormat(bar_to_oneline_string, data))
+    """
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return self.func(*self.args)
+
+class LogSampler:
+    """
+    Decides which of a stream of similar messages, like one per bar, are logged.
+
+    INPUTS:
+        every: int - Log one message in every `every`, 1 logs them all.
+        per_second: float - Log at most this many messages a second, 0 for no limit.
+    sample(level) is False when no handler would log at level, when the message is not the one in
+    `every` or when the rate is used up.  The skipped messages are counted in suppressed.  The counters
+    are not locked; two threads sampling at once can only miscount by a message.
+    """
+
+    def __init__(self, every: int = LOGGING['SAMPLE_EVERY'], per_second: float = LOGGING['MAX_PER_SEC']):
+        self.every = max(1, every)
+        self.per_second = per_second
+        self.suppressed = 0
+        self._count = 0
+        self._tokens = per_second
+        self._last = time.monotonic()
+
+    def sample(self, level=logging.INFO) -> bool:
+        if level < _handler_level:
+            return False
+
+        self._count += 1
+        if self._count < self.every:
+            self.suppressed += 1
+            return False
+        self._count = 0
+
+        if self.per_second:
+            now = time.monotonic()
+            self._tokens = min(self.per_second, self._tokens + (now - self._last) * self.per_second)
+            self._last = now
+            if self._tokens < 1:
+                self.suppressed += 1
+                return False
+            self._tokens -= 1
+        return True
+
 def setup_logger(name: str, log_file: str, file_level=logging.INFO, console_level=logging.INFO) -> logging.Logger:
     """
     Set up a logger that outputs to both file and console with different levels.
 
     INPUTS:
         name (str): Name of the logger.
-        log_file (str): Path to the log file.
+        log_file (str): Path to the log file of today, a DailyFileHandler continues it with the files of the
+            following days.
         file_level (int): Logging level for the file handler (default: logging.INFO). See Log level options below.
         console_level (int): Logging level for the console handler (default: logging.INFO). See Log level options below.
     OUTPUT:
         logging.Logger: Configured logger instance.
 
+    The logger only puts the records on a queue.  A listener thread formats them and writes them to the
+    file and the console, so a slow disk or terminal never holds up the caller.
+
     When a log level is selected, all logs at this level and above will be sent to the corresponding handler.
     LOG LEVELS OPTIONS:
         logging.CRITICAL: A very serious error, indicating that the program itself may be unable to continue running.
         logging.ERROR: Due to a more serious problem, the software has not been able to perform some function.
         logging.WARNING: An indication that something unexpected happened, or indicative of some problem in the near future (e.g. ‘disk full’ warnings).
         logging.INFO: Confirmation that things are working as expected.
-        logging.DEBUG: Detailed information, typically of interest only when diagnosing problems.   
+        logging.DEBUG: Detailed information, typically of interest only when diagnosing problems.
     """
-    
+    global _listener
+
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)  # Set to lowest level to capture everything
+
+    # if the queue is set up already, keep it
+    if any(isinstance(handler, DeferredQueueHandler) for handler in logger.handlers):
+        return logger
+
     formatter = logging.Formatter(
         '%(asctime)s - %(levelname)s - %(message)s'
     )
 
-    # if there is not a file handler already, add one
-    if not any(isinstance(handler, logging.FileHandler) for handler in logger.handlers):
-        file_handler = logging.FileHandler(log_file)
-        file_handler.setLevel(file_level)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-    
-    # if there is not a console handler already, add one
-    # Note: Check for StreamHandler but exclude FileHandler (which is a subclass)
-    if not any(isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler) for handler in logger.handlers):
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(console_level)
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+    log_dir, log_name = os.path.split(log_file)
+    file_handler = DailyFileHandler(log_dir or '.', prefix=log_name.rsplit('_', 1)[0])
+    file_handler.setLevel(file_level)
+    file_handler.setFormatter(formatter)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(formatter)
+
+    queue_handler = DeferredQueueHandler(queue.Queue(LOGGING['QUEUE_SIZE']))
+    logger.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    # Write what is still queued when the program exits
+    atexit.register(_listener.stop)
+    _update_handler_level()
 
     return logger
 
+def _output_handlers() -> list:
+    return list(_listener.handlers) if _listener is not None else []
+
+def _update_handler_level() -> None:
+    # The lowest level any handler writes, LogSampler skips the messages below it
+    global _handler_level
+    levels = [handler.level for handler in _output_handlers()]
+    _handler_level = min(levels) if levels else logging.NOTSET
+
 def set_file_log_level(level_str: str) -> None:
     """
     Set the file log level for the existing logger instance.
@@ -56,22 +208,33 @@ def set_file_log_level(level_str: str) -> None:
     INPUTS:
         level_str (str): Log level as a string. Options are "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL".
     """
-    level_mapping = {
-        "DEBUG": logging.DEBUG,
-        "INFO": logging.INFO,
-        "WARNING": logging.WARNING,
-        "ERROR": logging.ERROR,
-        "CRITICAL": logging.CRITICAL
-    }
-
-    level = level_mapping.get(level_str.upper(), logging.INFO)
-
-    logger = logging.getLogger(LOGGER_NAME)
-    for handler in logger.handlers:
+    level = _LEVELS.get(level_str.upper(), logging.INFO)
+    for handler in _output_handlers():
         if isinstance(handler, logging.FileHandler):
             handler.setLevel(level)
+    _update_handler_level()
+
+def set_console_log_level(level_str: str) -> None:
+    """
+    Set the console log level for the existing logger instance, see set_file_log_level().
+    """
+    level = _LEVELS.get(level_str.upper(), logging.INFO)
+    for handler in _output_handlers():
+        if not isinstance(handler, logging.FileHandler):
+            handler.setLevel(level)
+    _update_handler_level()
+
+_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL
+}
+_listener = None
+_handler_level = logging.NOTSET
 
 # Create the logger instance once
-# File gets DEBUG and above, Console gets INFO and above (no debug to console)
+# File gets INFO and above, Console gets INFO and above (no debug to console)
 log_filename = f"app_{datetime.now().strftime('%Y-%m-%d')}.log"
-logger = setup_logger(LOGGER_NAME, FILE_PATHS['LOG_DIR'] + log_filename, file_level=logging.INFO, console_level=logging.INFO)
\ No newline at end of file
+logger = setup_logger(LOGGER_NAME, FILE_PATHS['LOG_DIR'] + log_filename, file_level=logging.INFO, console_level=logging.INFO)
@@ -0,0 +1,253 @@
+"""
+The trading sessions of the stock stream, with the market holidays and early closes.
+
+Alpaca streams stocks from 4:00 to 20:00 ET on trading days, and until 17:00 ET on the days the market
+closes early at 13:00.  MarketCalendar computes the open and close of every day of a year once, from
+data/market_calendar.json, and keeps them in a dict keyed by the day, so finding the session of a time is
+a dict lookup without a timezone conversion.  Years missing from the file fall back to every weekday,
+with a warning.  SessionScheduler sleeps until the next open or close instead of polling.
+
+Run the module to list the special days of a year and check the sessions around its DST changes:
+
+Usage:
+    python -m helpers.market_calendar
+    python -m helpers.market_calendar --year 2027
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import time
+
+import pytz
+
+from helpers.logger import logger
+from resources.constants import MARKET_CALENDAR
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# Every session lies between 4:00 and 20:00 ET, so during a session the UTC day of (time - 5 hours) is
+# its day in ET whether it is EST (UTC-5) or EDT (UTC-4)
+SESSION_DAY_SHIFT_SEC = 5 * 3600
+
+def _time_of_day(value: str) -> datetime.time:
+    hour, minute = value.split(':')
+    return datetime.time(int(hour), int(minute))
+
+class Session:
+    __slots__ = ('day', 'open', 'close', 'early_close')
+
+    def __init__(self, day, open, close, early_close=False):
+        self.day = day
+        self.open = open  # epoch seconds
+        self.close = close
+        self.early_close = early_close
+
+    def __repr__(self):
+        open = datetime.datetime.fromtimestamp(self.open, datetime.timezone.utc)
+        close = datetime.datetime.fromtimestamp(self.close, datetime.timezone.utc)
+        early = ", early close" if self.early_close else ""
+        return f"{self.day} session from {open:%H:%M} to {close:%H:%M} UTC{early}"
+
+class MarketCalendar:
+    """
+    INPUTS:
+        path: str - The JSON file of the holidays and early closes.
+        year: int - The year computed at once, the current year by default.  Other years are computed
+            when they are first looked up.
+    """
+
+    def __init__(self, path=MARKET_CALENDAR['PATH'], year=None):
+        with open(path) as f:
+            data = json.load(f)
+        self.timezone = pytz.timezone(MARKET_CALENDAR['TIMEZONE'])
+        self.years = set(data['years'])
+        self.holidays = {datetime.date.fromisoformat(day): name for day, name in data['holidays'].items()}
+        self.early_closes = {datetime.date.fromisoformat(day): name for day, name in data['early_closes'].items()}
+        self._open = _time_of_day(MARKET_CALENDAR['OPEN'])
+        self._close = _time_of_day(MARKET_CALENDAR['CLOSE'])
+        self._early_close = _time_of_day(MARKET_CALENDAR['EARLY_CLOSE'])
+        self._sessions = {}  # day ordinal: Session, None for days without a session
+        self._build(year or datetime.datetime.now(self.timezone).year)
+
+    def _epoch(self, day, time_of_day) -> float:
+        return self.timezone.localize(datetime.datetime.combine(day, time_of_day)).timestamp()
+
+    def _build(self, year) -> None:
+        if year not in self.years:
+            logger.warning(f"MarketCalendar: no holidays for {year} in {MARKET_CALENDAR['PATH']}, every weekday is a trading day")
+        day = datetime.date(year, 1, 1)
+        while day.year == year:
+            session = None
+            if day.weekday() < 5 and day not in self.holidays:
+                early_close = day in self.early_closes
+                session = Session(day, self._epoch(day, self._open), self._epoch(day, self._early_close if early_close else self._close), early_close)
+            self._sessions[day.toordinal()] = session
+            day += datetime.timedelta(days=1)
+
+    def _session(self, ordinal):
+        try:
+            return self._sessions[ordinal]
+        except KeyError:
+            self._build(datetime.date.fromordinal(ordinal).year)
+            return self._sessions[ordinal]
+
+    def session(self, day: datetime.date):
+        """
+        Returns the Session of a day in ET, None when the market is closed that day.
+        """
+        return self._session(day.toordinal())
+
+    def session_at(self, now=None):
+        """
+        Returns the Session that now, epoch seconds, is in, None outside of the sessions.
+        """
+        now = time.time() if now is None else now
+        session = self._session(EPOCH_ORDINAL + int((now - SESSION_DAY_SHIFT_SEC) // 86400))
+        if session is not None and session.open <= now < session.close:
+            return session
+        return None
+
+    def is_open(self, now=None) -> bool:
+        return self.session_at(now) is not None
+
+    def next_session(self, now=None):
+        """
+        Returns the Session that now is in or the next one to open.
+        """
+        now = time.time() if now is None else now
+        ordinal = EPOCH_ORDINAL + int((now - SESSION_DAY_SHIFT_SEC) // 86400)
+        # A long weekend with a holiday is the longest stretch without a session
+        for offset in range(MARKET_CALENDAR['MAX_DAYS_CLOSED'] + 1):
+            session = self._session(ordinal + offset)
+            if session is not None and now < session.close:
+                return session
+        raise ValueError(f"MarketCalendar: no session within {MARKET_CALENDAR['MAX_DAYS_CLOSED']} days of {now}")
+
+class SessionScheduler:
+    """
+    Waits for the opens and closes of a MarketCalendar.
+
+    A wait sleeps until the time of the change, in steps of at most MAX_SLEEP_SEC so that a change of
+    the system clock is noticed.
+    """
+
+    def __init__(self, calendar: MarketCalendar, max_sleep=MARKET_CALENDAR['MAX_SLEEP_SEC']):
+        self.calendar = calendar
+        self.max_sleep = max_sleep
+
+    async def sleep_until(self, when: float) -> None:
+        while (delay := when - time.time()) > 0:
+            await asyncio.sleep(min(delay, self.max_sleep))
+
+    async def wait_for_open(self):
+        """
+        Returns the Session at its open, at once when it is open already.
+        """
+        session = self.calendar.next_session()
+        await self.sleep_until(session.open)
+        return session
+
+    async def wait_for_close(self, timeout=None) -> bool:
+        """
+        Returns True at the close of the current session, at once when the market is closed, or False
+        after timeout seconds.
+        """
+        session = self.calendar.session_at()
+        if session is None:
+            return True
+        if timeout is not None and time.time() + timeout < session.close:
+            await self.sleep_until(time.time() + timeout)
+            return False
+        await self.sleep_until(session.close)
+        return True
+
+    async def run_during_sessions(self, supervisor, exit_off_hours=False) -> None:
+        """
+        Start a StreamSupervisor at every open and stop it at every close, until cancelled.  With
+        exit_off_hours it returns at the first close instead.
+        """
+        while True:
+            if not self.calendar.is_open():
+                # If the client is running, stop the client
+                if supervisor.running:
+                    str_tmp = "temporarily" if not exit_off_hours else ""
+                    logger.info(f"Trading hours have ended. Closing {supervisor.asset} stream connection {str_tmp}...")
+                    await supervisor.stop()
+                    if exit_off_hours:
+                        return
+                session = self.calendar.next_session()
+                logger.info(f"Currently outside of trading hours. {supervisor.asset.capitalize()} stream connection is closed until the {session}.")
+                await self.wait_for_open()
+
+            # Start the client, the supervisor restarts it if it stops during the session
+            if not supervisor.running:
+                logger.info(f"Starting the {supervisor.asset} stream...")
+                supervisor.start()
+            await self.wait_for_close()
+
+def _dst_changes(calendar, year) -> list:
+    changes = []
+    day = datetime.date(year, 1, 1)
+    offset = calendar.timezone.utcoffset(datetime.datetime.combine(day, datetime.time(12)))
+    while day.year == year:
+        day_offset = calendar.timezone.utcoffset(datetime.datetime.combine(day, datetime.time(12)))
+        if day_offset != offset:
+            changes.append(day)
+            offset = day_offset
+        day += datetime.timedelta(days=1)
+    return changes
+
+def check(calendar, year) -> int:
+    """
+    Check the sessions around the DST changes and the special days of a year.  Returns the number of
+    failed checks.
+    """
+    failures = 0
+
+    def expect(description, condition):
+        nonlocal failures
+        if not condition:
+            failures += 1
+        print(f"{'ok  ' if condition else 'FAIL'} {description}")
+
+    for change in _dst_changes(calendar, year):
+        # The session before and after the change, they are an hour apart in UTC
+        before = calendar.next_session(calendar._epoch(change - datetime.timedelta(days=3), datetime.time()))
+        after = calendar.next_session(calendar._epoch(change, datetime.time()))
+        for session in (before, after):
+            local_open = datetime.datetime.fromtimestamp(session.open, calendar.timezone)
+            local_close = datetime.datetime.fromtimestamp(session.close, calendar.timezone)
+            expect(f"{session}: {local_open:%H:%M} to {local_close:%H:%M} ET",
+                   local_open.time() == calendar._open and local_close.time() in (calendar._close, calendar._early_close))
+            expect(f"{session.day}: open one second after the open and closed one second before it and at the close",
+                   calendar.is_open(session.open + 1) and not calendar.is_open(session.open - 1) and not calendar.is_open(session.close))
+        shift = (after.open - before.open) % 86400
+        expect(f"{change}: the open moves by an hour in UTC", shift in (3600, 86400 - 3600))
+
+    for day, name in sorted(calendar.holidays.items()):
+        if day.year == year:
+            expect(f"{day} {name}: no session", calendar.session(day) is None and not calendar.is_open(calendar._epoch(day, datetime.time(12))))
+    for day, name in sorted(calendar.early_closes.items()):
+        if day.year == year:
+            session = calendar.session(day)
+            expect(f"{session} {name}: closed at {MARKET_CALENDAR['EARLY_CLOSE']} ET",
+                   session.early_close and not calendar.is_open(calendar._epoch(day, calendar._early_close)))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the trading sessions of a year.')
+    parser.add_argument('--year', help='Default is the current year.', type=int, default=None)
+    args = parser.parse_args()
+
+    calendar = MarketCalendar(year=args.year)
+    year = args.year or datetime.datetime.now(calendar.timezone).year
+    days = (datetime.date(year + 1, 1, 1) - datetime.date(year, 1, 1)).days
+    trading_days = sum(1 for offset in range(days) if calendar.session(datetime.date(year, 1, 1) + datetime.timedelta(days=offset)) is not None)
+    print(f"{year}: {trading_days} trading days, DST changes on {', '.join(map(str, _dst_changes(calendar, year)))}")
+    failures = check(calendar, year)
+    print(f"{failures} checks failed")
+    raise SystemExit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Counters and histograms of the ingest, served in the Prometheus text format.
+
+Nothing is measured until enable() or start_http_server() is called: every recording function checks
+one module flag and returns, so the handlers pay for a function call and nothing else.  Queue depths,
+writer totals and pool usage are read when /metrics is scraped instead of being updated by the writers.
+
+    market_stream_messages_total{channel, asset}         bars, updated bars and trades received
+    market_stream_write_lag_seconds{writer}              exchange timestamp of a 1 min bar or trade to its commit
+    market_stream_db_seconds{function}                   time spent in the database functions
+    market_stream_db_errors_total{function}              database functions that raised
+    market_stream_stream_starts_total{asset}             run_wss_client calls
+    market_stream_stream_errors_total{asset, error}      streams that ended with an error
+    market_stream_stream_reconnects_total{asset}         reconnects of the raw client after a websocket error
+    market_stream_stream_recovery_seconds{asset}         drop of a stream to its next successful connect
+    market_stream_event_loop_lag_seconds{loop}           delay before a callback runs on a busy event loop
+    market_stream_bar_updates_saved_total{reason}        corrected bars not written, superseded or duplicate
+    market_stream_writer_queue_depth{writer}             rows queued in the batch writers
+    market_stream_writer_rows_total{writer, outcome}     rows written, spooled or failed
+    market_stream_db_pool_connections{pool, state}       connections in the pools and how many are idle
+
+Usage:
+    metrics.start_http_server(9108)
+    $ curl localhost:9108/metrics
+"""
+
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helpers.db_pool import pool_stats
+from helpers.logger import logger
+from resources.constants import METRICS
+
+enabled = False
+
+_registry = []
+_writers = []
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(names, values, extra='') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.function = function
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self):
+        # (suffix, label values, extra label, value)
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for label_values, value in values.items():
+                yield '', label_values, '', value
+            return
+        for label_values, child in list(self._children.items()):
+            yield from child.samples(label_values)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, label_values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_label_text(self.labelnames, label_values, extra)} {_number(value)}")
+        return '\n'.join(lines)
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def samples(self, label_values):
+        yield '', label_values, '', self.value
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, label_values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            yield '_bucket', label_values, f'le="{_number(bound)}"', cumulative
+        yield '_sum', label_values, '', total
+        yield '_count', label_values, '', cumulative
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=METRICS['LATENCY_BUCKETS']):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+def _writer_queue_depths():
+    return {(writer.name,): writer.qsize() for writer in _writers}
+
+def _writer_rows():
+    rows = {}
+    for writer in _writers:
+        rows[(writer.name, 'written')] = writer.rows_written
+        rows[(writer.name, 'spooled')] = writer.rows_spooled
+        rows[(writer.name, 'failed')] = writer.rows_failed
+    return rows
+
+def _pool_connections():
+    connections = {}
+    for pool, stats in pool_stats().items():
+        connections[(pool, 'size')] = stats.get('pool_size', 0)
+        connections[(pool, 'available')] = stats.get('pool_available', 0)
+    return connections
+
+MESSAGES = Counter('market_stream_messages_total', 'Messages received by the handlers.', ('channel', 'asset'))
+WRITE_LAG = Histogram('market_stream_write_lag_seconds', 'Exchange timestamp of a 1 min bar or a trade to the commit of its row.', ('writer',), buckets=METRICS['LAG_BUCKETS'])
+DB_SECONDS = Histogram('market_stream_db_seconds', 'Time spent in the database functions.', ('function',))
+DB_ERRORS = Counter('market_stream_db_errors_total', 'Database functions that raised.', ('function',))
+STREAM_STARTS = Counter('market_stream_stream_starts_total', 'Websocket clients started by run_wss_client.', ('asset',))
+STREAM_ERRORS = Counter('market_stream_stream_errors_total', 'Websocket clients that stopped with an error.', ('asset', 'error'))
+STREAM_RECONNECTS = Counter('market_stream_stream_reconnects_total', 'Reconnects of the raw client after a websocket error.', ('asset',))
+STREAM_RECOVERY = Histogram('market_stream_stream_recovery_seconds', 'Drop of a stream, or its first failed connect, to its next successful connect.', ('asset',), buckets=METRICS['RECOVERY_BUCKETS'])
+LOOP_LAG = Histogram('market_stream_event_loop_lag_seconds', 'Delay before a callback scheduled on an event loop runs.', ('loop',))
+UPDATES_SAVED = Counter('market_stream_bar_updates_saved_total', 'Corrected bars not written by the update coalescer.', ('reason',))
+QUEUE_DEPTH = Gauge('market_stream_writer_queue_depth', 'Rows queued in the batch writers.', ('writer',), function=_writer_queue_depths)
+WRITER_ROWS = Counter('market_stream_writer_rows_total', 'Rows handled by the batch writers.', ('writer', 'outcome'), function=_writer_rows)
+POOL_CONNECTIONS = Gauge('market_stream_db_pool_connections', 'Connections of the database pools.', ('pool', 'state'), function=_pool_connections)
+
+def render() -> str:
+    """
+    Returns all metrics in the Prometheus text format.
+    """
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+def count_message(channel: str, symbol: str) -> None:
+    if not enabled:
+        return
+    MESSAGES.labels(channel, 'crypto' if '/' in symbol else 'stock').inc()
+
+def observe_write_lag(writer: str, timestamps) -> None:
+    """
+    Record the time from each exchange timestamp, None for rows without one, to now.
+    """
+    if not enabled:
+        return
+    now = time.time()
+    histogram = WRITE_LAG.labels(writer)
+    for timestamp in timestamps:
+        if timestamp is not None:
+            histogram.observe(now - timestamp.timestamp())
+
+def count_stream_start(asset: str) -> None:
+    if enabled:
+        STREAM_STARTS.labels(asset).inc()
+
+def count_stream_error(asset: str, error: str) -> None:
+    if enabled:
+        STREAM_ERRORS.labels(asset, error).inc()
+
+def count_reconnect(asset: str) -> None:
+    if enabled:
+        STREAM_RECONNECTS.labels(asset).inc()
+
+def observe_stream_recovery(asset: str, seconds: float) -> None:
+    if enabled:
+        STREAM_RECOVERY.labels(asset).observe(seconds)
+
+def count_saved_update(reason: str) -> None:
+    if enabled:
+        UPDATES_SAVED.labels(reason).inc()
+
+def watch_writer(*writers) -> None:
+    """
+    Report the queue depth and row totals of BatchWriters.
+    """
+    _writers.extend(writers)
+
+def timed(func):
+    """
+    Decorator for the database functions, records their duration and errors under their name.
+    """
+    name = func.__name__
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not enabled:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                DB_ERRORS.labels(name).inc()
+                raise
+            finally:
+                DB_SECONDS.labels(name).observe(time.perf_counter() - start)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.labels(name).inc()
+            raise
+        finally:
+            DB_SECONDS.labels(name).observe(time.perf_counter() - start)
+    return wrapper
+
+def _record_loop_lag(name, scheduled) -> None:
+    LOOP_LAG.labels(name).observe(time.perf_counter() - scheduled)
+
+async def monitor_loops(get_loops, interval=METRICS['LOOP_LAG_INTERVAL_SEC']) -> None:
+    """
+    Measure how long callbacks wait on the event loops, which is how long the loops are stalled.
+
+    INPUTS:
+        get_loops: callable - Returns (name, loop) pairs, loops that are None or not running are skipped.
+        interval: float - Seconds between measurements.
+    Returns at once when metrics are not enabled.
+    """
+    if not enabled:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        for name, loop in get_loops():
+            if loop is not None and loop.is_running():
+                loop.call_soon_threadsafe(_record_loop_lag, name, time.perf_counter())
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port: int, host: str = METRICS['HOST']) -> ThreadingHTTPServer:
+    """
+    Enable the metrics and serve them on http://host:port/metrics from a daemon thread.
+    """
+    enable()
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"metrics: serving on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,324 @@
+"""
+Run the websocket clients and the database writes in separate processes.
+
+    receiver processes, one per asset: run the websocket client, turn every bar and trade into a plain
+        tuple and send it to the writer process of its symbol.  They never touch the database except
+        to read the watchlist.  A StreamSupervisor reconnects and restarts the client, and the stock
+        client only runs during the sessions of the market calendar, like in main.py.  A GapDetector
+        and a BackfillWorker fetch the minutes missed during an outage, the bars are sent as corrections.
+    writer processes, --writer-processes of them: each has its own BarWriter, TradeWriter,
+        UpdateCoalescer and aggregators and writes the symbols of its shard.  A symbol always goes to the
+        same writer over one queue, so its bars and trades are written in the order they were received.
+    the supervisor, the main process: starts the processes and starts them again when they die, with a
+        delay that grows while they keep dying.  On shutdown it sets the stop event of the receivers,
+        which flush what they hold for the writers and exit, and only then tells the writers to stop.
+
+Records are sent in batches of SHARD_BATCH_SIZE over multiprocessing queues.  Each writer process has
+its own spool directories, spool/bars_<n>/ and spool/trades_<n>/, which a restarted writer replays.
+"""
+
+import asyncio
+import multiprocessing
+import threading
+import time
+import zlib
+
+from helpers.bar_aggregator import BarAggregator
+from helpers.bar_writer import BarWriter
+from helpers.database import get_stocks_to_track, get_crypto_to_track
+from helpers.datastream_helper import get_wss_url
+from helpers.db_pool import close_pools
+from helpers.env import API_KEY, API_SECRET
+from helpers.gap_backfill import GapDetector, BackfillWorker
+from helpers.historical_bars import HistoricalBarsClient
+from helpers.logger import logger
+from helpers.market_calendar import MarketCalendar, SessionScheduler
+from helpers.raw_stream import RawDataStream, BarRecord, TradeRecord
+from helpers.stream_supervisor import StreamSupervisor
+from helpers.subscription_manager import SubscriptionManager
+from helpers.trade_bar_aggregator import TradeBarAggregator
+from helpers.trade_writer import TradeWriter
+from helpers.update_coalescer import UpdateCoalescer
+from resources.constants import MULTIPROCESS, FILE_PATHS
+
+CHECK_FREQUENCY = 300  # seconds between watchlist checks in the receivers
+
+def shard(symbol: str, shards: int) -> int:
+    """
+    Returns the writer of a symbol.  crc32 is the same in every process, unlike hash().
+    """
+    return zlib.crc32(symbol.encode()) % shards
+
+class ShardedSender:
+    """
+    The handlers of a receiver process, they send the records to the writer queues in batches.
+    """
+
+    def __init__(self, queues, batch_size=MULTIPROCESS['SHARD_BATCH_SIZE'], flush_interval=MULTIPROCESS['SHARD_FLUSH_INTERVAL_SEC']):
+        self.queues = queues
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.records_sent = 0
+        self.gap_detector = None  # notes the time of every bar when set
+        self._batches = [[] for _ in queues]
+        self._lock = threading.Lock()
+
+    def send(self, symbol, record) -> None:
+        index = shard(symbol, len(self.queues))
+        with self._lock:
+            batch = self._batches[index]
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self._flush(index)
+
+    def _flush(self, index) -> None:
+        batch = self._batches[index]
+        if batch:
+            self._batches[index] = []
+            # Blocks while the writer is behind, like a full BatchWriter queue does
+            self.queues[index].put(batch)
+            self.records_sent += len(batch)
+
+    def flush(self) -> None:
+        with self._lock:
+            for index in range(len(self.queues)):
+                self._flush(index)
+
+    async def bar_handler(self, data):
+        if self.gap_detector is not None:
+            self.gap_detector.observe(data)
+        self.send(data.symbol, ('b', data.symbol, data.timestamp, data.open, data.high, data.low, data.close, data.volume, data.trade_count, data.vwap))
+
+    async def updated_bar_handler(self, data):
+        self.send(data.symbol, ('u', data.symbol, data.timestamp, data.open, data.high, data.low, data.close, data.volume, data.trade_count, data.vwap))
+
+    async def trade_handler(self, data):
+        exchange = getattr(data.exchange, 'value', data.exchange)
+        self.send(data.symbol, ('t', data.symbol, data.timestamp, exchange, data.price, data.size, data.id, data.conditions, data.tape))
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.to_thread(self.flush)
+
+def _make_client(asset, config):
+    url = get_wss_url(asset, testing=config['testing'], base_url=config['replay_url'])
+    if config['raw_stream']:
+        return RawDataStream(API_KEY, API_SECRET, url, asset=asset)
+    from alpaca.data.live import StockDataStream, CryptoDataStream
+    if asset == 'stock':
+        return StockDataStream(API_KEY, API_SECRET, url_override=url)
+    return CryptoDataStream(API_KEY, API_SECRET, url_override=url)
+
+def _run_client(client, asset) -> None:
+    # Run by the StreamSupervisor in a thread, which restarts the client when this returns
+    try:
+        client.run()
+    except Exception as e:
+        logger.error(f"receiver {asset}: the stream ended with an error: {e}")
+
+async def _receive(asset, queues, config, stop_event) -> None:
+    sender = ShardedSender(queues)
+    get_symbols = get_stocks_to_track if asset == 'stock' else get_crypto_to_track
+    symbols = get_symbols()
+
+    client = _make_client(asset, config)
+    channels = {'bars': sender.bar_handler, 'updatedBars': sender.updated_bar_handler}
+    client.subscribe_bars(sender.bar_handler, *symbols)
+    client.subscribe_updated_bars(sender.updated_bar_handler, *symbols)
+    if asset == 'stock' and config['trades']:
+        channels['trades'] = sender.trade_handler
+        client.subscribe_trades(sender.trade_handler, *symbols)
+    manager = SubscriptionManager(client, channels, symbols=symbols, name=asset)
+
+    async def update_symbols():
+        while True:
+            await asyncio.sleep(CHECK_FREQUENCY)
+            await manager.update(get_symbols())
+
+    async def wait_for_stop():
+        while not stop_event.is_set():
+            await asyncio.sleep(MULTIPROCESS['STOP_CHECK_SEC'])
+
+    supervisor = StreamSupervisor(client, asset, _run_client)
+    # The bars missed during an outage are written over stock_bars like corrections
+    gap_detector = GapDetector()
+    gap_detector.watch(supervisor)
+    sender.gap_detector = gap_detector
+    backfill_worker = BackfillWorker(gap_detector, HistoricalBarsClient(base_url=config['rest_url']), sender.updated_bar_handler)
+    tasks = [supervisor.run(start=asset != 'stock'), sender.run(), update_symbols(), gap_detector.run(), backfill_worker.run()]
+    if asset == 'stock':
+        tasks.append(SessionScheduler(MarketCalendar()).run_during_sessions(supervisor))
+    work = asyncio.ensure_future(asyncio.gather(*tasks))
+    stop = asyncio.ensure_future(wait_for_stop())
+
+    logger.info(f"receiver {asset}: sending {len(symbols)} symbols to {len(queues)} writers")
+    try:
+        await asyncio.wait((work, stop), return_when=asyncio.FIRST_COMPLETED)
+        if work.done():
+            # Raises the error that ended the receiver, the IngestSupervisor starts it again
+            work.result()
+    finally:
+        for future in (work, stop):
+            future.cancel()
+        await asyncio.gather(work, stop, return_exceptions=True)
+        # Stops the client from this loop, asyncio.run() then waits for the thread that runs it
+        await supervisor.stop()
+        # The writers keep reading until the receivers exited, what was received is not lost
+        sender.flush()
+        logger.info(f"receiver {asset}: stopped, {sender.records_sent} records sent")
+
+def receiver_main(asset, queues, config, stop_event) -> None:
+    """
+    Entry point of a receiver process, it returns after stop_event is set.
+    """
+    try:
+        asyncio.run(_receive(asset, queues, config, stop_event))
+    except KeyboardInterrupt:
+        pass
+
+async def _write(index, queue, config) -> None:
+    bar_writer = BarWriter(spool_dir=f"{FILE_PATHS['SPOOL_DIR']}bars_{index}")
+    trade_writer = TradeWriter(spool_dir=f"{FILE_PATHS['SPOOL_DIR']}trades_{index}")
+    bar_writer.name = f"BarWriter {index}"
+    trade_writer.name = f"TradeWriter {index}"
+    trade_writer.flush_interval = config['trade_flush_interval']
+    bar_aggregator = BarAggregator(bar_writer)
+    trade_bar_aggregator = TradeBarAggregator(bar_writer)
+
+    async def write_corrected_bar(bar):
+        await bar_writer.put(bar, update=True)
+        await bar_aggregator.add(bar, update=True)
+
+    update_coalescer = UpdateCoalescer(write_corrected_bar)
+    # The coalescer first, it flushes into bar_writer when cancelled
+    tasks = [asyncio.create_task(task) for task in (update_coalescer.run(), bar_writer.run(), trade_writer.run(), bar_aggregator.run(), trade_bar_aggregator.run())]
+
+    loop = asyncio.get_running_loop()
+    logger.info(f"writer {index}: started")
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, queue.get)
+            if batch is None:
+                break
+            for record in batch:
+                kind = record[0]
+                if kind == 't':
+                    trade = TradeRecord(*record[1:])
+                    await trade_writer.put(trade)
+                    await trade_bar_aggregator.add(trade)
+                elif kind == 'u':
+                    update_coalescer.add(BarRecord(*record[1:]))
+                else:
+                    bar = BarRecord(*record[1:])
+                    update_coalescer.remember(bar)
+                    await bar_writer.put(bar)
+                    await bar_aggregator.add(bar)
+    finally:
+        # The writers flush what they hold when cancelled
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await close_pools()
+        logger.info(f"writer {index}: stopped")
+
+def writer_main(index, queue, config) -> None:
+    """
+    Entry point of a writer process, it returns after None is read from its queue.
+    """
+    try:
+        asyncio.run(_write(index, queue, config))
+    except KeyboardInterrupt:
+        pass
+
+class Worker:
+    __slots__ = ('name', 'target', 'args', 'process', 'started', 'restarts')
+
+    def __init__(self, name, target, args):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.started = 0
+        self.restarts = 0
+
+class IngestSupervisor:
+    """
+    Starts the receiver and writer processes and keeps them running.
+
+    INPUTS:
+        writers: int - Number of writer processes.
+        config: dict - testing, replay_url, rest_url, raw_stream, trades and trade_flush_interval, as set by main.py.
+    """
+
+    def __init__(self, writers: int, config: dict):
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue(maxsize=MULTIPROCESS['QUEUE_SIZE']) for _ in range(writers)]
+        self.stop_event = self._context.Event()
+        self.writers = [Worker(f"writer {index}", writer_main, (index, queue, config)) for index, queue in enumerate(self.queues)]
+        self.receivers = [Worker(f"receiver {asset}", receiver_main, (asset, self.queues, config, self.stop_event)) for asset in ('stock', 'crypto')]
+
+    def _start(self, worker) -> None:
+        worker.process = self._context.Process(target=worker.target, args=worker.args, name=worker.name, daemon=True)
+        worker.process.start()
+        worker.started = time.monotonic()
+        logger.info(f"IngestSupervisor: started {worker.name} (pid {worker.process.pid})")
+
+    def _restart_delay(self, worker) -> float:
+        # A worker that ran for a while starts over at 1 second
+        if time.monotonic() - worker.started > MULTIPROCESS['MAX_RESTART_DELAY_SEC']:
+            worker.restarts = 0
+        return min(2 ** worker.restarts, MULTIPROCESS['MAX_RESTART_DELAY_SEC'])
+
+    def run(self) -> None:
+        """
+        Run until interrupted, then stop the receivers and let the writers flush.
+        """
+        workers = self.writers + self.receivers
+        restart_at = {}
+        for worker in workers:
+            self._start(worker)
+        try:
+            while True:
+                time.sleep(MULTIPROCESS['SUPERVISE_FREQUENCY_SEC'])
+                now = time.monotonic()
+                for worker in workers:
+                    if worker.process.is_alive():
+                        continue
+                    if worker.name not in restart_at:
+                        delay = self._restart_delay(worker)
+                        logger.error(f"IngestSupervisor: {worker.name} exited with code {worker.process.exitcode}, restarting in {delay} secs")
+                        restart_at[worker.name] = now + delay
+                    elif now >= restart_at[worker.name]:
+                        del restart_at[worker.name]
+                        worker.restarts += 1
+                        self._start(worker)
+        except KeyboardInterrupt:
+            logger.info("IngestSupervisor: interrupted")
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        # Receivers first, so that the writers get everything that was received.  They flush their
+        # batches to the writer queues before they exit, which needs the writers to still be reading
+        self.stop_event.set()
+        deadline = time.monotonic() + MULTIPROCESS['SHUTDOWN_TIMEOUT_SEC']
+        for worker in self.receivers:
+            if worker.process is not None:
+                worker.process.join(max(0, deadline - time.monotonic()))
+                if worker.process.is_alive():
+                    logger.error(f"IngestSupervisor: {worker.name} did not stop in time, terminating it")
+                    worker.process.terminate()
+                    worker.process.join(5)
+
+        for worker, queue in zip(self.writers, self.queues):
+            if worker.process is not None and worker.process.is_alive():
+                queue.put(None)
+        deadline = time.monotonic() + MULTIPROCESS['SHUTDOWN_TIMEOUT_SEC']
+        for worker in self.writers:
+            if worker.process is not None:
+                worker.process.join(max(0, deadline - time.monotonic()))
+                if worker.process.is_alive():
+                    logger.error(f"IngestSupervisor: {worker.name} did not stop in time, terminating it")
+                    worker.process.terminate()
+        logger.info("IngestSupervisor: stopped")
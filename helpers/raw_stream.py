@@ -0,0 +1,237 @@
+"""
+A lean client for Alpaca's market data websocket, built on websockets like test_socket in datastream_helper.py.
+
+alpaca-py's DataStream builds a pydantic Bar or Trade for every message.  RawDataStream decodes the msgpack
+frames with timestamps converted by msgpack itself and hands the handlers small __slots__ records with the
+same attribute names, so bar_to_row, trade_to_row and bar_to_oneline_string work on them unchanged.
+
+It has the parts of the DataStream interface that main.py uses: subscribe_* and unsubscribe_* for bars,
+updated bars and trades, run(), stop_ws(), stop() and _running.
+"""
+
+import asyncio
+import datetime
+import json
+
+import msgpack
+import websockets
+from websockets.asyncio.client import connect
+
+from helpers import metrics
+from helpers.logger import logger
+
+RECONNECT_DELAY_SEC = 1
+MAX_FRAME_SIZE = 32768  # bytes per subscribe message, like the alpaca-py clients
+MAX_RECONNECT_DELAY_SEC = 30
+
+class BarRecord:
+    __slots__ = ('symbol', 'timestamp', 'open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap')
+
+    def __init__(self, symbol, timestamp, open, high, low, close, volume, trade_count, vwap):
+        self.symbol = symbol
+        self.timestamp = timestamp
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.trade_count = trade_count
+        self.vwap = vwap
+
+    def __repr__(self):
+        return (f"symbol='{self.symbol}' timestamp={self.timestamp!r} open={self.open} high={self.high} low={self.low} "
+                f"close={self.close} volume={self.volume} trade_count={self.trade_count} vwap={self.vwap}")
+
+class TradeRecord:
+    __slots__ = ('symbol', 'timestamp', 'exchange', 'price', 'size', 'id', 'conditions', 'tape')
+
+    def __init__(self, symbol, timestamp, exchange, price, size, id, conditions, tape):
+        self.symbol = symbol
+        self.timestamp = timestamp
+        self.exchange = exchange
+        self.price = price
+        self.size = size
+        self.id = id
+        self.conditions = conditions
+        self.tape = tape
+
+    def __repr__(self):
+        return (f"symbol='{self.symbol}' timestamp={self.timestamp!r} exchange='{self.exchange}' price={self.price} "
+                f"size={self.size} id={self.id} conditions={self.conditions} tape='{self.tape}'")
+
+def _bar_record(msg) -> BarRecord:
+    return BarRecord(msg['S'], msg['t'], msg['o'], msg['h'], msg['l'], msg['c'], msg['v'], msg.get('n'), msg.get('vw'))
+
+def _trade_record(msg) -> TradeRecord:
+    return TradeRecord(msg['S'], msg['t'], msg.get('x'), msg['p'], msg['s'], msg.get('i'), msg.get('c'), msg.get('z'))
+
+# Message type: (channel, record builder)
+MESSAGE_TYPES = {
+    'b': ('bars', _bar_record),
+    'u': ('updatedBars', _bar_record),
+    't': ('trades', _trade_record),
+}
+
+def _decode(frame):
+    if isinstance(frame, bytes):
+        # timestamp=3 makes msgpack return timezone aware datetimes
+        return msgpack.unpackb(frame, timestamp=3)
+    msgs = json.loads(frame)
+    for msg in msgs:
+        if 't' in msg and isinstance(msg['t'], str):
+            msg['t'] = datetime.datetime.fromisoformat(msg['t'].replace('Z', '+00:00'))
+    return msgs
+
+class RawDataStream:
+    """
+    Stream bars, updated bars and trades from an Alpaca market data websocket url.
+
+    INPUTS:
+        api_key, secret_key: str - Alpaca API key ID and secret.
+        url: str - e.g. get_wss_url('crypto').
+        asset: str - 'stock' or 'crypto'.
+    The connection is reopened with a growing delay when it drops, and the subscriptions are sent again.
+    A StreamSupervisor sets supervised and waits its own delay instead.
+    """
+
+    def __init__(self, api_key, secret_key, url, asset='stock'):
+        self._api_key = api_key
+        self._secret_key = secret_key
+        self._endpoint = url
+        self.asset = asset
+        self._handlers = {channel: {} for channel, _ in MESSAGE_TYPES.values()}
+        self._max_frame_size = MAX_FRAME_SIZE
+        self._ws = None
+        self._loop = None
+        self._running = False
+        self._should_run = True
+        self.supervised = False
+
+    async def _connect(self) -> None:
+        self._ws = await connect(
+            self._endpoint,
+            additional_headers={'Content-Type': 'application/msgpack'},
+            ping_interval=10,
+            ping_timeout=180,
+            max_size=None
+        )
+        msg = _decode(await self._ws.recv())
+        if msg[0]['T'] != 'success' or msg[0].get('msg') != 'connected':
+            raise ValueError('connected message not received')
+
+    async def _auth(self) -> None:
+        await self._ws.send(msgpack.packb({'action': 'auth', 'key': self._api_key, 'secret': self._secret_key}))
+        msg = _decode(await self._ws.recv())
+        if msg[0]['T'] == 'error':
+            raise ValueError(msg[0].get('msg', 'auth failed'))
+        if msg[0]['T'] != 'success' or msg[0].get('msg') != 'authenticated':
+            raise ValueError('failed to authenticate')
+
+    async def _send(self, action, channels) -> None:
+        channels = {channel: list(symbols) for channel, symbols in channels.items() if symbols}
+        if channels and self._ws is not None:
+            await self._ws.send(msgpack.packb(dict(channels, action=action)))
+
+    async def _consume(self) -> None:
+        # recv() rather than async for, so a FeedRecorder attached to the client sees the frames
+        while True:
+            for msg in _decode(await self._ws.recv()):
+                message_type = MESSAGE_TYPES.get(msg.get('T'))
+                if message_type is None:
+                    await self._dispatch_control(msg)
+                    continue
+                channel, build = message_type
+                handlers = self._handlers[channel]
+                handler = handlers.get(msg.get('S')) or handlers.get('*')
+                if handler is not None:
+                    await handler(build(msg))
+
+    async def _dispatch_control(self, msg) -> None:
+        # Messages other than market data, e.g. subscription acknowledgements and errors
+        if msg.get('T') == 'error':
+            logger.error(f"RawDataStream: error {msg.get('msg')} ({msg.get('code')})")
+        elif msg.get('T') == 'subscription':
+            logger.info(f"RawDataStream: subscribed to {', '.join(f'{k}: {v}' for k, v in msg.items() if k != 'T' and v)}")
+
+    async def _run_forever(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._should_run = True
+        delay = RECONNECT_DELAY_SEC
+        while self._should_run:
+            try:
+                logger.info(f"RawDataStream: connecting to {self._endpoint}")
+                await self._connect()
+                await self._auth()
+                await self._send('subscribe', self._handlers)
+                self._running = True
+                delay = RECONNECT_DELAY_SEC
+                await self._consume()
+            except (websockets.WebSocketException, OSError) as e:
+                if self._should_run:
+                    logger.warning(f"RawDataStream: websocket error, reconnecting in {delay} secs: {e}")
+                    metrics.count_reconnect(self.asset)
+            except ValueError as e:
+                if "insufficient subscription" in str(e):
+                    logger.error(f"RawDataStream: {e}")
+                    return
+                logger.warning(f"RawDataStream: {e}, reconnecting in {delay} secs")
+            finally:
+                self._running = False
+                if self._ws is not None:
+                    await self._ws.close()
+                    self._ws = None
+            if self._should_run and not self.supervised:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY_SEC)
+        logger.info("RawDataStream: stopped")
+
+    def run(self) -> None:
+        """Connect and stream until stop() is called."""
+        asyncio.run(self._run_forever())
+
+    async def stop_ws(self) -> None:
+        # main.py calls this from its own loop, the websocket belongs to the loop in run()
+        self._should_run = False
+        ws = self._ws
+        if ws is None or self._loop is None or not self._loop.is_running():
+            return
+        if asyncio.get_running_loop() is self._loop:
+            await ws.close()
+        else:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(ws.close(), self._loop))
+
+    def stop(self) -> None:
+        if self._loop is not None and self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.stop_ws(), self._loop).result(timeout=5)
+
+    def _subscribe(self, channel, handler, symbols) -> None:
+        if not asyncio.iscoroutinefunction(handler):
+            raise ValueError("handler must be a coroutine function")
+        for symbol in symbols:
+            self._handlers[channel][symbol] = handler
+        if self._running:
+            asyncio.run_coroutine_threadsafe(self._send('subscribe', {channel: symbols}), self._loop).result()
+
+    def _unsubscribe(self, channel, symbols) -> None:
+        if self._running:
+            asyncio.run_coroutine_threadsafe(self._send('unsubscribe', {channel: symbols}), self._loop).result()
+        for symbol in symbols:
+            self._handlers[channel].pop(symbol, None)
+
+    def subscribe_bars(self, handler, *symbols) -> None:
+        self._subscribe('bars', handler, symbols)
+
+    def subscribe_updated_bars(self, handler, *symbols) -> None:
+        self._subscribe('updatedBars', handler, symbols)
+
+    def subscribe_trades(self, handler, *symbols) -> None:
+        self._subscribe('trades', handler, symbols)
+
+    def unsubscribe_bars(self, *symbols) -> None:
+        self._unsubscribe('bars', symbols)
+
+    def unsubscribe_updated_bars(self, *symbols) -> None:
+        self._unsubscribe('updatedBars', symbols)
+
+    def unsubscribe_trades(self, *symbols) -> None:
+        self._unsubscribe('trades', symbols)
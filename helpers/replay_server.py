@@ -0,0 +1,187 @@
+"""
+A local stand-in for Alpaca's market data websocket that replays capture files from helpers/feed_recorder.py.
+
+The server speaks the same protocol as Alpaca: it sends the connected message, answers auth, subscribe and
+unsubscribe, and sends the recorded bars, trades, etc. of the subscribed symbols.  Paths containing "crypto"
+replay the crypto captures, any other path the stock captures.  Clients that send the
+"Content-Type: application/msgpack" header, like the alpaca-py clients, get msgpack, others get JSON.
+
+Usage:
+    python -m helpers.replay_server captures/stock_20241210_143600.cap.gz --speed 10
+    python main.py --replay-url ws://localhost:8765
+
+--speed 1 replays in real time, --speed 10 ten times faster, --speed max as fast as the client reads.
+"""
+
+import argparse
+import asyncio
+import json
+
+import msgpack
+from websockets.asyncio.server import serve
+
+from helpers.feed_recorder import read_capture
+from helpers.logger import logger
+
+# Message type to subscription channel
+CHANNELS = {
+    't': 'trades',
+    'q': 'quotes',
+    'o': 'orderbooks',
+    'b': 'bars',
+    'u': 'updatedBars',
+    'd': 'dailyBars',
+    's': 'statuses',
+    'l': 'lulds',
+    'n': 'news',
+    # corrections and cancel errors are sent to the trade subscribers
+    'c': 'trades',
+    'x': 'trades',
+}
+SUBSCRIBABLE = ('trades', 'quotes', 'orderbooks', 'bars', 'updatedBars', 'dailyBars', 'statuses', 'lulds', 'news')
+
+def _decode(frame):
+    if frame[:1] in (b'[', b'{'):
+        return json.loads(frame)
+    return msgpack.unpackb(frame)
+
+def _json_default(value):
+    if isinstance(value, msgpack.Timestamp):
+        return value.to_datetime().isoformat().replace('+00:00', 'Z')
+    raise TypeError(f'Cannot encode a {type(value)}')
+
+def load_captures(paths) -> dict:
+    """
+    Returns the market data of the capture files as {asset: [(receive time, [messages]), ...]}, in time order.
+    Control messages like success and subscription are left out, the server sends its own.
+    """
+    captures = {}
+    for path in paths:
+        header, frames = read_capture(path)
+        asset_frames = captures.setdefault(header['asset'], [])
+        count = 0
+        for received, frame in frames:
+            messages = [message for message in _decode(frame) if message.get('T') in CHANNELS]
+            if messages:
+                asset_frames.append((received, messages))
+                count += 1
+        logger.info(f"ReplayServer: loaded {count} {header['asset']} frames from {path}")
+    for asset_frames in captures.values():
+        asset_frames.sort(key=lambda frame: frame[0])
+    return captures
+
+class ReplayServer:
+    """
+    Replays captures to every client that connects.
+
+    INPUTS:
+        captures: dict - As returned by load_captures.
+        speed: float - Replay speed, 1 is real time. 0 sends the frames as fast as possible.
+        loop: bool - Start over at the end of the captures.
+        max_connections: int - Refuse more connections like Alpaca does, None for no limit.
+    """
+
+    def __init__(self, captures: dict, speed: float = 1.0, loop: bool = False, max_connections: int = None):
+        self.captures = captures
+        self.speed = speed
+        self.loop = loop
+        self.max_connections = max_connections
+        self.connections = 0
+
+    async def serve_forever(self, host='localhost', port=8765) -> None:
+        async with serve(self._handle, host, port) as server:
+            logger.info(f"ReplayServer: listening on ws://{host}:{port} (speed={self.speed or 'max'})")
+            await server.serve_forever()
+
+    async def _handle(self, connection) -> None:
+        asset = 'crypto' if 'crypto' in connection.request.path else 'stock'
+        use_msgpack = connection.request.headers.get('Content-Type') == 'application/msgpack'
+
+        async def send(messages):
+            if use_msgpack:
+                await connection.send(msgpack.packb(messages))
+            else:
+                await connection.send(json.dumps(messages, default=_json_default))
+
+        subscriptions = {channel: set() for channel in SUBSCRIBABLE}
+        replay_task = None
+        authenticated = False
+        self.connections += 1
+        try:
+            await send([{'T': 'success', 'msg': 'connected'}])
+            async for frame in connection:
+                request = _decode(frame if isinstance(frame, bytes) else frame.encode())
+                action = request.get('action')
+
+                if action == 'auth':
+                    if self.max_connections is not None and self.connections > self.max_connections:
+                        await send([{'T': 'error', 'code': 406, 'msg': 'connection limit exceeded'}])
+                        return
+                    authenticated = True
+                    await send([{'T': 'success', 'msg': 'authenticated'}])
+                elif not authenticated:
+                    await send([{'T': 'error', 'code': 401, 'msg': 'not authenticated'}])
+                elif action in ('subscribe', 'unsubscribe'):
+                    for channel in SUBSCRIBABLE:
+                        symbols = set(request.get(channel, []))
+                        if action == 'subscribe':
+                            subscriptions[channel] |= symbols
+                        else:
+                            subscriptions[channel] -= symbols
+                    await send([dict({'T': 'subscription'}, **{channel: sorted(symbols) for channel, symbols in subscriptions.items()})])
+                    if replay_task is None:
+                        replay_task = asyncio.create_task(self._replay(asset, subscriptions, send))
+                else:
+                    await send([{'T': 'error', 'code': 400, 'msg': 'invalid syntax'}])
+        finally:
+            self.connections -= 1
+            if replay_task is not None:
+                replay_task.cancel()
+
+    async def _replay(self, asset, subscriptions, send) -> None:
+        frames = self.captures.get(asset, [])
+        if not frames:
+            logger.warning(f"ReplayServer: no {asset} captures to replay")
+            return
+        loop = asyncio.get_running_loop()
+
+        def subscribed(message):
+            symbols = subscriptions[CHANNELS[message['T']]]
+            return '*' in symbols or message.get('S') in symbols
+
+        while True:
+            first_received = frames[0][0]
+            started = loop.time()
+            sent = 0
+            for received, messages in frames:
+                if self.speed:
+                    delay = (received - first_received) / self.speed - (loop.time() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                messages = [message for message in messages if subscribed(message)]
+                if messages:
+                    await send(messages)
+                    sent += len(messages)
+            logger.info(f"ReplayServer: replayed {sent} {asset} messages in {loop.time() - started:.1f} secs")
+            if not self.loop:
+                return
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured Alpaca websocket frames on a local websocket server.')
+    parser.add_argument('captures', help='Capture files written by FeedRecorder.', nargs='+')
+    parser.add_argument('--host', help='Host to listen on. Default is localhost.', type=str, default='localhost')
+    parser.add_argument('--port', help='Port to listen on. Default is 8765.', type=int, default=8765)
+    parser.add_argument('--speed', help='Replay speed, 1 for real time, 10 for ten times faster or "max". Default is 1.', type=str, default='1')
+    parser.add_argument('--loop', help='Start over at the end of the captures.', action='store_true')
+    parser.add_argument('--max-connections', help='Answer "connection limit exceeded" beyond this many connections.', type=int, default=None)
+    args = parser.parse_args()
+
+    speed = 0 if args.speed == 'max' else float(args.speed)
+    server = ReplayServer(load_captures(args.captures), speed=speed, loop=args.loop, max_connections=args.max_connections)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        logger.info("ReplayServer: stopped")
+
+if __name__ == "__main__":
+    main()
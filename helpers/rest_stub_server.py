@@ -0,0 +1,178 @@
+"""
+A local stand-in for the bars endpoints of Alpaca's market data REST API.
+
+Answers GET /v2/stocks/bars and /v1beta3/crypto/us/bars like Alpaca: the bars of the requested symbols
+and timeframe, e.g. 1Min, 15Min, 1Hour or 1Day, from start to end, sorted by symbol and time, limit bars
+per page with a next_page_token.  The bars start on multiples of their length from the epoch in UTC, so
+day bars are stamped at midnight UTC.  They are made up but always the same for a symbol, timeframe and
+time.  Stocks have no bars on weekends and every symbol skips one bar in skip_every, like a minute
+without trades.  With rate_limit the server answers 429 with a Retry-After header beyond that many
+requests in the last window seconds, a minute by default.
+
+Usage:
+    python -m helpers.rest_stub_server --port 8766
+    python main.py --rest-url http://localhost:8766
+"""
+
+import argparse
+import datetime
+import json
+import math
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helpers.logger import logger
+
+# Seconds of a timeframe unit, Alpaca also accepts the short forms
+TIMEFRAME_UNITS = {'Min': 60, 'T': 60, 'Hour': 3600, 'H': 3600, 'Day': 86400, 'D': 86400}
+
+def _parse_time(value: str) -> int:
+    return int(datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+def _parse_timeframe(value: str) -> int:
+    """
+    Returns the seconds of a timeframe like 1Min, 15Min, 1Hour or 1Day.
+    """
+    match = re.fullmatch(r'(\d+)([A-Za-z]+)', value)
+    if match is None or match.group(2) not in TIMEFRAME_UNITS or int(match.group(1)) < 1:
+        raise ValueError(f"unsupported timeframe {value}")
+    return int(match.group(1)) * TIMEFRAME_UNITS[match.group(2)]
+
+def _bar_times(start: int, end: int, length: int, weekdays_only: bool) -> list:
+    first = start + (-start % length)
+    times = range(first, end + 1, length)
+    if weekdays_only:
+        return [bar_time for bar_time in times if datetime.datetime.fromtimestamp(bar_time, datetime.timezone.utc).weekday() < 5]
+    return list(times)
+
+def stub_bar(symbol: str, bar_time: int, length: int = 60) -> dict:
+    seed = zlib.crc32(f"{symbol}{bar_time}{length}".encode())
+    base = 100 + zlib.crc32(symbol.encode()) % 400 + (seed % 1000) / 100
+    minutes = length // 60
+    return {
+        't': datetime.datetime.fromtimestamp(bar_time, datetime.timezone.utc).isoformat().replace('+00:00', 'Z'),
+        'o': base, 'h': base + 0.5, 'l': base - 0.5, 'c': base + 0.25,
+        'v': (100 + seed % 900) * minutes, 'n': (1 + seed % 50) * minutes, 'vw': base + 0.1,
+    }
+
+class RestStubServer:
+    """
+    INPUTS:
+        skip_every: int - Every symbol has no bar for one bar time in this many, 0 for none.
+        rate_limit: int - Requests a window before 429 is answered, None for no limit.
+        window: float - Seconds of the rate limit window.
+    """
+
+    def __init__(self, host='localhost', port=8766, skip_every=7, rate_limit=None, window=60):
+        self.skip_every = skip_every
+        self.rate_limit = rate_limit
+        self.window = window
+        self.requests = 0
+        self.throttled = 0
+        self._request_times = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self) -> 'RestStubServer':
+        threading.Thread(target=self.server.serve_forever, name='rest_stub', daemon=True).start()
+        logger.info(f"RestStubServer: listening on {self.url}")
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _throttle(self) -> int:
+        # Seconds until the next request is allowed, 0 when this one is
+        if self.rate_limit is None:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._request_times = [sent for sent in self._request_times if sent > now - self.window]
+            if len(self._request_times) >= self.rate_limit:
+                self.throttled += 1
+                return math.ceil(self._request_times[0] + self.window - now)
+            self._request_times.append(now)
+            return 0
+
+    def _send(self, request, status, body, headers=()) -> None:
+        data = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(data)
+
+    def _handle(self, request) -> None:
+        url = urllib.parse.urlsplit(request.path)
+        if url.path not in ('/v2/stocks/bars', '/v1beta3/crypto/us/bars'):
+            self._send(request, 404, {'message': 'not found'})
+            return
+        with self._lock:
+            self.requests += 1
+        retry_after = self._throttle()
+        if retry_after:
+            self._send(request, 429, {'message': 'too many requests.'}, headers=[('Retry-After', str(retry_after))])
+            return
+
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            symbols = sorted(params['symbols'].split(','))
+            start = _parse_time(params['start'])
+            end = _parse_time(params['end'])
+            length = _parse_timeframe(params.get('timeframe', '1Min'))
+        except (KeyError, ValueError) as e:
+            self._send(request, 400, {'message': f'invalid request: {e}'})
+            return
+        limit = min(int(params.get('limit') or 1000), 10000)
+        offset = int(params.get('page_token') or 0)
+
+        # Page through symbol x bar time without building the whole list
+        times = _bar_times(start, end, length, weekdays_only=url.path.startswith('/v2/'))
+        total = len(symbols) * len(times)
+        bars = {}
+        position = offset
+        while position < min(offset + limit, total):
+            symbol = symbols[position // len(times)]
+            bar_time = times[position % len(times)]
+            position += 1
+            if self.skip_every and (bar_time // length + zlib.crc32(symbol.encode())) % self.skip_every == 0:
+                continue
+            bars.setdefault(symbol, []).append(stub_bar(symbol, bar_time, length))
+        next_page_token = str(position) if position < total else None
+        self._send(request, 200, {'bars': bars, 'next_page_token': next_page_token})
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve made up historical bars like Alpaca\'s REST API.')
+    parser.add_argument('--host', help='Host to listen on. Default is localhost.', type=str, default='localhost')
+    parser.add_argument('--port', help='Port to listen on. Default is 8766.', type=int, default=8766)
+    parser.add_argument('--skip-every', help='Leave out one bar in this many per symbol. Default is 7.', type=int, default=7)
+    parser.add_argument('--rate-limit', help='Answer 429 beyond this many requests a minute.', type=int, default=None)
+    args = parser.parse_args()
+
+    server = RestStubServer(args.host, args.port, skip_every=args.skip_every, rate_limit=args.rate_limit)
+    logger.info(f"RestStubServer: listening on {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import datetime
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from helpers.logger import logger
+
+# Every record is a header followed by the JSON encoded item
+# header: payload length (uint32), crc32 of the payload (uint32)
+HEADER = struct.Struct('<II')
+SEGMENT_PREFIX = 'segment_'
+SEGMENT_SUFFIX = '.spool'
+
+def _encode(item) -> bytes:
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return {'$dt': value.isoformat()}
+        raise TypeError(f'Cannot spool a {type(value)}')
+    return json.dumps(item, default=default, separators=(',', ':')).encode()
+
+def _decode(payload: bytes):
+    def object_hook(value):
+        if '$dt' in value:
+            return datetime.datetime.fromisoformat(value['$dt'])
+        return value
+    def to_tuples(value):
+        if isinstance(value, list):
+            return tuple(to_tuples(v) for v in value)
+        return value
+    return to_tuples(json.loads(payload, object_hook=object_hook))
+
+class Segment:
+    """
+    One preallocated, memory mapped spool file.  Records are appended until the next one does not fit.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        new_file = not os.path.exists(path)
+        with open(path, 'ab') as f:
+            if new_file or os.path.getsize(path) < size:
+                f.truncate(size)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.size = len(self._map)
+        self.offset = self._scan()
+
+    def _scan(self) -> int:
+        # Find the end of the valid records.  A torn or corrupted record ends the segment.
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            length, crc = HEADER.unpack_from(self._map, offset)
+            if length == 0:
+                break
+            end = offset + HEADER.size + length
+            if end > self.size or zlib.crc32(self._map[offset + HEADER.size:end]) != crc:
+                logger.warning(f"Spool: ignoring a corrupted record at offset {offset} of {self.path}")
+                break
+            offset = end
+        return offset
+
+    def records(self):
+        offset = 0
+        while offset < self.offset:
+            length, _ = HEADER.unpack_from(self._map, offset)
+            start = offset + HEADER.size
+            yield _decode(self._map[start:start + length])
+            offset = start + length
+
+    def fits(self, payload: bytes) -> bool:
+        return self.offset + HEADER.size + len(payload) <= self.size
+
+    def append(self, payload: bytes) -> None:
+        HEADER.pack_into(self._map, self.offset, len(payload), zlib.crc32(payload))
+        start = self.offset + HEADER.size
+        self._map[start:start + len(payload)] = payload
+        self.offset = start + len(payload)
+
+    def flush(self) -> None:
+        self._map.flush()
+
+    def close(self) -> None:
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+class Spool:
+    """
+    An append only spool on disk for rows that could not be written to the database yet.
+
+    The spool is a directory of segment files of segment_size bytes.  Items are appended to the newest
+    segment, each as a record with its own crc32, and the segment is flushed to disk after every append.
+    A record that is too large for an empty segment gets a segment of its own.
+
+    Segments are read back oldest first with sealed_segments() and deleted with remove() once their
+    rows are in the database.  seal() closes the newest segment so that it can be drained as well.
+    Leftover segments of a previous run are picked up when the spool is opened.
+
+    All methods are thread safe.
+    """
+
+    def __init__(self, directory: str, segment_size: int):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._sealed = sorted(self._segment_paths())
+        self._active = None
+        self._next_number = self._number(self._sealed[-1]) + 1 if self._sealed else 0
+        if self._sealed:
+            logger.info(f"Spool: found {len(self._sealed)} segments to replay in {directory}")
+
+    def _segment_paths(self):
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                yield os.path.join(self.directory, name)
+
+    @staticmethod
+    def _number(path: str) -> int:
+        return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def _open_segment(self, min_size: int) -> Segment:
+        path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{self._next_number:08d}{SEGMENT_SUFFIX}")
+        self._next_number += 1
+        return Segment(path, max(self.segment_size, min_size))
+
+    def _seal_active(self) -> None:
+        if self._active is not None:
+            self._active.close()
+            self._sealed.append(self._active.path)
+            self._active = None
+
+    def append_many(self, items) -> None:
+        """
+        Append items to the spool and flush them to disk.
+
+        INPUTS:
+            items: list - Rows made of str, int, float, bool, None and datetime values.
+        """
+        payloads = [_encode(item) for item in items]
+        with self._lock:
+            for payload in payloads:
+                if self._active is None or not self._active.fits(payload):
+                    self._seal_active()
+                    self._active = self._open_segment(HEADER.size + len(payload))
+                self._active.append(payload)
+            if self._active is not None:
+                self._active.flush()
+
+    def seal(self) -> None:
+        """
+        Close the segment that is being appended to, new items go to a new segment.
+        """
+        with self._lock:
+            if self._active is not None and self._active.offset == 0:
+                return
+            self._seal_active()
+
+    def sealed_segments(self) -> list:
+        """
+        Returns the paths of the sealed segments, oldest first.
+        """
+        with self._lock:
+            return list(self._sealed)
+
+    def read(self, path: str) -> list:
+        """
+        Returns the items in a sealed segment.
+        """
+        segment = Segment(path, 0)
+        try:
+            return list(segment.records())
+        finally:
+            segment.close()
+
+    def remove(self, path: str) -> None:
+        """
+        Delete a sealed segment after its items were written to the database.
+        """
+        with self._lock:
+            self._sealed.remove(path)
+            os.remove(path)
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not self._sealed and (self._active is None or self._active.offset == 0)
@@ -0,0 +1,225 @@
+"""
+Keep a websocket client connected: reconnect it with a jittered, growing delay and restart it when its
+run() returns while it should be running.
+
+The alpaca clients reconnect by themselves, but at once and forever: a "connection limit exceeded" answer
+is retried in a tight loop, and an error that ends run() leaves the stream dead until the process is
+restarted.  StreamSupervisor hooks into the client's _connect, _auth and _consume, like attach_recorder()
+does, so it sees every drop and every attempt:
+
+    _consume raising     the connection dropped, the outage starts
+    _connect             sleeps the backoff delay first when the previous attempt failed
+    _auth raising        the attempt failed; after a connection limit error the delay is at least
+                         CONNECTION_LIMIT_WAIT_SEC, since the old connection is still counted by Alpaca
+    _auth returning      the stream is back, the time to recover is logged and measured
+
+The listeners, e.g. GapDetector, are called as listener(event, at) with event 'down' when an outage
+starts, 'up' when it ends and 'stopped' when the client is stopped on purpose, and at the epoch seconds
+it happened.  They are called on the client's loop, in another thread than the one running run().
+
+The client keeps its subscriptions in _handlers, which SubscriptionManager keeps up to date while the
+client is down, and sends them all again after every connect, so the current subscriptions are restored.
+
+Works with StockDataStream, CryptoDataStream and RawDataStream, whose own reconnect delay is turned off.
+"""
+
+import asyncio
+import collections
+import random
+import time
+
+import websockets
+
+from helpers import metrics
+from helpers.logger import logger
+from resources.constants import STREAM_SUPERVISOR
+
+class Outage:
+    __slots__ = ('start', 'end', 'attempts', 'error')
+
+    def __init__(self, start, error):
+        self.start = start
+        self.end = None
+        self.attempts = 0
+        self.error = error
+
+    @property
+    def seconds(self):
+        return None if self.end is None else self.end - self.start
+
+def backoff_delay(failures: int, base=STREAM_SUPERVISOR['BACKOFF_BASE_SEC'], maximum=STREAM_SUPERVISOR['MAX_BACKOFF_SEC']) -> float:
+    """
+    Returns the delay before the next attempt after failures failed attempts: half of the exponential delay
+    plus a random part of the other half, so that clients that dropped together do not reconnect together.
+    """
+    if failures <= 0:
+        return 0
+    cap = min(maximum, base * 2 ** (failures - 1))
+    return cap / 2 + random.uniform(0, cap / 2)
+
+class StreamSupervisor:
+    """
+    INPUTS:
+        client: DataStream or RawDataStream - A client that is not running yet.
+        asset: str - 'stock' or 'crypto', for the log and the metrics.
+        run_client: function - Runs the client until it stops, called in a thread as run_client(client, asset).
+    """
+
+    def __init__(self, client, asset: str, run_client):
+        self.client = client
+        self.asset = asset
+        self.run_client = run_client
+        self.outages = collections.deque(maxlen=STREAM_SUPERVISOR['OUTAGES_KEPT'])
+        self.outage = None  # the current Outage
+        self.failures = 0   # failed attempts in a row
+        self.connection_limited = False
+        self.restarts = 0
+        self._connected_once = False
+        self._delay_spent = False
+        self._wanted = asyncio.Event()
+        self.listeners = []
+        self._hook()
+
+    def _hook(self) -> None:
+        client = self.client
+        connect = client._connect
+        auth = client._auth
+        consume = client._consume
+
+        async def supervised_connect():
+            await self._wait_before_attempt()
+            try:
+                await connect()
+            except Exception as e:
+                self._attempt_failed(e)
+                raise
+
+        async def supervised_auth():
+            try:
+                await auth()
+            except Exception as e:
+                self._attempt_failed(e)
+                raise
+            self._connected()
+
+        async def supervised_consume():
+            try:
+                await consume()
+            except (websockets.WebSocketException, OSError) as e:
+                if client._should_run:
+                    self._dropped(e)
+                raise
+
+        if hasattr(client, 'supervised'):
+            client.supervised = True
+        client._connect = supervised_connect
+        client._auth = supervised_auth
+        client._consume = supervised_consume
+
+    def _notify(self, event, at) -> None:
+        for listener in self.listeners:
+            try:
+                listener(event, at)
+            except Exception as e:
+                logger.error(f"StreamSupervisor: a listener of the {self.asset} stream failed on {event}: {e}")
+
+    def _dropped(self, error) -> None:
+        if self.outage is None:
+            self.outage = Outage(time.time(), f"{type(error).__name__}: {error}")
+            logger.warning(f"StreamSupervisor: the {self.asset} stream dropped: {error}")
+            self._notify('down', self.outage.start)
+
+    def _attempt_failed(self, error) -> None:
+        self.failures += 1
+        self.connection_limited = "connection limit exceeded" in str(error)
+        if self.outage is None:
+            # The first connect failed, or the previous connection ended without an error
+            self.outage = Outage(time.time(), f"{type(error).__name__}: {error}")
+            self._notify('down', self.outage.start)
+        self.outage.attempts += 1
+        self.outage.error = f"{type(error).__name__}: {error}"
+
+    def _next_delay(self) -> float:
+        delay = backoff_delay(self.failures)
+        if self.connection_limited:
+            delay = max(delay, STREAM_SUPERVISOR['CONNECTION_LIMIT_WAIT_SEC'] + random.uniform(0, STREAM_SUPERVISOR['BACKOFF_BASE_SEC']))
+        return delay
+
+    async def _wait_before_attempt(self) -> None:
+        # Runs on the client's loop before every connect
+        if self._delay_spent:
+            # run() waited already before it started the client again
+            self._delay_spent = False
+            return
+        delay = self._next_delay()
+        if not delay:
+            return
+        reason = "the connection limit" if self.connection_limited else f"{self.failures} failed attempts"
+        logger.info(f"StreamSupervisor: reconnecting the {self.asset} stream in {delay:.1f} secs after {reason}")
+        until = time.monotonic() + delay
+        while (remaining := until - time.monotonic()) > 0:
+            if not self.client._should_run:
+                raise ConnectionAbortedError(f"the {self.asset} stream was stopped")
+            await asyncio.sleep(min(remaining, STREAM_SUPERVISOR['STOP_CHECK_SEC']))
+
+    def _connected(self) -> None:
+        outage, self.outage = self.outage, None
+        self.failures = 0
+        self.connection_limited = False
+        if outage is not None:
+            outage.end = time.time()
+            self.outages.append(outage)
+            metrics.observe_stream_recovery(self.asset, outage.seconds)
+            symbols = len(self.client._handlers.get('bars', ()))
+            logger.info(f"StreamSupervisor: the {self.asset} stream recovered in {outage.seconds:.1f} secs after {outage.attempts + 1} attempts ({outage.error}), resubscribing {symbols} symbols")
+            self._notify('up', outage.end)
+        elif self._connected_once:
+            logger.info(f"StreamSupervisor: the {self.asset} stream reconnected")
+        self._connected_once = True
+
+    def start(self) -> None:
+        """
+        Run the client, from the loop that runs run().
+        """
+        # A stop_ws() while the client was not connected leaves its stop message behind
+        stop_queue = getattr(self.client, '_stop_stream_queue', None)
+        while stop_queue is not None and not stop_queue.empty():
+            stop_queue.get_nowait()
+        self._wanted.set()
+
+    async def stop(self) -> None:
+        """
+        Stop the client on purpose, it is not restarted until start() is called.
+        """
+        self._wanted.clear()
+        self._notify('stopped', time.time())
+        await self.client.stop_ws()
+
+    @property
+    def running(self) -> bool:
+        return self._wanted.is_set()
+
+    async def run(self, start=True) -> None:
+        """
+        Run the client whenever it is started, until cancelled.  A client whose run() returns while it
+        was not stopped is started again after the backoff delay.
+        """
+        if start:
+            self.start()
+        while True:
+            await self._wanted.wait()
+            await asyncio.to_thread(self.run_client, self.client, self.asset)
+            if not self._wanted.is_set():
+                continue
+            if not self.client._should_run:
+                # Stopped with stop_ws() rather than stop(), e.g. by close_after_trading_hours
+                self._wanted.clear()
+                continue
+
+            # run() returned without stop(), count it as a failed attempt
+            self._attempt_failed(RuntimeError(f"the {self.asset} stream ended"))
+            self.restarts += 1
+            delay = self._next_delay()
+            logger.warning(f"StreamSupervisor: the {self.asset} stream ended, restarting it in {delay:.1f} secs")
+            await asyncio.sleep(delay)
+            self._delay_spent = True
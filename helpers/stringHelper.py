@@ -1,6 +1,9 @@
-from alpaca.data.models.bars import Bar
+from typing import TYPE_CHECKING
 
-def bar_to_oneline_string(data: Bar):
+if TYPE_CHECKING:
+    from alpaca.data.models.bars import Bar
+
+def bar_to_oneline_string(data: 'Bar'):
     """
      Convert a bar object to a string in the format:
         MM/DD/YYYY HH:MM:SS symbol='SYM' o=O h=H l=L c=C v=V trade_count=TC vwap=VWAP
@@ -0,0 +1,175 @@
+"""
+Change the symbols a running websocket client is subscribed to by sending only the differences.
+
+The subscribe_* methods of the alpaca clients resend every subscription of the client and update_sub
+used to unsubscribe every old symbol before subscribing the new ones, so one new ticker meant a storm of
+messages and a gap in the bars of the symbols that did not change.  SubscriptionManager compares the
+watchlist with what is subscribed, unsubscribes the removed symbols and subscribes the added ones in
+messages that stay below the client's frame size.  Every message is answered by Alpaca with a
+subscription message that lists all the symbols subscribed, the manager waits for those and logs how
+long the change took.  The client's own resubscribe after a reconnect and the subscribe_* calls are
+answered the same way, so an answer only acknowledges a change when its lists hold all the symbols
+subscribed and none of the symbols unsubscribed.  The changes still waiting when the client connects
+again are failed, their messages went out on the old connection.
+
+Works with StockDataStream, CryptoDataStream and RawDataStream, which keep their handlers in
+_handlers[channel][symbol] and run on their own loop.
+"""
+
+import asyncio
+import collections
+import time
+
+import msgpack
+
+from helpers.logger import logger
+
+ACK_TIMEOUT_SEC = 10
+
+class SubscriptionManager:
+    """
+    Keeps the subscriptions of a client in line with a list of symbols.
+
+    INPUTS:
+        client: DataStream or RawDataStream - The client, running or not.
+        channels: dict - {channel: handler}, e.g. {'bars': bar_data_handler, 'updatedBars': updatebar_data_handler}.
+        symbols: iterable - The symbols the client is already subscribed to.
+        name: str - For the log, e.g. 'stock'.
+    """
+
+    def __init__(self, client, channels: dict, symbols=(), name: str = ''):
+        self.client = client
+        self.channels = dict(channels)
+        self.symbols = set(symbols)
+        self.name = name
+        self.last_update_secs = None
+        self._pending = collections.deque()  # (future, action, symbols) of the messages sent
+        self._hook_dispatch()
+        self._hook_connect()
+
+    def _hook_dispatch(self) -> None:
+        # Watch the control messages of the client for the acknowledgements
+        name = '_dispatch_control' if hasattr(self.client, '_dispatch_control') else '_dispatch'
+        dispatch = getattr(self.client, name)
+
+        async def dispatch_with_acks(msg):
+            msg_type = msg.get('T')
+            if self._pending and msg_type == 'error':
+                future = self._pending.popleft()[0]
+                if not future.done():
+                    future.set_exception(ValueError(f"{msg.get('msg')} ({msg.get('code')})"))
+            elif self._pending and msg_type == 'subscription':
+                self._acknowledge(msg)
+            await dispatch(msg)
+
+        setattr(self.client, name, dispatch_with_acks)
+
+    def _hook_connect(self) -> None:
+        connect = self.client._connect
+
+        async def connect_and_drop_pending():
+            while self._pending:
+                future = self._pending.popleft()[0]
+                if not future.done():
+                    future.set_exception(ConnectionError("the client reconnected before it was acknowledged"))
+            await connect()
+
+        self.client._connect = connect_and_drop_pending
+
+    def _acknowledge(self, msg) -> None:
+        # Resolve the oldest change that the subscriptions in msg confirm
+        subscribed = {channel: set(msg.get(channel) or ()) for channel in self.channels}
+        for entry in self._pending:
+            future, action, batch = entry
+            if all(('*' in symbols or symbol in symbols) == (action == 'subscribe')
+                   for symbols in subscribed.values() for symbol in batch):
+                self._pending.remove(entry)
+                if not future.done():
+                    future.set_result(msg)
+                return
+
+    def batches(self, symbols) -> list:
+        """
+        Split symbols into lists whose subscribe message for all channels fits in one frame.
+        """
+        max_size = getattr(self.client, '_max_frame_size', 32768)
+        batches = []
+        batch = []
+        size = len(msgpack.packb({'action': 'unsubscribe', **{channel: [] for channel in self.channels}}))
+        batch_size = size
+        for symbol in sorted(symbols):
+            # a str of up to 31 bytes has a 1 byte header, the array header can grow by 2 bytes
+            symbol_size = (len(symbol.encode()) + 3) * len(self.channels)
+            if batch and batch_size + symbol_size > max_size:
+                batches.append(batch)
+                batch = []
+                batch_size = size
+            batch.append(symbol)
+            batch_size += symbol_size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def update(self, symbols) -> None:
+        """
+        Subscribe the symbols that are new and unsubscribe the ones that are no longer in symbols.
+        """
+        symbols = set(symbols)
+        added = symbols - self.symbols
+        removed = self.symbols - symbols
+        if not added and not removed:
+            return
+
+        client = self.client
+        loop = getattr(client, '_loop', None)
+        if client._running and loop is not None and loop.is_running():
+            # The client's loop sends and receives the acknowledgements
+            future = asyncio.run_coroutine_threadsafe(self._apply(added, removed), loop)
+            await asyncio.wrap_future(future)
+        else:
+            # Sent with the other subscriptions when the client connects
+            self._set_handlers(added, removed)
+        self.symbols = symbols
+
+    def _set_handlers(self, added, removed) -> None:
+        for channel, handler in self.channels.items():
+            handlers = self.client._handlers[channel]
+            for symbol in added:
+                handlers[symbol] = handler
+            for symbol in removed:
+                handlers.pop(symbol, None)
+
+    async def _send(self, action, batch) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((future, action, batch))
+        await self.client._ws.send(msgpack.packb({'action': action, **{channel: batch for channel in self.channels}}))
+        return future
+
+    async def _apply(self, added, removed) -> None:
+        started = time.perf_counter()
+        futures = []
+        # Handle the added symbols before they are subscribed, keep the removed ones until they are unsubscribed
+        self._set_handlers(added, ())
+        for batch in self.batches(removed):
+            futures.append(await self._send('unsubscribe', batch))
+        for batch in self.batches(added):
+            futures.append(await self._send('subscribe', batch))
+
+        try:
+            async with asyncio.timeout(ACK_TIMEOUT_SEC):
+                results = await asyncio.gather(*futures, return_exceptions=True)
+        except TimeoutError:
+            logger.warning(f"SubscriptionManager: {self.name} subscription change not acknowledged within {ACK_TIMEOUT_SEC} secs")
+            results = []
+            self._pending = collections.deque(entry for entry in self._pending if entry[0] not in futures)
+        finally:
+            self._set_handlers((), removed)
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        self.last_update_secs = time.perf_counter() - started
+        for error in errors:
+            logger.error(f"SubscriptionManager: {self.name} subscription change failed: {error}")
+        logger.info(
+            f"SubscriptionManager: {self.name} +{len(added)} -{len(removed)} symbols in {len(futures)} messages, "
+            f"{len(results) - len(errors)} acknowledged in {self.last_update_secs * 1000:.1f} ms"
+        )
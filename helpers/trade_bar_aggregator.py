@@ -0,0 +1,198 @@
+"""
+Build seconds, tick and volume bars from the trade stream.
+
+Each symbol has one open bar per bar type, so memory grows with the number of symbols only.  A trade
+updates the open bars in constant time and finished bars are queued to the bar writer, which inserts them
+into stock_bars in batches with the interval from bar_interval():
+    seconds bars end on the second boundary, like the minute bars they are aligned to the epoch in UTC.
+        They are finished by the first trade of a later bar or CLOSE_DELAY_SEC after they ended.
+    tick bars hold a fixed number of trades.
+    volume bars are finished by the trade that brings their volume to the size or above.
+Tick and volume bars are stamped with the time of their first trade.  Small bars often start in the same
+microsecond during the opening and closing crosses and sweeps, and stock_bars keeps one bar per symbol,
+time and interval, so a bar that would get the stamp of the previous one, or an older one, is stamped 1
+microsecond after it instead.  Trades older than the open seconds bar, or in a seconds bar that is
+written already, are counted in late_trades and left out.  stock_bars keeps the first row of a bar, so
+a bar reopened by a late trade would be dropped by the insert anyway.
+"""
+
+import asyncio
+import datetime
+import threading
+import time
+
+from helpers.database import bar_interval
+from helpers.logger import logger
+from resources.constants import TRADE_BARS
+
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+class TradeBar:
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume', 'trade_count', 'notional')
+
+    def __init__(self, start, price, size):
+        self.start = start
+        self.open = price
+        self.high = price
+        self.low = price
+        self.close = price
+        self.volume = size
+        self.trade_count = 1
+        self.notional = price * size
+
+    def add(self, price, size) -> None:
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += size
+        self.trade_count += 1
+        self.notional += price * size
+
+    def to_row(self, symbol, timestamp, interval) -> tuple:
+        vwap = self.notional / self.volume if self.volume else None
+        return (timestamp, symbol, self.open, self.high, self.low, self.close, self.volume, self.trade_count, vwap, interval)
+
+class TradeBarAggregator:
+    """
+    Aggregates the trades of the trade handler and writes the bars with writer.put_row().
+
+    INPUTS:
+        writer: BarWriter - Where the finished bars are queued.
+        seconds, ticks, volume: tuple of int - The sizes of the bars of each type.
+        close_delay: float - Seconds after the end of a seconds bar before it is written without a later trade.
+    add() is called by the trade handler on the stock client's thread, run() runs on the writer's loop.
+    """
+
+    def __init__(self, writer, seconds=TRADE_BARS['SECONDS'], ticks=TRADE_BARS['TICKS'], volume=TRADE_BARS['VOLUME'],
+                 close_delay=TRADE_BARS['CLOSE_DELAY_SEC'], check_frequency=TRADE_BARS['CHECK_FREQUENCY_SEC']):
+        self.writer = writer
+        self.seconds = tuple((length, bar_interval('seconds', length)) for length in seconds)
+        self.ticks = tuple((count, bar_interval('ticks', count)) for count in ticks)
+        self.volume = tuple((size, bar_interval('volume', size)) for size in volume)
+        self.close_delay = close_delay
+        self.check_frequency = check_frequency
+        self.bars_written = 0
+        self.late_trades = 0
+        # symbol: {interval: (TradeBar, timestamp of the first trade)}
+        self._open_bars = {}
+        # symbol: {interval: timestamp of the last tick or volume bar}
+        self._last_stamps = {}
+        # symbol: {interval: epoch the last written seconds bar ended}
+        self._closed_until = {}
+        self._lock = threading.Lock()
+
+    async def add(self, data) -> None:
+        """
+        Add a trade to the open bars of its symbol and write the bars it finishes.
+        """
+        price = data.price
+        size = data.size
+        timestamp = data.timestamp
+        epoch = timestamp.timestamp()
+        with self._lock:
+            open_bars = self._open_bars.get(data.symbol)
+            if open_bars is None:
+                open_bars = self._open_bars[data.symbol] = {}
+                self._last_stamps[data.symbol] = {}
+                self._closed_until[data.symbol] = {}
+            rows = self._add(data.symbol, open_bars, timestamp, epoch, price, size)
+        await self._write(rows)
+
+    def _add(self, symbol, open_bars, timestamp, epoch, price, size) -> list:
+        rows = []
+        closed_until = self._closed_until[symbol]
+        for length, interval in self.seconds:
+            start = int(epoch) - int(epoch) % length
+            if start < closed_until.get(interval, 0):
+                self.late_trades += 1
+                continue
+            bar = open_bars.get(interval)
+            if bar is not None and start != bar[0].start:
+                if start < bar[0].start:
+                    self.late_trades += 1
+                    continue
+                rows.append(self._close_seconds(symbol, open_bars, interval, length))
+                bar = None
+            if bar is None:
+                open_bars[interval] = (TradeBar(start, price, size), datetime.datetime.fromtimestamp(start, tz=datetime.timezone.utc))
+            else:
+                bar[0].add(price, size)
+
+        last_stamps = self._last_stamps[symbol]
+        for count, interval in self.ticks:
+            bar = open_bars.get(interval)
+            if bar is None:
+                bar = open_bars[interval] = (TradeBar(epoch, price, size), self._stamp(last_stamps, interval, timestamp))
+            else:
+                bar[0].add(price, size)
+            if bar[0].trade_count >= count:
+                rows.append(self._close(symbol, open_bars, interval))
+
+        for volume, interval in self.volume:
+            bar = open_bars.get(interval)
+            if bar is None:
+                bar = open_bars[interval] = (TradeBar(epoch, price, size), self._stamp(last_stamps, interval, timestamp))
+            else:
+                bar[0].add(price, size)
+            if bar[0].volume >= volume:
+                rows.append(self._close(symbol, open_bars, interval))
+        return rows
+
+    @staticmethod
+    def _stamp(last_stamps, interval, timestamp) -> datetime.datetime:
+        # A unique timestamp for a new tick or volume bar, its first trade's unless the last bar has it already
+        last = last_stamps.get(interval)
+        if last is not None and timestamp <= last:
+            timestamp = last + _MICROSECOND
+        last_stamps[interval] = timestamp
+        return timestamp
+
+    def _close(self, symbol, open_bars, interval) -> tuple:
+        bar, timestamp = open_bars.pop(interval)
+        return bar.to_row(symbol, timestamp, interval)
+
+    def _close_seconds(self, symbol, open_bars, interval, length) -> tuple:
+        # Later trades of the bar are late, a new bar with its time would not be written
+        self._closed_until[symbol][interval] = open_bars[interval][0].start + length
+        return self._close(symbol, open_bars, interval)
+
+    def close_due(self, now=None) -> list:
+        """
+        Finish the seconds bars that ended close_delay seconds before now.  Returns the rows to write.
+        """
+        now = time.time() if now is None else now
+        rows = []
+        with self._lock:
+            for symbol, open_bars in self._open_bars.items():
+                for length, interval in self.seconds:
+                    bar = open_bars.get(interval)
+                    if bar is not None and bar[0].start + length + self.close_delay <= now:
+                        rows.append(self._close_seconds(symbol, open_bars, interval, length))
+        return rows
+
+    async def _write(self, rows) -> None:
+        for row in rows:
+            await self.writer.put_row(row)
+        self.bars_written += len(rows)
+
+    def forget(self, *symbols) -> None:
+        """
+        Drop the open bars of symbols that are no longer tracked.
+        """
+        with self._lock:
+            for symbol in symbols:
+                self._open_bars.pop(symbol, None)
+                self._last_stamps.pop(symbol, None)
+                self._closed_until.pop(symbol, None)
+
+    async def run(self) -> None:
+        """
+        Write the seconds bars that no trade finished, every check_frequency seconds.
+        """
+        while True:
+            await asyncio.sleep(self.check_frequency)
+            await self._write(self.close_due())
+            if self.late_trades:
+                logger.debug(f"TradeBarAggregator: {self.late_trades} late trades left out so far")
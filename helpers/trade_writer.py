@@ -0,0 +1,33 @@
+from helpers.batch_writer import BatchWriter
+from helpers.database import trade_to_row, copy_trades_async
+from resources.constants import TRADE_WRITER, FILE_PATHS
+
+class TradeWriter(BatchWriter):
+    """
+    Streams the trades received by the websocket handlers into stock_trades_real_time with binary COPY.
+
+    Each batch is one COPY, so thousands of trades cost a single round trip and commit.
+    The write rate is logged every report_frequency seconds.
+    Rows that cannot be written are kept in the spool under spool/trades/ until the database is back.
+    See BatchWriter for when batches are flushed.
+    """
+
+    name = "TradeWriter"
+
+    def __init__(self, batch_size=TRADE_WRITER['BATCH_SIZE'], flush_interval=TRADE_WRITER['FLUSH_INTERVAL_SEC'], max_queue=TRADE_WRITER['MAX_QUEUE'], spool_dir=FILE_PATHS['SPOOL_DIR'] + 'trades', report_frequency=TRADE_WRITER['REPORT_FREQUENCY_SEC']):
+        super().__init__(batch_size, flush_interval, max_queue, report_frequency=report_frequency, spool_dir=spool_dir)
+
+    async def put(self, data) -> None:
+        """
+        Queue a trade to be written to stock_trades_real_time.
+
+        INPUTS:
+            data: Trade - The trade received from the Alpaca API.
+        """
+        await self._put_item(trade_to_row(data))
+
+    def _item_time(self, item):
+        return item[0]
+
+    async def _write_batch(self, batch, connection) -> None:
+        await copy_trades_async(batch, connection)
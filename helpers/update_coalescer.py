@@ -0,0 +1,146 @@
+"""
+Coalesce the corrected 1 min bars of the updatedBars channel before they are written.
+
+Alpaca can send several corrections of the same symbol and minute within seconds.  Every one that is
+written is an upsert into stock_bars, which also invalidates the continuous aggregates of that minute,
+and rolls the bar up again.  UpdateCoalescer holds the corrections for WINDOW_SEC after the first one of
+a window arrived and keeps only the latest of every (symbol, timestamp).  The survivors are handed on
+together when the window ends.
+
+A correction with the same values as the bar last written for its key is dropped.  The values of the last
+RECENT_KEYS keys written are kept in an LRU, both the bars from the feed, through remember(), and the
+corrections handed on.
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+
+from helpers import metrics
+from helpers.logger import logger
+from resources.constants import UPDATE_COALESCER
+
+def _values(data) -> tuple:
+    return (data.open, data.high, data.low, data.close, data.volume, data.trade_count, data.vwap)
+
+class UpdateCoalescer:
+    """
+    INPUTS:
+        on_bar: coroutine function - Called with every correction that survives a window.
+        window: float - Seconds corrections are held after the first one of a window arrived.
+        recent_keys: int - Keys whose last written values are kept to drop duplicates.
+
+    add() and remember() are called by the handlers, which run on the loops of the websocket clients, and
+    run() on the main loop, so the pending corrections and the LRU are guarded by a lock.
+    """
+
+    def __init__(self, on_bar, window=UPDATE_COALESCER['WINDOW_SEC'], recent_keys=UPDATE_COALESCER['RECENT_KEYS'], report_frequency=UPDATE_COALESCER['REPORT_FREQUENCY_SEC']):
+        self.on_bar = on_bar
+        self.window = window
+        self.recent_keys = recent_keys
+        self.report_frequency = report_frequency
+        self._pending = {}  # (symbol, timestamp): latest correction
+        self._recent = OrderedDict()  # (symbol, timestamp): values last written
+        self._lock = threading.Lock()
+        self._loop = None
+        self._arrived = None
+
+        # Counters for logging
+        self.received = 0
+        self.superseded = 0
+        self.duplicates = 0
+        self.flushed = 0
+        self._last_report_saved = 0
+
+    @property
+    def writes_saved(self) -> int:
+        return self.superseded + self.duplicates
+
+    def _remember(self, key, values) -> None:
+        recent = self._recent
+        recent[key] = values
+        recent.move_to_end(key)
+        if len(recent) > self.recent_keys:
+            recent.popitem(last=False)
+
+    def remember(self, data) -> None:
+        """
+        Note the values of a 1 min bar from the feed, a correction that does not change it is dropped.
+        """
+        with self._lock:
+            self._remember((data.symbol, data.timestamp), _values(data))
+
+    def add(self, data) -> None:
+        """
+        Hold a correction until the window ends, replacing an earlier one of the same symbol and minute.
+        """
+        key = (data.symbol, data.timestamp)
+        with self._lock:
+            self.received += 1
+            if self._recent.get(key) == _values(data) and key not in self._pending:
+                self.duplicates += 1
+                metrics.count_saved_update('duplicate')
+                return
+            if key in self._pending:
+                self.superseded += 1
+                metrics.count_saved_update('superseded')
+            first = not self._pending
+            self._pending[key] = data
+        if first and self._arrived is not None:
+            # Wake run() on its own loop, it may be another thread's
+            self._loop.call_soon_threadsafe(self._arrived.set)
+
+    async def flush(self) -> int:
+        """
+        Hand the pending corrections to on_bar.  Returns how many were handed on.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            bars = []
+            for key, data in pending.items():
+                values = _values(data)
+                if self._recent.get(key) == values:
+                    # Changed back to the values already written within the window
+                    self.duplicates += 1
+                    metrics.count_saved_update('duplicate')
+                    continue
+                self._remember(key, values)
+                bars.append(data)
+        for data in bars:
+            await self.on_bar(data)
+        self.flushed += len(bars)
+        return len(bars)
+
+    def _report(self) -> None:
+        saved = self.writes_saved - self._last_report_saved
+        if saved:
+            logger.info(f"UpdateCoalescer: {saved} writes saved over the last {self.report_frequency} secs ({self.received} corrections received, {self.flushed} written in total)")
+        self._last_report_saved = self.writes_saved
+
+    async def run(self) -> None:
+        """
+        Flush every window until cancelled.  The pending corrections are flushed when cancelled, so run()
+        should be cancelled before the writer that on_bar puts them into.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._arrived = asyncio.Event()
+        next_report = self._loop.time() + self.report_frequency
+        try:
+            while True:
+                if not self._pending:
+                    try:
+                        async with asyncio.timeout_at(next_report):
+                            await self._arrived.wait()
+                    except TimeoutError:
+                        pass
+                    self._arrived.clear()
+                if self._pending:
+                    await asyncio.sleep(self.window)
+                    await self.flush()
+                if self._loop.time() >= next_report:
+                    self._report()
+                    next_report = self._loop.time() + self.report_frequency
+        except asyncio.CancelledError:
+            await self.flush()
+            logger.info(f"UpdateCoalescer: stopped. {self.writes_saved} of {self.received} corrections not written, {self.superseded} superseded and {self.duplicates} duplicates.")
+            raise
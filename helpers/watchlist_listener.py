@@ -0,0 +1,93 @@
+"""
+Wake the symbol updates in main.py as soon as the watchlists change in the database.
+
+The triggers in data/db_watchlist_notify.sql send a notification on the watchlist_changed channel when
+stock_targets, portfolio_configs or orders change.  WatchlistListener LISTENs on one long lived
+connection and sets an event per asset.  While it is connected, update_symbols and update_crypto_symbols
+only poll as a slow fallback; while it is not, they poll at the usual CHECK_FREQUENCY.
+"""
+
+import asyncio
+
+from helpers.database import connect_to_db_async
+from helpers.logger import logger
+
+WATCHLIST_CHANNEL = 'watchlist_changed'
+ASSETS = ('stock', 'crypto')
+RECONNECT_DELAY_SEC = 5
+MAX_RECONNECT_DELAY_SEC = 300
+
+class WatchlistListener:
+    """
+    Listens for watchlist notifications.
+
+    INPUTS:
+        debounce: float - Seconds to wait after a notification for more, so that a batch of changes
+            causes one update.
+    """
+
+    def __init__(self, debounce: float = 2.0):
+        self.debounce = debounce
+        self.connected = False
+        self.notifications = 0
+        self.connections = 0
+        self._events = {asset: asyncio.Event() for asset in ASSETS}
+
+    async def run(self) -> None:
+        """
+        Listen until cancelled, reconnecting when the connection is lost.  Returns at once when the
+        database has no watchlist triggers.
+        """
+        delay = RECONNECT_DELAY_SEC
+        while True:
+            try:
+                connection = await connect_to_db_async()
+            except Exception as e:
+                logger.warning(f"WatchlistListener: cannot connect, polling until reconnected in {delay} secs: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY_SEC)
+                continue
+
+            try:
+                async with connection:
+                    await connection.set_autocommit(True)
+                    cursor = await connection.execute("SELECT 1 FROM pg_proc WHERE proname = 'notify_watchlist_changed'")
+                    if await cursor.fetchone() is None:
+                        logger.warning("WatchlistListener: data/db_watchlist_notify.sql has not been run, the watchlists are polled")
+                        return
+                    await connection.execute(f"LISTEN {WATCHLIST_CHANNEL}")
+                    self.connected = True
+                    delay = RECONNECT_DELAY_SEC
+                    logger.info(f"WatchlistListener: listening on {WATCHLIST_CHANNEL}")
+                    if self.connections:
+                        # Changes made while not listening were missed
+                        self._notify('all')
+                    self.connections += 1
+                    async for notify in connection.notifies():
+                        self.notifications += 1
+                        self._notify(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"WatchlistListener: connection lost, polling until reconnected: {e}")
+            finally:
+                self.connected = False
+            await asyncio.sleep(delay)
+
+    def _notify(self, payload: str) -> None:
+        for asset in ASSETS if payload not in ASSETS else (payload,):
+            self._events[asset].set()
+
+    async def wait(self, asset: str, timeout: float) -> bool:
+        """
+        Wait up to timeout seconds for a change of the watchlist of asset.  Returns True if it changed.
+        """
+        event = self._events[asset]
+        try:
+            async with asyncio.timeout(timeout):
+                await event.wait()
+        except TimeoutError:
+            return False
+        await asyncio.sleep(self.debounce)
+        event.clear()
+        return True
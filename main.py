@@ -1,97 +1,123 @@
+# First, so that the startup is timed from here, see --profile-startup
+from helpers.startup_profiler import startup_profiler
+
 import argparse
 import asyncio
-import datetime
-import pytz
-import os
-
-from alpaca.data.live import StockDataStream, CryptoDataStream
-from alpaca.data.live.websocket import DataStream
-
-from dotenv import load_dotenv
+import importlib
+import logging
+from typing import TYPE_CHECKING
 
-from helpers.database import connect_to_db, add_bar_row_to_db, add_trade_to_stock_trades, get_stocks_to_track, update_bar_row_in_db, get_crypto_to_track
+from helpers.env import API_KEY, API_SECRET
+from helpers.database import get_stocks_to_track, get_crypto_to_track, backfill_positions
 from helpers.stringHelper import bar_to_oneline_string
 from helpers.datastream_helper import test_socket, get_wss_url
-from helpers.logger import logger, set_file_log_level
-
-load_dotenv()
-
-# Alpaca API key ID and secret
-API_KEY = os.getenv("MS_ALPACA_API_KEY", default="")
-API_SECRET = os.getenv("MS_ALPACA_API_SECRET", default="")
+from helpers.feed_recorder import FeedRecorder, attach_recorder
+from helpers.raw_stream import RawDataStream, BarRecord
+from helpers.multiprocess_ingest import IngestSupervisor
+from helpers.subscription_manager import SubscriptionManager
+from helpers.stream_supervisor import StreamSupervisor
+from helpers.gap_backfill import GapDetector, BackfillWorker
+from helpers.market_calendar import MarketCalendar, SessionScheduler
+from helpers.historical_bars import HistoricalBarsClient
+from helpers.watchlist_listener import WatchlistListener
+from helpers.bar_writer import BarWriter
+from helpers.bar_cache import BarCache
+from helpers.update_coalescer import UpdateCoalescer
+from helpers.bar_aggregator import BarAggregator
+from helpers.trade_bar_aggregator import TradeBarAggregator
+from helpers.trade_writer import TradeWriter
+from helpers.db_pool import get_pool, get_async_pool, close_pools, log_pool_stats, report_pool_stats
+from helpers import metrics
+from helpers.logger import logger, set_file_log_level, LogSampler, LazyFormat
+
+# alpaca.data imports pandas, which takes most of the startup time.  The clients are imported while the
+# preflight checks of sub_bars run, see import_stream_clients
+if TYPE_CHECKING:
+    from alpaca.data.live.websocket import DataStream
+
+startup_profiler.mark('imports')
 
 # https://docs.alpaca.markets/docs/streaming-market-data
 STOCK_TESTING_URL = "wss://stream.data.alpaca.markets/v2/test"
 # STOCK_SANDBOX_URL = "wss://stream.data.sandbox.alpaca.markets/v2/iex"
 CHECK_FREQUENCY = 300  # 5 minutes
+WATCHLIST_FALLBACK_FREQUENCY = 1800  # poll every 30 minutes while the watchlist notifications are received
 
 TESTING = False
+SUBSCRIBE_TRADES = False  # also stream the stock trades into stock_trades_real_time
+REPLAY_URL = None  # connect to a helpers/replay_server.py at this url instead of Alpaca
+REST_URL = None  # fetch historical bars from a helpers/rest_stub_server.py at this url instead of Alpaca
+RECORD_DIR = None  # record the raw websocket frames to capture files in this directory
+RAW_STREAM = False  # use helpers/raw_stream.py instead of the alpaca-py clients
+WRITER_PROCESSES = 0  # receive and write in separate processes, see helpers/multiprocess_ingest.py
+recorders = []
+subscription_managers = {}  # client: SubscriptionManager
+stream_supervisors = {}  # client: StreamSupervisor
+watchlist_listener = WatchlistListener()
 
-# Alpaca supports extended trading hours from 4:00 AM to 8:00 PM EST
-# https://docs.alpaca.markets/docs/orders-at-alpaca#orders-submitted-outside-of-eligible-trading-hours
-# Define the trading hours
-trade_start_hour = 4
-trade_start_min = 00
-trade_end_hour = 20
-trade_end_min = 00
-est = pytz.timezone('US/Eastern')
+# Write the bars and trades received by the handlers to the database in batches
+bar_writer = BarWriter()
+trade_writer = TradeWriter()
 
-def is_trading_hours():
-    # True if it is a weekday and the current time is between 9:30 AM and 4:00 PM EST
+# Which bars and trades the handlers log, see --log-every and --log-max-per-sec
+bar_log_sampler = LogSampler()
+trade_log_sampler = LogSampler()
 
-    # Convert the UTC time to Eastern Standard Time
-    current_time = datetime.datetime.now(est)
-    start_time = current_time.replace(hour=trade_start_hour, minute=trade_start_min, second=0, microsecond=0)
-    end_time = current_time.replace(hour=trade_end_hour, minute=trade_end_min, second=0, microsecond=0)
+# The minutes missed while a stream was disconnected, fetched by a BackfillWorker in sub_bars
+gap_detector = GapDetector()
 
-    # It is a weekday and the current time is between 9:30 AM and 4:00 PM EST
-    if current_time.weekday() < 5 and start_time <= current_time <= end_time:
-        return True
-    return  False
+# The recent bars of the tracked symbols, to read without querying stock_bars
+bar_cache = BarCache()
 
-async def close_after_trading_hours(wss_client):
-    # sleep for 5 seconds to allow the client to start
-    await asyncio.sleep(5)
+# 5 min, 15 min, 1 hour and 1 day bars rolled up from the 1 min bars, written by bar_writer
+bar_aggregator = BarAggregator(bar_writer)
 
-    while True:
-        if is_trading_hours():
-            await asyncio.sleep(60)  # Check every minute
+# seconds, tick and volume bars built from the stock trades, when SUBSCRIBE_TRADES is set
+trade_bar_aggregator = TradeBarAggregator(bar_writer)
 
-        else:
-            logger.info("Trading hours have ended. Closing connection...")
-            await wss_client.stop_ws()
-            break
+async def write_corrected_bar(data):
+    await bar_writer.put(data, update=True)
+    await bar_aggregator.add(data, update=True)
 
-# Create a function that will replace subscribe_bars during non-trading hours.  
-# It should take the same arguments as subscribe_bars and call the handler every minute with a random string like, symbol='AAPL' timestamp=datetime.datetime(2024, 9, 23, 19, 59, tzinfo=datetime.timezone.utc) open=226.375 high=226.63 low=226.3 close=226.49 volume=15052.0 trade_count=208.0 vwap=226.463702
-def simulate_subscribe_bars(bar_data_handler, *symbols):
+# The corrected bars, only the latest of a symbol and minute in a window is written
+update_coalescer = UpdateCoalescer(write_corrected_bar)
+
+# Alpaca supports extended trading hours from 4:00 AM to 8:00 PM ET, until 5:00 PM on early close days
+# https://docs.alpaca.markets/docs/orders-at-alpaca#orders-submitted-outside-of-eligible-trading-hours
+# The sessions of the year with the market holidays, see data/market_calendar.json
+market_calendar = MarketCalendar()
+session_scheduler = SessionScheduler(market_calendar)
+
+def is_trading_hours():
+    # True during a session of the stock stream
+    return market_calendar.is_open()
+
+async def close_after_trading_hours(wss_client):
+    # Sleep until the session closes
+    await session_scheduler.wait_for_close()
+    logger.info("Trading hours have ended. Closing connection...")
+    await wss_client.stop_ws()
+
+# Replaces subscribe_bars during non-trading hours: takes the same arguments and calls the handler every
+# minute with a random BarRecord of each symbol, stamped with the minute like the bars of the stream
+async def simulate_subscribe_bars(bar_data_handler, *symbols):
     SLEEP_TIME_SEC = 60
-    # Every minute, call the bar_data_handler with a random string
     import random
     import datetime
 
-    async def simulate():
-        fake_it = True
-        while fake_it:
-            for symbol in symbols:
-                ts_now = repr(datetime.datetime.now(datetime.timezone.utc))
-                data = f"symbol='{symbol}' timestamp={ts_now} open={random.uniform(100, 200):.2f} high={random.uniform(100, 200):.2f} low={random.uniform(100, 200):.2f} close={random.uniform(100, 200):.2f} volume={random.randint(100, 200)} trade_count={random.randint(100, 200)} vwap={random.uniform(100, 200):.2f}"
-                await bar_data_handler(data)
-            if not is_trading_hours():
-                fake_it = False
+    fake_it = True
+    while fake_it:
+        minute = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+        for symbol in symbols:
+            prices = [round(random.uniform(100, 200), 2) for _ in range(4)]
+            data = BarRecord(symbol, minute, prices[0], max(prices), min(prices), prices[-1],
+                             float(random.randint(100, 200)), random.randint(100, 200), round(sum(prices) / 4, 2))
+            await bar_data_handler(data)
+        if is_trading_hours():
+            fake_it = False
+        else:
             await asyncio.sleep(SLEEP_TIME_SEC)
 
-    asyncio.run(simulate())
-
-def add_trade_row_to_db(data):
-    # Connect to the database
-    db_connection = connect_to_db()
-
-    # Insert the data into the database
-    add_trade_to_stock_trades(data, db_connection)
-
-    db_connection.close()
-
 async def live_stock_stream(symbols, simulate=False, subscribe_trades=False):
     """
     Subscribe to the live stock data stream for the given symbols.
@@ -99,16 +125,13 @@ async def live_stock_stream(symbols, simulate=False, subscribe_trades=False):
     INPUTS:
     symbols: tuple - The symbols to subscribe to.
     """
-        
-    async def trade_data_handler(data):
-        logger.info(f'TRADE: {data}')
-        add_trade_row_to_db(data)     
+    from alpaca.data.live import StockDataStream
 
     if not is_trading_hours():
         logger.info('live_stock_stream: Currently outside of trading hours.')
         if simulate:
             logger.info('Simulating data...')
-            simulate_subscribe_bars(bar_data_handler, *symbols)
+            await simulate_subscribe_bars(bar_data_handler, *symbols)
         else:
             logger.info('Guess we\'ll wait...')
     # Subscribe stock data stream
@@ -130,31 +153,59 @@ async def live_stock_stream(symbols, simulate=False, subscribe_trades=False):
         close_after_trading_hours(wss_client)
     )
 
-def run_wss_client(wss_client: DataStream, client_type="unknown"):
+def run_wss_client(wss_client: 'DataStream', client_type="unknown"):
     if wss_client is None:
         logger.error("Error: WebSocket client is None. Exiting run_wss_client.")
         return
+    metrics.count_stream_start(client_type)
     try:
         wss_client.run()
     except ValueError as e:
         if "connection limit exceeded" in str(e):
             logger.error(f"run_wss_client: ValueError (connection limit) {e}")
+            metrics.count_stream_error(client_type, 'connection_limit')
         else:
             logger.error(f"ValueError run_wss_client: {e}")
+            metrics.count_stream_error(client_type, 'value_error')
         return
     except Exception as e:
         logger.error(f"Error run_wss_client: {e}")
+        metrics.count_stream_error(client_type, type(e).__name__)
     finally:
         logger.info(f"{client_type} stream ended.")
 
 # Get the OHLCV 1 min bars for the given symbol
 async def bar_data_handler(data):
-    logger.info(f'BAR_1MIN: {bar_to_oneline_string(data)}')
-    add_bar_row_to_db(data)
+    if startup_profiler.waiting:
+        startup_profiler.first_bar(data.symbol)
+    metrics.count_message('bars', data.symbol)
+    gap_detector.observe(data)
+    if bar_log_sampler.sample(logging.INFO):
+        logger.info('BAR_1MIN: %s', LazyFormat(bar_to_oneline_string, data))
+    bar_cache.update(data)
+    update_coalescer.remember(data)
+    await bar_writer.put(data)
+    await bar_aggregator.add(data)
 
 async def updatebar_data_handler(data):
-    logger.info(f'UPDATE_BAR: {bar_to_oneline_string(data)}')
-    update_bar_row_in_db(data)
+    metrics.count_message('updatedBars', data.symbol)
+    if bar_log_sampler.sample(logging.INFO):
+        logger.info('UPDATE_BAR: %s', LazyFormat(bar_to_oneline_string, data))
+    bar_cache.update(data)
+    update_coalescer.add(data)
+
+async def backfilled_bar_handler(data):
+    # bars fetched for a gap, they replace any bar of the same minute
+    bar_cache.update(data)
+    await bar_writer.put(data, update=True)
+    await bar_aggregator.add(data, update=True)
+
+async def trade_data_handler(data):
+    metrics.count_message('trades', data.symbol)
+    if trade_log_sampler.sample(logging.DEBUG):
+        logger.debug('TRADE: %s', data)
+    await trade_writer.put(data)
+    await trade_bar_aggregator.add(data)
 
 def start_sub(stocks_to_track=None, asset='stock'):
     """
@@ -162,8 +213,8 @@ def start_sub(stocks_to_track=None, asset='stock'):
 
     Alpaca provides sandbox urls for testing, but does not explain how to connect to them.
     """
-    stock_url = get_wss_url('stock', testing=TESTING)
-    crypto_url = get_wss_url('crypto', testing=TESTING)
+    stock_url = get_wss_url('stock', testing=TESTING, base_url=REPLAY_URL)
+    crypto_url = get_wss_url('crypto', testing=TESTING, base_url=REPLAY_URL)
     
     # if stocks_to_track is None, get the stocks to track from the database.  
     # if asset is crypto, then use get_crypto_to_track() otherwise use get_stocks_to_track()
@@ -176,9 +227,13 @@ def start_sub(stocks_to_track=None, asset='stock'):
         symbols = stocks_to_track
     
     try:
-        if asset == 'stock':
+        if RAW_STREAM and asset in ('stock', 'crypto'):
+            wss_client = RawDataStream(API_KEY, API_SECRET, stock_url if asset == 'stock' else crypto_url, asset=asset)
+        elif asset == 'stock':
+            from alpaca.data.live import StockDataStream
             wss_client = StockDataStream(API_KEY, API_SECRET, url_override=stock_url)
         elif asset == 'crypto':
+            from alpaca.data.live import CryptoDataStream
             wss_client = CryptoDataStream(API_KEY, API_SECRET, url_override=crypto_url)
         else:
             logger.error(f"Unknown asset type: {asset}")
@@ -189,33 +244,55 @@ def start_sub(stocks_to_track=None, asset='stock'):
     finally:
         logger.info(f"Connected to the {asset} data stream")
 
+    if RECORD_DIR is not None:
+        recorder = FeedRecorder(RECORD_DIR, asset, url=wss_client._endpoint)
+        attach_recorder(wss_client, recorder)
+        recorders.append(recorder)
+
+    bar_cache.track(*symbols)
+    channels = {'bars': bar_data_handler, 'updatedBars': updatebar_data_handler}
+    if asset == 'stock' and SUBSCRIBE_TRADES:
+        channels['trades'] = trade_data_handler
     wss_client.subscribe_bars(bar_data_handler, *symbols)
     wss_client.subscribe_updated_bars(updatebar_data_handler, *symbols)
+    if 'trades' in channels:
+        wss_client.subscribe_trades(trade_data_handler, *symbols)
+    subscription_managers[wss_client] = SubscriptionManager(wss_client, channels, symbols=symbols, name=asset)
+    stream_supervisors[wss_client] = StreamSupervisor(wss_client, asset, run_wss_client)
+    gap_detector.watch(stream_supervisors[wss_client])
     return wss_client
 
-def update_sub(client, new_symbols, old_symbols):
-    # update the subscriptions to the new symbols
-    client.unsubscribe_bars(*old_symbols)
-    client.subscribe_bars(bar_data_handler, *new_symbols)
+async def update_sub(client, new_symbols, old_symbols):
+    # keep caching and aggregating the symbols that are still tracked
+    removed_symbols = set(old_symbols) - set(new_symbols)
+    bar_cache.evict(*removed_symbols)
+    bar_aggregator.forget(*removed_symbols)
+    trade_bar_aggregator.forget(*removed_symbols)
+    bar_cache.track(*new_symbols)
 
-    # update the corrected subscriptions to the new symbols
-    client.unsubscribe_updated_bars(*old_symbols)
-    client.subscribe_updated_bars(updatebar_data_handler, *new_symbols)
+    # only the added and removed symbols are subscribed and unsubscribed
+    await subscription_managers[client].update(new_symbols)
+
+async def wait_for_watchlist_change(asset, caller):
+    # Woken by the database when the watchlist changes, polling is the fallback
+    timeout = WATCHLIST_FALLBACK_FREQUENCY if watchlist_listener.connected else CHECK_FREQUENCY
+    logger.info(f'{caller}: waiting up to {timeout} secs for a watchlist change...')
+    if await watchlist_listener.wait(asset, timeout):
+        logger.info(f'{caller}: the {asset} watchlist changed')
 
 async def update_symbols(wss_client, symbols_to_track=()):
     current_stocks_to_track = symbols_to_track
 
     while True:
         # if is_trading_hours():
-        logger.info(f'update_symbols: sleeping for {CHECK_FREQUENCY} secs...')
-        await asyncio.sleep(CHECK_FREQUENCY)  # Sleep for 5 minutes
-        
+        await wait_for_watchlist_change('stock', 'update_symbols')
+
         # Check if the symbols to track have changed
         new_stocks_to_track = get_stocks_to_track()        
         if sorted(current_stocks_to_track) != sorted(new_stocks_to_track):
             logger.info(f'update_symbols: Updating stocks to track...now tracking {new_stocks_to_track}')
             old_stocks = set(current_stocks_to_track)
-            update_sub(wss_client, new_stocks_to_track, old_stocks)
+            await update_sub(wss_client, new_stocks_to_track, old_stocks)
             current_stocks_to_track = new_stocks_to_track
         else:
             logger.info('update_symbols: No changes to stocks to track')
@@ -224,78 +301,109 @@ async def update_crypto_symbols(wss_client, symbols_to_track=()):
     current_crypto_to_track = symbols_to_track
 
     while True:
-        logger.info(f'update_crypto_symbols: sleeping for {CHECK_FREQUENCY} secs...')
-        await asyncio.sleep(CHECK_FREQUENCY)  # Sleep for 5 minutes
+        await wait_for_watchlist_change('crypto', 'update_crypto_symbols')
         new_crypto_to_track = get_crypto_to_track()
         if sorted(current_crypto_to_track) != sorted(new_crypto_to_track):
             logger.info(f'update_crypto_symbols: Updating crypto to track...now tracking {new_crypto_to_track}')
             old_crypto = set(current_crypto_to_track)
-            update_sub(wss_client, new_crypto_to_track, old_crypto)
+            await update_sub(wss_client, new_crypto_to_track, old_crypto)
             current_crypto_to_track = new_crypto_to_track
         else:
             logger.info('update_crypto_symbols: No changes to crypto to track')
 
-async def start_stop_stock_stream(wss_client: DataStream, exit_off_hours: bool = True):
+async def supervise_stream(wss_client, start=True):
+    # Run the client and reconnect it when it drops, see helpers/stream_supervisor.py
+    if wss_client is None:
+        logger.error("Error: WebSocket client is None. Exiting supervise_stream.")
+        return
+    await stream_supervisors[wss_client].run(start=start)
+
+async def start_stop_stock_stream(wss_client: 'DataStream', exit_off_hours: bool = True):
     if wss_client is None:
         logger.error("Error: WebSocket client is None. Exiting start_stop_stock_stream.")
         return
-    # sleep for 5 seconds to allow the client to start
-    await asyncio.sleep(5)
+    await session_scheduler.run_during_sessions(stream_supervisors[wss_client], exit_off_hours=exit_off_hours)
 
-    while True:
-        if is_trading_hours():
-            # If the client has stopped, start the client
-            if not wss_client._running:
-                logger.info("Starting the stock stream...")
-                asyncio.create_task(asyncio.to_thread(run_wss_client, wss_client, client_type="stock"))
-        else:
-            # If the client is running, stop the client
-            if wss_client._running:
-                str_tmp = "temporarily" if not exit_off_hours else ""
-                logger.info(f"Trading hours have ended. Closing stock stream connection {str_tmp}...")
-                await wss_client.stop_ws()
-                if exit_off_hours:
-                    break
-            else:
-                logger.info("Currently outside of trading hours. Stock stream connection is closed.")
-
-        await asyncio.sleep(60)  # Check every minute
+def import_stream_clients():
+    # Imported in a thread while the preflight checks wait for the network and the database
+    if not RAW_STREAM:
+        importlib.import_module('alpaca.data.live')
+
+async def preflight(step, awaitable):
+    result = await awaitable
+    startup_profiler.mark(step)
+    return result
 
 async def sub_bars():
     """
-    start 4 tasks:
-    - start_stop_stock_stream: starts and stops a stock tracking client that is connected to alpaca's websocket
+    start 15 tasks:
+    - update_coalescer: writes the latest correction of a symbol and minute every window, cancelled before bar_writer so that it can flush
+    - bar_writer: writes the bars received by both clients to the database in batches
+    - trade_writer: copies the stock trades to the database in batches, when SUBSCRIBE_TRADES is set
+    - bar_aggregator: writes the 5 min to 1 day rollups that no new bar finished
+    - trade_bar_aggregator: writes the seconds bars built from the trades that no new trade finished
+    - report_pool_stats: logs the database pool usage at a specified interval.
+    - monitor_loops: measures the stalls of the event loops, when the metrics are served
+    - gap_detector: queues the minutes missed while a client was disconnected
+    - backfill_worker: fetches the missed minutes from the REST API and writes them
+    - watchlist_listener: wakes update_symbols and update_crypto_symbols when the watchlists change in the database
+    - supervise_stream: runs the stock tracking client while start_stop_stock_stream wants it running, and reconnects it
+    - start_stop_stock_stream: starts and stops the stock tracking client at the session opens and closes
     - update_symbols: updates the symbols to track at a specified interval.
-    - run_wss_client: starts a crypto tracking client that is connected to alpaca's websocket
+    - supervise_stream: runs a crypto tracking client that is connected to alpaca's websocket, and reconnects it
     - update_crypto_symbols: updates the crypto symbols to track at a specified interval.
     """
-    stock_symbols = get_stocks_to_track()
-    crypto_symbols = get_crypto_to_track()
-
-    # A check for the connection limit exceeded error
-    crypto_stream_url = get_wss_url('crypto', testing=TESTING)
-    stock_stream_url = get_wss_url('stock', testing=TESTING)
-    connection_available = await test_socket(url=crypto_stream_url)
-    if connection_available:
-        connection_available = await test_socket(url=stock_stream_url)
-    if not connection_available:
+    crypto_stream_url = get_wss_url('crypto', testing=TESTING, base_url=REPLAY_URL)
+    stock_stream_url = get_wss_url('stock', testing=TESTING, base_url=REPLAY_URL)
+
+    # The symbol queries, a check of both streams for the connection limit exceeded error, the pool of
+    # the writers and the import of the clients all wait on something else, so they run at once
+    stock_symbols, crypto_symbols, crypto_available, stock_available, _, _ = await asyncio.gather(
+        preflight('stocks to track', asyncio.to_thread(get_stocks_to_track)),
+        preflight('crypto to track', asyncio.to_thread(get_crypto_to_track)),
+        preflight('crypto stream check', test_socket(url=crypto_stream_url)),
+        preflight('stock stream check', test_socket(url=stock_stream_url)),
+        preflight('database pool', get_async_pool()),
+        preflight('stream clients imported', asyncio.to_thread(import_stream_clients))
+    )
+    if not (crypto_available and stock_available):
         logger.error("No connection available. Exiting sub_bars.")
         return
-    
+
     # A stock data stream client
     wss_stock_client = start_sub(stocks_to_track=stock_symbols, asset='stock')
 
     # A crypto data stream client
     wss_crypto_client = start_sub(stocks_to_track=crypto_symbols, asset='crypto')
+    startup_profiler.mark('clients created')
+    main_loop = asyncio.get_running_loop()
+    backfill_worker = BackfillWorker(gap_detector, HistoricalBarsClient(base_url=REST_URL), backfilled_bar_handler)
 
     try:
         await asyncio.gather(
+            # batched database writes for both clients
+            update_coalescer.run(),
+            bar_writer.run(),
+            trade_writer.run(),
+            bar_aggregator.run(),
+            trade_bar_aggregator.run(),
+            report_pool_stats(),
+            metrics.monitor_loops(lambda: (
+                ('main', main_loop),
+                ('stock', getattr(wss_stock_client, '_loop', None)),
+                ('crypto', getattr(wss_crypto_client, '_loop', None))
+            )),
+            gap_detector.run(),
+            backfill_worker.run(),
+            watchlist_listener.run(),
+
             # thread for tracking stock data
             update_symbols(wss_stock_client, symbols_to_track=stock_symbols),
+            supervise_stream(wss_stock_client, start=False),
             start_stop_stock_stream(wss_stock_client, exit_off_hours=False),
 
             # thread for tracking crypto data
-            asyncio.to_thread(run_wss_client, wss_crypto_client, client_type="crypto"),
+            supervise_stream(wss_crypto_client),
             update_crypto_symbols(wss_crypto_client, symbols_to_track=crypto_symbols)
         )
     except asyncio.CancelledError:
@@ -309,6 +417,10 @@ async def sub_bars():
         if wss_crypto_client is not None:
             logger.info("Stopping crypto WebSocket client...")
             wss_crypto_client.stop()
+        for recorder in recorders:
+            recorder.close()
+        log_pool_stats()
+        await close_pools()
 
 def main():
     # Create an ArgumentParser object
@@ -317,12 +429,56 @@ def main():
     # Add arguments
     parser.add_argument('-v', '--verbosity', help='Set console output verbosity level. 0 None, 1 Errors, 2 Info, 3 Debug', type=int, default=0)
     parser.add_argument('--log-verbosity', help='Set log file verbosity level. Options are "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL". Default is "INFO".', type=str, default="INFO")
+    parser.add_argument('--log-every', help='Log one in this many bars and trades. Default is 1, all of them.', type=int, default=1)
+    parser.add_argument('--log-max-per-sec', help='Log at most this many bars and this many trades a second. Default is 0, no limit.', type=float, default=0)
+    parser.add_argument('--trades', help='Also stream the trades of the tracked stocks into stock_trades_real_time.', action='store_true')
+    parser.add_argument('--trade-flush-interval', help=f'Seconds to collect trades before they are copied to the database. Default is {trade_writer.flush_interval}.', type=float, default=trade_writer.flush_interval)
+
+    parser.add_argument('--record-dir', help='Record the raw websocket frames of both streams to compressed capture files in this directory.', type=str, default=None)
+    parser.add_argument('--raw-stream', help='Decode the websocket frames with the lean client in helpers/raw_stream.py instead of alpaca-py.', action='store_true')
+    parser.add_argument('--replay-url', help='Connect to a local replay server, e.g. ws://localhost:8765, instead of Alpaca. See helpers/replay_server.py.', type=str, default=None)
+    parser.add_argument('--rest-url', help='Fetch missed bars from a local stub server, e.g. http://localhost:8766, instead of Alpaca. See helpers/rest_stub_server.py.', type=str, default=None)
+    parser.add_argument('--writer-processes', help='Receive in one process per stream and write the database in this many processes. Default is 0, everything in one process.', type=int, default=0)
+    parser.add_argument('--metrics-port', help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics. Default is off.', type=int, default=None)
+    parser.add_argument('--profile-startup', help='Log the time of every startup step, from the process start to the first bar received.', action='store_true')
+    parser.add_argument('--backfill-positions', help='Compute the positions table from all orders once, after data/db_positions.sql was run, and exit.', action='store_true')
 
     # Parse the arguments
     args = parser.parse_args()
+    if args.metrics_port is not None and args.writer_processes > 0:
+        parser.error('--metrics-port is not supported with --writer-processes')
+
+    global SUBSCRIBE_TRADES, RECORD_DIR, REPLAY_URL, REST_URL, RAW_STREAM, WRITER_PROCESSES
+    SUBSCRIBE_TRADES = args.trades
+    RECORD_DIR = args.record_dir
+    REPLAY_URL = args.replay_url
+    REST_URL = args.rest_url
+    RAW_STREAM = args.raw_stream
+    WRITER_PROCESSES = args.writer_processes
+    trade_writer.flush_interval = args.trade_flush_interval
+    startup_profiler.enabled = args.profile_startup
+    startup_profiler.mark('arguments')
 
     # Set the logger level based on verbosity
     set_file_log_level(level_str=args.log_verbosity)
+    for sampler in (bar_log_sampler, trade_log_sampler):
+        sampler.every = max(1, args.log_every)
+        sampler.per_second = args.log_max_per_sec
+
+    if args.backfill_positions:
+        with get_pool().connection() as connection:
+            backfill_positions(connection)
+        return
+
+    if WRITER_PROCESSES > 0:
+        config = {'testing': TESTING, 'replay_url': REPLAY_URL, 'rest_url': REST_URL, 'raw_stream': RAW_STREAM,
+                  'trades': SUBSCRIBE_TRADES, 'trade_flush_interval': trade_writer.flush_interval}
+        IngestSupervisor(WRITER_PROCESSES, config).run()
+        return
+
+    if args.metrics_port is not None:
+        metrics.watch_writer(bar_writer, trade_writer)
+        metrics.start_http_server(args.metrics_port)
 
     try:
         asyncio.run(sub_bars())
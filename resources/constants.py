@@ -1,3 +1,141 @@
 FILE_PATHS = {
-    'LOG_DIR': 'logs/'
-}
\ No newline at end of file
+    'LOG_DIR': 'logs/',
+    'SPOOL_DIR': 'spool/',
+    'ARCHIVE_DIR': 'archive/'
+}
+
+# Logging through a queue to a file per day (see helpers/logger.py)
+LOGGING = {
+    'QUEUE_SIZE': 10000,        # records waiting for the listener thread, more are dropped
+    'COMPRESS_AFTER_DAYS': 1,   # log files of earlier days are gzipped
+    'SAMPLE_EVERY': 1,          # log one in this many bars and trades
+    'MAX_PER_SEC': 0            # and at most this many a second per message type, 0 for no limit
+}
+
+# Batched writes of 1 min bars to stock_bars (see helpers/bar_writer.py)
+BAR_WRITER = {
+    'MAX_QUEUE': 10000,         # bars waiting to be written before the handlers block
+    'BATCH_SIZE': 500,          # flush as soon as this many bars are collected
+    'FLUSH_INTERVAL_SEC': 1.0   # or this long after the first bar of a batch arrived
+}
+
+# Binary COPY of trades into stock_trades_real_time (see helpers/trade_writer.py)
+TRADE_WRITER = {
+    'MAX_QUEUE': 100000,
+    'BATCH_SIZE': 5000,
+    'FLUSH_INTERVAL_SEC': 1.0,
+    'REPORT_FREQUENCY_SEC': 60  # how often rows/sec is logged
+}
+
+# Local spool for rows that cannot be written to the database (see helpers/spool.py)
+SPOOL = {
+    'SEGMENT_SIZE': 8 * 1024 * 1024,  # bytes per segment file, one segment is replayed per transaction
+    'DRAIN_FREQUENCY_SEC': 10         # how often the spool is replayed while the database is unavailable
+}
+
+# Recent 1 min bars kept in memory per symbol (see helpers/bar_cache.py)
+BAR_CACHE = {
+    'SIZE': 1440  # bars per symbol, one day of crypto minutes
+}
+
+# Corrected 1 min bars held back to write only the latest of a symbol and minute (see helpers/update_coalescer.py)
+UPDATE_COALESCER = {
+    'WINDOW_SEC': 2.0,           # corrections are held this long after the first one of a window
+    'RECENT_KEYS': 20000,        # (symbol, minute) keys whose written values are kept to drop duplicates
+    'REPORT_FREQUENCY_SEC': 300  # how often the saved writes are logged
+}
+
+# Rollups of the 1 min bars written to stock_bars with interval = minutes (see helpers/bar_aggregator.py)
+BAR_AGGREGATOR = {
+    'INTERVALS': (5, 15, 60, 1440),  # minutes, 1440 is a UTC day like time_bucket('1 day')
+    'CLOSE_DELAY_SEC': 60,           # a bucket without its last minute is written this long after it ended
+    'CHECK_FREQUENCY_SEC': 5         # how often buckets are checked for the close delay
+}
+
+# Bars built from the stock trades, written to stock_bars (see helpers/trade_bar_aggregator.py)
+TRADE_BARS = {
+    'SECONDS': (1, 10),       # time bars, seconds per bar
+    'TICKS': (100,),          # tick bars, trades per bar
+    'VOLUME': (10000,),       # volume bars, shares per bar
+    'CLOSE_DELAY_SEC': 2,     # a time bar is written this long after it ended when no later trade closed it
+    'CHECK_FREQUENCY_SEC': 1
+}
+
+# Trading sessions of the stock stream (see helpers/market_calendar.py)
+MARKET_CALENDAR = {
+    'PATH': 'data/market_calendar.json',  # the holidays and early closes
+    'TIMEZONE': 'US/Eastern',
+    'OPEN': '04:00',             # Alpaca's extended hours
+    'CLOSE': '20:00',
+    'EARLY_CLOSE': '17:00',      # extended hours end on the days the market closes at 13:00
+    'MAX_DAYS_CLOSED': 10,       # how far ahead the next session is looked for
+    'MAX_SLEEP_SEC': 300         # waits are split so that a change of the system clock is noticed
+}
+
+# Receiver and writer processes of the multi-process mode (see helpers/multiprocess_ingest.py)
+MULTIPROCESS = {
+    'QUEUE_SIZE': 1000,                # batches waiting per writer process before the receivers block
+    'SHARD_BATCH_SIZE': 200,           # records sent to a writer at once
+    'SHARD_FLUSH_INTERVAL_SEC': 0.05,  # or at least this often
+    'SUPERVISE_FREQUENCY_SEC': 1,      # how often the supervisor checks the processes
+    'MAX_RESTART_DELAY_SEC': 60,       # restarts back off up to this long
+    'STOP_CHECK_SEC': 0.5,             # how often the receivers check the stop event
+    'SHUTDOWN_TIMEOUT_SEC': 30         # time the receivers, then the writers, get to flush on shutdown
+}
+
+# Reconnects of the websocket clients (see helpers/stream_supervisor.py)
+STREAM_SUPERVISOR = {
+    'BACKOFF_BASE_SEC': 1,             # the delay after the first failed attempt, doubled after every next one
+    'MAX_BACKOFF_SEC': 60,
+    'CONNECTION_LIMIT_WAIT_SEC': 30,   # at least this long after a connection limit exceeded error
+    'STOP_CHECK_SEC': 0.5,             # how often a delay checks whether the client was stopped
+    'OUTAGES_KEPT': 100                # the most recent outages kept with their time to recover
+}
+
+# Prometheus metrics endpoint (see helpers/metrics.py)
+METRICS = {
+    'HOST': '127.0.0.1',
+    'LOOP_LAG_INTERVAL_SEC': 0.5,  # how often the event loops are checked for stalls
+    'LATENCY_BUCKETS': (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'LAG_BUCKETS': (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 65, 70, 90, 120, 300),  # a 1 min bar arrives after its minute
+    'RECOVERY_BUCKETS': (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+}
+
+# Requests to Alpaca's historical bars endpoints (see helpers/historical_bars.py)
+HISTORICAL_BARS = {
+    'REQUESTS_PER_MIN': 150,     # Alpaca allows 200 on the free plan, leave some for other programs
+    'PAGE_SIZE': 10000,          # bars per page, Alpaca's maximum
+    'TIMEOUT_SEC': 30,
+    'RETRIES': 5,                # for 429, 5xx and connection errors
+    'RETRY_DELAY_SEC': 1,        # doubled on every retry unless the answer has a Retry-After
+    'MAX_RETRY_DELAY_SEC': 60
+}
+
+# Minute bars missed while a stream was disconnected (see helpers/gap_backfill.py)
+GAP_BACKFILL = {
+    'CHECK_FREQUENCY_SEC': 1,     # how often the outages that ended are queued as gaps
+    'MAX_GAP_MIN': 1440,          # longer outages are backfilled for their last day only
+    'SYMBOLS_PER_REQUEST': 100,
+    'CONCURRENCY': 2,             # gaps fetched at the same time
+    'RETRY_DELAY_SEC': 60         # a gap that failed is tried once more after this long
+}
+
+# Bulk loads into stock_bars_historical (see helpers/historical_loader.py)
+HISTORICAL_LOADER = {
+    'CONCURRENCY': 4,            # requests and writes in flight
+    'SYMBOLS_PER_REQUEST': 100,  # symbols of one day fetched and written together
+    'REPORT_FREQUENCY_SEC': 10   # how often rows/sec is logged
+}
+
+# The checks before the streams start (see main.py and helpers/datastream_helper.py)
+STARTUP = {
+    'PREFLIGHT_TIMEOUT_SEC': 10  # to connect and authenticate to a stream in test_socket
+}
+
+# Parquet archive of the closed days of stock_bars and stock_trades_real_time (see helpers/bar_archive.py)
+BAR_ARCHIVE = {
+    'SETTLE_SEC': 3600,         # a day is exported this long after it ended in ET, once its corrections are in
+    'COMPRESSION': 'zstd',
+    'ROW_GROUP_SIZE': 1000000,  # rows per row group, a symbol's day of 1 min bars is one group
+    'MANIFEST_SAVE_SEC': 10     # how often the manifest is saved during an export
+}
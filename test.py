@@ -3,7 +3,7 @@ import os
 import tracemalloc
 from psycopg import sql, connect
 from dotenv import load_dotenv
-from helpers.database import connect_to_db, print_stock_bars_5min, get_crypto_to_track
+from helpers.database import connect_to_db, get_crypto_to_track
 from helpers.datastream_helper import start_stream
 
 load_dotenv()
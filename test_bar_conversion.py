@@ -0,0 +1,42 @@
+"""
+Tests of helpers/barConversion.py: the timestamps of printed bars in any field order.
+
+Usage:
+    python -m pytest test_bar_conversion.py
+"""
+
+import datetime
+
+import pytest
+
+from helpers.barConversion import bars_string_to_dict, bars_strings_to_columns
+
+TIMEZONES = [
+    datetime.timezone.utc,
+    datetime.timezone(datetime.timedelta(hours=-5)),
+    datetime.timezone(datetime.timedelta(hours=5, minutes=30), 'IST'),
+]
+
+def printed_bars(timestamp):
+    # The usual field order and another one
+    return (
+        f"symbol='AAPL' timestamp={timestamp!r} open=226.375 high=226.63 low=226.3 close=226.49 volume=15052.0 trade_count=208.0 vwap=226.463702",
+        f"open=226.375 symbol='AAPL' high=226.63 low=226.3 close=226.49 volume=15052.0 trade_count=208.0 vwap=226.463702 timestamp={timestamp!r}",
+    )
+
+@pytest.mark.parametrize('tzinfo', TIMEZONES, ids=str)
+def test_timestamp_with_a_fixed_offset(tzinfo):
+    timestamp = datetime.datetime(2024, 9, 23, 14, 59, 30, 250, tzinfo=tzinfo)
+    for line in printed_bars(timestamp):
+        parsed = bars_string_to_dict(line)['timestamp']
+        assert parsed == timestamp
+        assert parsed.utcoffset() == timestamp.utcoffset()
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    micros = (timestamp - epoch) // datetime.timedelta(microseconds=1)
+    assert list(bars_strings_to_columns(printed_bars(timestamp))['time']) == [micros, micros]
+
+def test_unsupported_timestamp_is_reported_whole():
+    value = "datetime.datetime(2024, 9, 23, 14, 59, tzinfo=zoneinfo.ZoneInfo(key='America/New_York'))"
+    with pytest.raises(ValueError) as error:
+        bars_string_to_dict(printed_bars(value)[1].replace(repr(value), value))
+    assert str(error.value) == f"Unsupported timestamp: {value}"
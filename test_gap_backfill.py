@@ -0,0 +1,154 @@
+"""
+Tests of helpers/gap_backfill.py and helpers/historical_bars.py against helpers/rest_stub_server.py: the
+outages reported by a StreamSupervisor, find_gaps, the paging of a backfill and the retry of a 429 with
+Retry-After.
+
+Usage:
+    python -m pytest test_gap_backfill.py
+"""
+
+import asyncio
+import datetime
+import email.utils
+import time
+
+import pytest
+import websockets
+
+from helpers.gap_backfill import Gap, GapDetector, BackfillWorker
+from helpers.historical_bars import HistoricalBarsClient, RateLimiter, retry_after
+from helpers.rest_stub_server import RestStubServer
+from helpers.stream_supervisor import StreamSupervisor
+
+UTC = datetime.timezone.utc
+
+def epoch(*args) -> int:
+    return int(datetime.datetime(*args, tzinfo=UTC).timestamp())
+
+class FakeClient:
+    # The parts of a DataStream that StreamSupervisor and GapDetector use
+    def __init__(self, symbols):
+        self._should_run = True
+        self._handlers = {'bars': dict.fromkeys(symbols)}
+
+    async def _connect(self):
+        pass
+
+    async def _auth(self):
+        pass
+
+    async def _consume(self):
+        raise websockets.ConnectionClosedError(None, None)
+
+    async def stop_ws(self):
+        self._should_run = False
+
+def test_find_gaps():
+    detector = GapDetector(max_gap_min=60)
+    detector.last_bar = {'AAPL': epoch(2024, 3, 5, 14, 28), 'MSFT': epoch(2024, 3, 5, 14, 31)}
+    gaps = detector.find_gaps('stock', ['AAPL', 'MSFT', 'NVDA'], epoch(2024, 3, 5, 14, 30, 20), epoch(2024, 3, 5, 14, 35, 5))
+    # The bar of 14:29 arrives after 14:30, so it may be missing too; 14:34 is the last complete minute
+    assert [(gap.symbols, gap.start, gap.end) for gap in gaps] == [
+        (['AAPL', 'NVDA'], epoch(2024, 3, 5, 14, 29), epoch(2024, 3, 5, 14, 34)),
+        (['MSFT'], epoch(2024, 3, 5, 14, 32), epoch(2024, 3, 5, 14, 34)),
+    ]
+
+def test_find_gaps_of_a_long_outage_keeps_the_last_minutes():
+    detector = GapDetector(max_gap_min=10)
+    gaps = detector.find_gaps('crypto', ['BTC/USD'], epoch(2024, 3, 5, 10), epoch(2024, 3, 5, 14))
+    assert (gaps[0].start, gaps[0].end) == (epoch(2024, 3, 5, 13, 50), epoch(2024, 3, 5, 13, 59))
+
+def test_find_gaps_within_a_minute():
+    detector = GapDetector()
+    detector.last_bar = {'AAPL': epoch(2024, 3, 5, 14, 29)}
+    assert detector.find_gaps('stock', ['AAPL'], epoch(2024, 3, 5, 14, 30, 10), epoch(2024, 3, 5, 14, 30, 12)) == []
+
+def test_a_drop_and_an_immediate_reconnect_is_an_outage():
+    async def run():
+        client = FakeClient(['AAPL'])
+        supervisor = StreamSupervisor(client, 'stock', None)
+        detector = GapDetector()
+        detector.watch(supervisor)
+        await client._auth()
+        with pytest.raises(websockets.ConnectionClosedError):
+            await client._consume()
+        await client._auth()
+        return detector
+
+    detector = asyncio.run(run())
+    # Both events are queued, so check() finds the outage however short it was
+    detector.check()
+    assert detector.outages == 1
+
+def test_an_outage_ended_by_a_stop_is_forgotten():
+    async def run():
+        client = FakeClient(['AAPL'])
+        supervisor = StreamSupervisor(client, 'stock', None)
+        detector = GapDetector()
+        detector.watch(supervisor)
+        await client._auth()
+        with pytest.raises(websockets.ConnectionClosedError):
+            await client._consume()
+        await supervisor.stop()
+        client._should_run = True
+        await client._auth()
+        return detector
+
+    detector = asyncio.run(run())
+    assert detector.check() == []
+    assert detector.outages == 0
+
+def test_backfill_pages_through_the_stub():
+    stub = RestStubServer(port=0, skip_every=7).start()
+    client = HistoricalBarsClient(base_url=stub.url, rate_limiter=RateLimiter(60000), page_size=50)
+    bars = []
+
+    async def on_bar(bar):
+        bars.append(bar)
+
+    worker = BackfillWorker(GapDetector(), client, on_bar, symbols_per_request=2)
+    gap = Gap('stock', ['AAPL', 'MSFT', 'NVDA'], epoch(2024, 3, 5, 14), epoch(2024, 3, 5, 15, 59))
+    try:
+        count = asyncio.run(worker.backfill(gap))
+    finally:
+        client.close()
+        stub.stop()
+
+    # 120 minutes a symbol less the ones the stub skips, over several pages and two requests of symbols
+    assert count == len(bars)
+    assert 3 * 120 * 6 // 7 - 3 <= count <= 3 * 120 * 6 // 7 + 3
+    assert {bar.symbol for bar in bars} == {'AAPL', 'MSFT', 'NVDA'}
+    assert min(bar.timestamp for bar in bars) >= datetime.datetime(2024, 3, 5, 14, tzinfo=UTC)
+    assert max(bar.timestamp for bar in bars) <= datetime.datetime(2024, 3, 5, 15, 59, tzinfo=UTC)
+    assert client.requests_sent > 2
+    assert client.requests_retried == 0
+
+def test_429_is_retried_after_retry_after():
+    stub = RestStubServer(port=0, skip_every=0, rate_limit=1, window=1).start()
+    client = HistoricalBarsClient(base_url=stub.url, rate_limiter=RateLimiter(60000), page_size=30)
+
+    async def fetch():
+        pages = []
+        async for bars in client.pages('crypto', ['BTC/USD'], datetime.datetime(2024, 3, 5, 14, tzinfo=UTC), datetime.datetime(2024, 3, 5, 14, 59, tzinfo=UTC)):
+            pages.append(bars)
+        return pages
+
+    started = time.monotonic()
+    try:
+        pages = asyncio.run(fetch())
+    finally:
+        client.close()
+        stub.stop()
+
+    assert [len(bars) for bars in pages] == [30, 30]
+    assert stub.throttled >= 1
+    assert client.requests_retried == stub.throttled
+    # The stub asked for a second, not the doubling delay of a retry without Retry-After
+    assert 0.5 <= time.monotonic() - started < 5
+
+def test_retry_after():
+    assert retry_after('3', 1) == 3
+    assert retry_after(None, 1) == 1
+    assert retry_after('soon', 1) == 1
+    assert 25 < retry_after(email.utils.formatdate(time.time() + 30, usegmt=True), 1) <= 30
+    assert retry_after('Wed, 21 Oct 2015 07:28:00 GMT', 1) == 0
@@ -0,0 +1,109 @@
+"""
+Tests of helpers/historical_loader.py against helpers/rest_stub_server.py: the fetch of every timeframe
+with paging, the planning of the units and the resume of an interrupted load.  The database is replaced
+by a dict of checkpoints.
+
+Usage:
+    python -m pytest test_historical_loader.py
+"""
+
+import argparse
+import asyncio
+import datetime
+
+import pytest
+
+import helpers.historical_loader as historical_loader
+from helpers.historical_bars import HistoricalBarsClient, RateLimiter
+from helpers.historical_loader import HistoricalLoader, LoadUnit, plan_units
+from helpers.rest_stub_server import RestStubServer
+
+@pytest.fixture(scope='module')
+def stub():
+    server = RestStubServer(port=0, skip_every=0).start()
+    yield server
+    server.stop()
+
+def make_client(stub, page_size=10000) -> HistoricalBarsClient:
+    return HistoricalBarsClient(base_url=stub.url, rate_limiter=RateLimiter(60000), page_size=page_size)
+
+@pytest.mark.parametrize('timeframe, interval, bars_per_day', [
+    ('1Min', 1, 1440),
+    ('5Min', 5, 288),
+    ('1Hour', 60, 24),
+    ('1Day', 1440, 1),
+])
+def test_fetch_timeframes(stub, timeframe, interval, bars_per_day):
+    client = make_client(stub, page_size=500)
+    loader = HistoricalLoader(client, timeframe=timeframe)
+    day = datetime.date(2024, 3, 5)
+    rows = asyncio.run(loader.fetch(LoadUnit(day, ['AAPL', 'MSFT'])))
+    client.close()
+
+    assert len(rows) == 2 * bars_per_day
+    assert {row[-1] for row in rows} == {interval}
+    assert {row[0].date() for row in rows} == {day}
+    for symbol in ('AAPL', 'MSFT'):
+        times = [row[0] for row in rows if row[1] == symbol]
+        assert times == sorted(times)
+        assert all(later - earlier == datetime.timedelta(minutes=interval) for earlier, later in zip(times, times[1:]))
+    # 500 bars a page
+    assert client.requests_sent == -(-len(rows) // 500)
+
+def test_fetch_weekend_stocks(stub):
+    client = make_client(stub)
+    rows = asyncio.run(HistoricalLoader(client).fetch(LoadUnit(datetime.date(2024, 3, 9), ['AAPL'])))
+    client.close()
+    assert rows == []
+
+def test_plan_units():
+    symbols = ['AAPL', 'AMZN', 'MSFT']
+    start = datetime.date(2024, 3, 8)  # a Friday
+    end = datetime.date(2024, 3, 11)
+    done = {('AAPL', datetime.date(2024, 3, 8)), ('AMZN', datetime.date(2024, 3, 8)), ('MSFT', datetime.date(2024, 3, 8))}
+
+    units = plan_units(symbols, start, end, done, symbols_per_request=2)
+    # Friday is done, Sunday has no stock bars
+    assert [(unit.day, unit.symbols) for unit in units] == [
+        (datetime.date(2024, 3, 9), ['AAPL', 'AMZN']), (datetime.date(2024, 3, 9), ['MSFT']),
+        (datetime.date(2024, 3, 11), ['AAPL', 'AMZN']), (datetime.date(2024, 3, 11), ['MSFT']),
+    ]
+    crypto_days = {unit.day for unit in plan_units(symbols, start, end, set(), asset='crypto')}
+    assert datetime.date(2024, 3, 10) in crypto_days
+
+def test_resume(stub, monkeypatch):
+    checkpoints = {}  # (symbol, day, interval): rows
+    failing_days = {datetime.date(2024, 3, 5)}
+
+    def load_checkpoints(symbols, start_day, end_day, interval):
+        return {(symbol, day) for symbol, day, checkpoint_interval in checkpoints
+                if symbol in symbols and start_day <= day <= end_day and checkpoint_interval == interval}
+
+    async def write(self, unit, rows):
+        if unit.day in failing_days:
+            raise ConnectionError("the database went away")
+        for symbol in unit.symbols:
+            checkpoints[(symbol, unit.day, self.interval)] = sum(1 for row in rows if row[1] == symbol)
+
+    async def close_pools():
+        pass
+
+    monkeypatch.setattr(historical_loader, 'load_checkpoints', load_checkpoints)
+    monkeypatch.setattr(historical_loader, 'close_pools', close_pools)
+    monkeypatch.setattr(HistoricalLoader, 'write', write)
+    args = argparse.Namespace(symbols='MSFT,AAPL', asset='stock', start='2024-03-04', end='2024-03-06',
+                              timeframe='1Hour', concurrency=2, rest_url=stub.url)
+
+    summary = asyncio.run(historical_loader.load(args))
+    assert (summary['units'], summary['units_loaded'], summary['units_failed']) == (3, 2, 1)
+    assert ('AAPL', datetime.date(2024, 3, 5), 60) not in checkpoints
+
+    # The next run only loads the day that failed
+    failing_days.clear()
+    summary = asyncio.run(historical_loader.load(args))
+    assert (summary['units'], summary['units_loaded'], summary['rows']) == (1, 1, 2 * 24)
+    assert checkpoints[('AAPL', datetime.date(2024, 3, 5), 60)] == 24
+    assert len(checkpoints) == 6
+
+    summary = asyncio.run(historical_loader.load(args))
+    assert summary['units'] == 0
@@ -0,0 +1,100 @@
+"""
+Tests of helpers/market_calendar.py: the sessions around the DST changes, the holidays and the early
+closes of data/market_calendar.json.
+
+Usage:
+    python -m pytest test_market_calendar.py
+"""
+
+import datetime
+
+import pytest
+
+from helpers.market_calendar import MarketCalendar, _dst_changes, check
+
+UTC = datetime.timezone.utc
+
+@pytest.fixture(scope='module')
+def calendar():
+    return MarketCalendar(year=2024)
+
+def utc(*args) -> float:
+    return datetime.datetime(*args, tzinfo=UTC).timestamp()
+
+def local(calendar, epoch) -> datetime.time:
+    return datetime.datetime.fromtimestamp(epoch, calendar.timezone).time()
+
+def test_dst_changes(calendar):
+    assert _dst_changes(calendar, 2024) == [datetime.date(2024, 3, 10), datetime.date(2024, 11, 3)]
+    assert _dst_changes(calendar, 2025) == [datetime.date(2025, 3, 9), datetime.date(2025, 11, 2)]
+
+@pytest.mark.parametrize('day, open, close', [
+    # EST before the spring change, EDT after it
+    (datetime.date(2024, 3, 8), (9, 0), (1, 0)),
+    (datetime.date(2024, 3, 11), (8, 0), (0, 0)),
+    # EDT before the fall change, EST after it
+    (datetime.date(2024, 11, 1), (8, 0), (0, 0)),
+    (datetime.date(2024, 11, 4), (9, 0), (1, 0)),
+])
+def test_sessions_around_dst_changes(calendar, day, open, close):
+    session = calendar.session(day)
+    assert session.open == utc(day.year, day.month, day.day, *open)
+    next_day = day + datetime.timedelta(days=1)
+    assert session.close == utc(next_day.year, next_day.month, next_day.day, *close)
+    assert calendar.session_at(session.open) is session
+    assert calendar.session_at(session.close - 1) is session
+    assert not calendar.is_open(session.open - 1)
+    assert not calendar.is_open(session.close)
+
+@pytest.mark.parametrize('year', [2024, 2025, 2026, 2027])
+def test_every_session_is_4_to_20_et(year):
+    calendar = MarketCalendar(year=year)
+    day = datetime.date(year, 1, 1)
+    sessions = 0
+    while day.year == year:
+        session = calendar.session(day)
+        if session is not None:
+            sessions += 1
+            assert local(calendar, session.open) == datetime.time(4)
+            assert local(calendar, session.close) == (datetime.time(17) if session.early_close else datetime.time(20))
+            # session_at finds the session from a time in it, also in the evening when the UTC day changed
+            assert calendar.session_at(session.close - 60) is session
+        day += datetime.timedelta(days=1)
+    assert 248 <= sessions <= 253
+
+def test_sunday_after_the_spring_change(calendar):
+    # Closed on the day of the change, the next session is Monday at 4:00 EDT
+    now = utc(2024, 3, 10, 12)
+    assert not calendar.is_open(now)
+    assert calendar.next_session(now).day == datetime.date(2024, 3, 11)
+
+def test_holidays(calendar):
+    holidays = [day for day in calendar.holidays if day.year == 2024]
+    assert datetime.date(2024, 7, 4) in holidays
+    assert datetime.date(2024, 12, 25) in holidays
+    for day in holidays:
+        assert calendar.session(day) is None
+        assert not calendar.is_open(calendar._epoch(day, datetime.time(12)))
+
+def test_next_session_skips_a_long_weekend(calendar):
+    # Good Friday 2024 is a holiday, the Thursday evening is followed by Monday's session
+    now = calendar._epoch(datetime.date(2024, 3, 28), datetime.time(21))
+    assert calendar.session(datetime.date(2024, 3, 29)) is None
+    assert calendar.next_session(now).day == datetime.date(2024, 4, 1)
+
+def test_early_closes(calendar):
+    session = calendar.session(datetime.date(2024, 11, 29))
+    assert session.early_close
+    assert session.close == utc(2024, 11, 29, 22)
+    assert calendar.is_open(session.close - 1)
+    assert not calendar.is_open(session.close)
+    assert not calendar.session(datetime.date(2024, 11, 27)).early_close
+
+def test_year_missing_from_the_file_has_every_weekday():
+    calendar = MarketCalendar(year=2031)
+    # New Year's Day is a Wednesday, there are no holidays for the year
+    assert calendar.session(datetime.date(2031, 1, 1)) is not None
+    assert calendar.session(datetime.date(2031, 1, 4)) is None
+
+def test_check_passes(calendar):
+    assert check(calendar, 2024) == 0
@@ -0,0 +1,65 @@
+"""
+Tests of helpers/trade_bar_aggregator.py: late trades and the unique stamps of tick bars.
+
+Usage:
+    python -m pytest test_trade_bar_aggregator.py
+"""
+
+import asyncio
+import datetime
+
+from helpers.trade_bar_aggregator import TradeBarAggregator
+
+START = datetime.datetime(2024, 3, 5, 14, 30, tzinfo=datetime.timezone.utc)
+
+class Trade:
+    def __init__(self, symbol, seconds, price=100.0, size=10):
+        self.symbol = symbol
+        self.timestamp = START + datetime.timedelta(seconds=seconds)
+        self.price = price
+        self.size = size
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+
+    async def put_row(self, row):
+        self.rows.append(row)
+
+def add(aggregator, *trades):
+    async def run():
+        for trade in trades:
+            await aggregator.add(trade)
+    asyncio.run(run())
+
+def test_a_trade_of_a_bar_closed_by_close_due_is_late():
+    writer = ListWriter()
+    aggregator = TradeBarAggregator(writer, seconds=(1,), ticks=(), volume=(), close_delay=2)
+    add(aggregator, Trade('AAPL', 0.5))
+    rows = aggregator.close_due(now=START.timestamp() + 3)
+    assert len(rows) == 1
+    add(aggregator, Trade('AAPL', 0.9), Trade('AAPL', 3.1))
+    assert aggregator.late_trades == 1
+    assert writer.rows == []
+    assert aggregator.close_due(now=START.timestamp() + 10)[0][0] == START + datetime.timedelta(seconds=3)
+
+def test_a_trade_older_than_the_open_bar_is_late():
+    writer = ListWriter()
+    aggregator = TradeBarAggregator(writer, seconds=(1,), ticks=(), volume=())
+    add(aggregator, Trade('AAPL', 0.1), Trade('AAPL', 1.1), Trade('AAPL', 0.5), Trade('MSFT', 0.5))
+    assert aggregator.late_trades == 1
+    assert [row[0] for row in writer.rows] == [START]
+
+def test_forget_drops_the_closed_bars():
+    aggregator = TradeBarAggregator(ListWriter(), seconds=(1,), ticks=(), volume=(), close_delay=0)
+    add(aggregator, Trade('AAPL', 0.5))
+    aggregator.close_due(now=START.timestamp() + 5)
+    aggregator.forget('AAPL')
+    add(aggregator, Trade('AAPL', 0.6))
+    assert aggregator.late_trades == 0
+
+def test_tick_bars_in_the_same_microsecond_get_unique_stamps():
+    writer = ListWriter()
+    aggregator = TradeBarAggregator(writer, seconds=(), ticks=(1,), volume=())
+    add(aggregator, Trade('AAPL', 0), Trade('AAPL', 0), Trade('AAPL', 0))
+    assert [row[0] for row in writer.rows] == [START + datetime.timedelta(microseconds=n) for n in range(3)]